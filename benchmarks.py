@@ -0,0 +1,83 @@
+from time import perf_counter
+from typing import Callable
+import numpy as np
+
+from wiggle.cache import MemoryCache
+from wiggle.samplerparams import SamplerParameters
+from wiggle.sequencer import Event, Sequencer, SequencerParams
+from wiggle.stretch import shift_pitch, stretch
+
+samplerate = 44100
+
+lengths = {
+    'one-shot (0.5s)': 0.5,
+    'loop (8s)': 8,
+}
+
+qualities = ['fast', 'standard', 'high']
+
+
+def tone(duration: float) -> np.ndarray:
+    t = np.linspace(0, duration, int(samplerate * duration), endpoint=False)
+    return np.sin(2 * np.pi * 220 * t) * np.exp(-t * 2) \
+        + np.random.uniform(-0.05, 0.05, len(t))
+
+
+def timeit(func: Callable[[], np.ndarray], repeats: int = 5) -> float:
+    # the first call absorbs any one-time costs, e.g. JIT compilation
+    func()
+
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return float(np.median(times))
+
+
+def benchmark_quality_tiers():
+    for label, duration in lengths.items():
+        samples = tone(duration)
+
+        operations = {
+            'time-stretch x1.25': lambda q: stretch(samples, 1.25, q),
+            'pitch-shift +5': lambda q: shift_pitch(samples, samplerate, 5, q),
+        }
+
+        for op_name, op in operations.items():
+            timings = {q: timeit(lambda: op(q)) for q in qualities}
+            baseline = timings['standard']
+            summary = ', '.join(
+                f'{q}: {t * 1000:.1f}ms ({baseline / t:.1f}x)'
+                for q, t in timings.items())
+            print(f'{label}, {op_name} -> {summary}')
+
+
+def benchmark_mixing():
+    grain = tone(0.5)
+    
+    def synth(params: SamplerParameters) -> np.ndarray:
+        return grain
+    
+    params = SamplerParameters(url='grain')
+    
+    for count in [64, 512, 4096]:
+        pattern = SequencerParams(
+            events=[
+                Event(gain=1, time=t, synth=synth, params=params) 
+                for t in np.random.uniform(0, 8, count)],
+            speed=1,
+            normalize=False)
+        
+        timings = {
+            mode: timeit(lambda: Sequencer(
+                samplerate, render_cache=MemoryCache(0), mixing=mode).render(pattern))
+            for mode in ['direct', 'impulse', 'auto']
+        }
+        summary = ', '.join(f'{m}: {t * 1000:.1f}ms' for m, t in timings.items())
+        print(f'{count} grains over 8s -> {summary}')
+
+
+if __name__ == '__main__':
+    benchmark_quality_tiers()
+    benchmark_mixing()
@@ -4,7 +4,7 @@ from wiggle import Sampler, SamplerParameters, FilterParameters, \
     Sequencer, SequencerParams, eighth, quarter, thirtysecond, measure, sixteenth
 
 import numpy as np
-from copy import deepcopy
+from dataclasses import replace
 from itertools import chain
 
 from wiggle.sequencer import Event, repeat
@@ -212,18 +212,21 @@ def sequencer_example():
     # overlay the two sequences
     sequencer_params = hat_params + kick_params
     
-    # repeat the entire pattern four times
+    # loop the entire pattern four times, rendering it only once
     seq_params = SequencerParams(
-        events=repeat(every=measure, fur=measure * 4, evt=sequencer_params.once(sequencer)),
+        events=[sequencer_params.loop(sequencer, period=measure, count=4)],
         speed=speed,
         normalize=True
     )
     
     # TODO: nice way to visit each node in the graph and transform
-    echoed = deepcopy(seq_params.events)
-    for echo in echoed:
-        echo.time = echo.time + np.random.uniform(0, 0.2)
-        echo.gain = np.random.uniform(0.01, 0.4)
+    echoed = [
+        replace(
+            echo, 
+            time=echo.time + np.random.uniform(0, 0.2), 
+            gain=np.random.uniform(0.01, 0.4))
+        for echo in seq_params.events
+    ]
     echoed_params = SequencerParams(echoed, speed=speed, normalize=sequencer_params.normalize)
     
     top_level_params = seq_params + echoed_params
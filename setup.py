@@ -28,6 +28,8 @@ setup(
     classifiers=[
         "Programming Language :: Python :: 3",
     ],
+    # frozen dataclasses use slots, which require python 3.10
+    python_requires='>=3.10',
     setup_requires=[
         'lmdb',
         'requests',
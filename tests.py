@@ -1,10 +1,36 @@
 from unittest import TestCase, skip
-from wiggle import Sampler, Sequencer, SamplerParameters, SequencerParams, AudioFetcher, Event, encode_samples
+from unittest.mock import patch
+from wiggle import Sampler, Sequencer, SamplerParameters, SequencerParams, AudioFetcher, Event, encode_samples, \
+    encode_sample_blocks, write_sample_blocks
 import numpy as np
-from wiggle.samplerparams import ReverbParameters
+from wiggle.cache import MemoryCache, set_default_cache_bytes
+import wiggle.cache as cache_module
+from wiggle.canvas import BlockSparseCanvas
+from wiggle.scheduler import RenderScheduler
+from wiggle.incremental import IncrementalRenderer
+from wiggle.cancellation import CancellationToken, RenderCancelled, cancellable
+from wiggle.governor import checkpoint
+from wiggle.singleflight import SingleFlight
+from wiggle.governor import ResourceGovernor, ResourceLimits, ResourceLimitExceeded
+from wiggle.wiggle import Permissions, Wiggle
+from wiggle.synthtype import SynthType
+from wiggle.sequencer import EventTable, Loop, repeat, default_render_cache
+from wiggle.stretch import wsola_time_stretch, resample_pitch_shift
+from wiggle.sampler import fft_convolve, trim_tail, impulse_response_cache, \
+    PartitionedConvolver, cached_reverb, reverb, StageCache, default_stage_cache, \
+    convolve_impulse_response
+from wiggle.lmdbcache import LmdbAudioCache
+from wiggle.fetch import audio_bytes, fetch_audio_from_url
+from tempfile import TemporaryDirectory
+from wiggle.samplerparams import ReverbParameters, GainParameters, GainKeyPoint, FilterParameters
 from wiggle.sourcematerial import SourceMaterial
 from wiggle.synths import get_synth, get_synth_by_id, get_synth_by_name, list_synths, render, restore_params_from_dict
 import json
+import pickle
+import time
+import threading
+import asyncio
+from dataclasses import FrozenInstanceError, dataclass, replace
 from soundfile import SoundFile
 from io import BytesIO
 
@@ -20,8 +46,93 @@ class FakeAudioFetcher(AudioFetcher):
     def fetch(self, url):
         return self.__call__(url)
 
+class StreamingSession(object):
+    """
+    Serves a body of `chunks` chunks of `chunk_size` bytes for any url,
+    recording how many were read
+    """
+    def __init__(self, chunks: int, chunk_size: int, content_length: bool = False):
+        super().__init__()
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.headers = {'Content-Length': str(chunks * chunk_size)} if content_length else {}
+        self.read = 0
+    
+    def get(self, url, stream=False, timeout=None):
+        return self
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+    
+    def raise_for_status(self):
+        pass
+    
+    def iter_content(self, chunk_size=None):
+        for _ in range(self.chunks):
+            self.read += 1
+            yield bytes(self.chunk_size)
+
+
+class RecordingAudioFetcher(FakeAudioFetcher):
+    def __init__(self, get_duration_func = lambda url: 1):
+        super().__init__(get_duration_func)
+        self.fetched = []
+        self.prefetched = []
+    
+    def fetch(self, url):
+        self.fetched.append(url)
+        return super().fetch(url)
+    
+    def prefetch(self, urls):
+        urls = list(urls)
+        self.prefetched.extend(urls)
+        return super().prefetch(urls)
+
+
+class DeterministicAudioFetcher(FakeAudioFetcher):
+    """
+    Returns the same noise for a given URL every time it is fetched
+    """
+    def __call__(self, url):
+        duration = self.get_duration_func(url)
+        rng = np.random.default_rng(sum(url.encode()))
+        return rng.uniform(-1, 1, int(22050 * duration))
+
+
+def one_second(url: str) -> int:
+    return 1
+
+
+def nested_pattern(sampler: Sampler, sequencer: Sequencer) -> SequencerParams:
+    hat = SamplerParameters(url='https://example.com/hat', duration_seconds=0.25)
+    kick = SamplerParameters(url='https://example.com/kick', duration_seconds=0.5)
+    
+    bar = SequencerParams(
+        events=[
+            *[Event(gain=0.5, time=t * 0.5, synth=sampler, params=hat) for t in range(8)],
+            *[Event(gain=1, time=t, synth=sampler, params=kick) for t in range(4)],
+        ],
+        speed=1,
+        normalize=True)
+    
+    return SequencerParams(
+        events=[bar.once(sequencer) >> t for t in range(0, 16, 4)],
+        speed=1,
+        normalize=True)
+
+
 class Tests(TestCase):
     
+    def setUp(self):
+        # renders shared by synths built with the default caches mustn't
+        # depend on which tests ran first
+        default_render_cache.clear()
+        default_stage_cache.cache.clear()
+        impulse_response_cache.clear()
+    
     def test_can_get_schema_for_sampler(self):
         sampler = Sampler(FakeAudioFetcher())
         schema = sampler.schema
@@ -48,7 +159,7 @@ class Tests(TestCase):
         )
     
     
-    def test_sampler_audio_render_is_as_long_as_impulse_response(self):
+    def test_sampler_audio_render_is_linear_convolution_length(self):
         def get_duration(url: str) -> int:
             if 'ir' in url:
                 return 10
@@ -66,7 +177,9 @@ class Tests(TestCase):
                 url='https://example.com/ir',
                 mix=0.5
             )))
-        self.assertEqual(samples.shape, (fetcher.samplerate * 10,))
+        
+        # the full, linear convolution includes the impulse response's tail
+        self.assertEqual(samples.shape, (fetcher.samplerate * (10 + 2) - 1,))
     
     
     def test_sampler_params_from_dict_infers_start_0(self):
@@ -361,7 +474,1593 @@ class Tests(TestCase):
             retrieved = sf.read()
         
         self.assertEqual(len(samples), len(retrieved))
+
+    def test_memory_cache_evicts_least_recently_used_items_over_byte_budget(self):
+        cache = MemoryCache(max_bytes=3 * 8 * 100)
+        cache.put('a', np.zeros(100))
+        cache.put('b', np.zeros(100))
+        cache.put('c', np.zeros(100))
+        
+        # touch a, so that b is now the least-recently used
+        cache.get('a')
+        cache.put('d', np.zeros(100))
+        
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(1, cache.stats.evictions)
+        self.assertEqual(3 * 8 * 100, cache.stats.resident_bytes)
+    
+    def test_memory_cache_does_not_store_items_larger_than_budget(self):
+        cache = MemoryCache(max_bytes=8 * 100)
+        cache.put('a', np.zeros(10))
+        cache.put('b', np.zeros(1000))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(0, cache.stats.evictions)
+    
+    def test_memory_cache_reports_hits_and_misses(self):
+        cache = MemoryCache(max_bytes=1024)
+        cache.get('a')
+        cache.put('a', np.zeros(10))
+        cache.get('a')
+        cache.get('a')
+        stats = cache.stats
+        self.assertEqual(2, stats.hits)
+        self.assertEqual(1, stats.misses)
+    
+    def test_shared_caches_divide_a_single_configurable_budget(self):
+        caches = [default_render_cache, default_stage_cache.cache, impulse_response_cache]
+        self.assertLessEqual(
+            sum(c.max_bytes for c in [*caches, AudioFetcher(22050).memory_cache]), 
+            cache_module.default_cache_bytes)
+        
+        default_render_cache.put('a', np.zeros(1000))
+        
+        original = cache_module.default_cache_bytes
+        try:
+            set_default_cache_bytes(2 ** 10)
+            self.assertLessEqual(sum(c.max_bytes for c in caches), 2 ** 10)
+            self.assertNotIn('a', default_render_cache)
+        finally:
+            set_default_cache_bytes(original)
+        
+        self.assertEqual(int(original * 0.2), default_render_cache.max_bytes)
+    
+    def test_fetchers_share_cache_entries_by_url_and_samplerate(self):
+        cache = MemoryCache(max_bytes=1024 * 1024)
+        url = 'https://example.com/sound'
+        samples = np.random.uniform(-1, 1, 1000)
+        cache.put((url, 22050), samples)
+        
+        a = AudioFetcher(22050, memory_cache=cache)
+        b = AudioFetcher(22050, memory_cache=cache)
+        
+        self.assertIs(samples, a.fetch(url))
+        self.assertIs(samples, b.fetch(url))
+        self.assertEqual(2, b.cache_stats.hits)
+    
+    def test_fetcher_can_be_configured_with_private_byte_budget(self):
+        fetcher = AudioFetcher(22050, memory_cache_bytes=1024)
+        self.assertEqual(1024, fetcher.cache_stats.max_bytes)
+        self.assertIsNot(fetcher.memory_cache, AudioFetcher(22050).memory_cache)
+    
+    def test_lmdb_cache_persists_samples_across_instances(self):
+        samples = np.random.uniform(-1, 1, 1000)
+        
+        with TemporaryDirectory() as path:
+            cache = LmdbAudioCache(path, map_size=2**24)
+            cache.put_samples('https://example.com/sound', 22050, samples)
+            cache.close()
+            
+            cache = LmdbAudioCache(path, map_size=2**24)
+            restored = cache.get_samples('https://example.com/sound', 22050)
+            np.testing.assert_array_equal(samples, restored)
+            self.assertIsNone(cache.get_samples('https://example.com/sound', 44100))
+            del restored
+            cache.close()
+    
+    def test_lmdb_cache_returns_read_only_views(self):
+        samples = np.random.uniform(-1, 1, 1000)
+        
+        with TemporaryDirectory() as path:
+            cache = LmdbAudioCache(path, map_size=2**24)
+            cache.put_samples('https://example.com/sound', 22050, samples)
+            restored = cache.get_samples('https://example.com/sound', 22050)
+            
+            self.assertFalse(restored.flags.owndata)
+            self.assertFalse(restored.flags.writeable)
+            
+            # views remain valid after subsequent writes
+            cache.put_samples('https://example.com/other', 22050, samples * 2)
+            np.testing.assert_array_equal(samples, restored)
+            del restored
+            cache.close()
+    
+    def test_lmdb_cache_does_not_exhaust_readers_when_views_are_held(self):
+        with TemporaryDirectory() as path:
+            cache = LmdbAudioCache(path, map_size=2**24, max_readers=16)
+            
+            # alternating writes and reads, with every view kept alive, as
+            # the memory cache does for fetched audio
+            views = []
+            for i in range(64):
+                cache.put_samples(f'https://example.com/{i}', 22050, np.full(100, i))
+                views.append(cache.get_samples(f'https://example.com/{i}', 22050))
+            
+            for i, view in enumerate(views):
+                np.testing.assert_array_equal(np.full(100, i), view)
+                self.assertFalse(view.flags.writeable)
+            
+            self.assertLessEqual(len(cache._pinned), 8)
+            del views, view
+            cache.close()
+    
+    def test_lmdb_cache_cannot_be_closed_while_views_are_held(self):
+        with TemporaryDirectory() as path:
+            cache = LmdbAudioCache(path, map_size=2**24)
+            cache.put_samples('https://example.com/sound', 22050, np.zeros(100))
+            view = cache.get_samples('https://example.com/sound', 22050)
+            
+            self.assertRaises(RuntimeError, cache.close)
+            np.testing.assert_array_equal(np.zeros(100), view)
+            
+            del view
+            cache.close()
+    
+    def test_fetcher_decodes_and_stores_raw_bytes_from_disk_cache(self):
+        url = 'https://example.com/sound'
+        samples = np.random.uniform(-1, 1, 22050)
+        
+        with TemporaryDirectory() as path:
+            cache = LmdbAudioCache(path, map_size=2**24)
+            cache.put_raw(url, audio_bytes(samples, 22050))
+            
+            fetcher = AudioFetcher(
+                22050, memory_cache=MemoryCache(2**24), disk_cache=cache)
+            fetched = fetcher.fetch(url)
+            
+            self.assertEqual(samples.shape, fetched.shape)
+            np.testing.assert_allclose(samples, fetched, atol=1e-3)
+            self.assertIsNotNone(cache.get_samples(url, 22050))
+            del fetched
+            del fetcher
+            cache.close()
+    
+    def test_prefetch_fetches_each_unique_url_once(self):
+        fetcher = RecordingAudioFetcher()
+        urls = ['https://example.com/a', 'https://example.com/b', 'https://example.com/a']
+        results = fetcher.prefetch(urls)
+        
+        self.assertEqual(2, len(results))
+        self.assertEqual(
+            ['https://example.com/a', 'https://example.com/b'], 
+            sorted(fetcher.fetched))
+    
+    def test_prefetch_for_sampler_includes_impulse_response(self):
+        fetcher = RecordingAudioFetcher()
+        params = SamplerParameters(
+            url='https://example.com/sound',
+            reverb=ReverbParameters(url='https://example.com/ir', mix=0.5))
+        fetcher.prefetch_for(params)
+        self.assertEqual(
+            ['https://example.com/ir', 'https://example.com/sound'], 
+            sorted(fetcher.fetched))
+    
+    def test_source_material_from_sequencer_includes_convolution_url(self):
+        sampler_params = SamplerParameters(
+            url='https://example.com/sound',
+            reverb=ReverbParameters(url='https://example.com/ir', mix=0.5))
+        event = Event(gain=1, time=1, synth=1, params=sampler_params)
+        sequencer_params = SequencerParams(events=[event], speed=1, normalize=True)
+        sm = sequencer_params.source_material
+        self.assertEqual(2, len(sm))
+        self.assertTrue(SourceMaterial('https://example.com/ir') in sm)
+    
+    def test_sequencer_prefetches_source_material_before_rendering(self):
+        fetcher = RecordingAudioFetcher()
+        sampler = Sampler(fetcher)
+        events = [
+            Event(
+                gain=1, 
+                time=i, 
+                synth=sampler, 
+                params=SamplerParameters(url=f'https://example.com/sound{i}'))
+            for i in range(4)
+        ]
+        sequencer = Sequencer(22050)
+        sequencer.render(SequencerParams(events=events, speed=1, normalize=True))
+        
+        self.assertEqual(
+            sorted(f'https://example.com/sound{i}' for i in range(4)), 
+            sorted(fetcher.prefetched))
+    
+    def test_scheduled_render_is_identical_to_serial_render(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher)
+        serial = Sequencer(22050, render_cache=MemoryCache(0))
+        expected = serial.render(nested_pattern(sampler, serial))
+        
+        with RenderScheduler(max_workers=4) as scheduler:
+            scheduled = Sequencer(22050, scheduler=scheduler, render_cache=MemoryCache(0))
+            result = scheduled.render(nested_pattern(sampler, scheduled))
+        
+        np.testing.assert_array_equal(expected, result)
+    
+    def test_process_scheduled_render_is_identical_to_serial_render(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher)
+        serial = Sequencer(22050, render_cache=MemoryCache(0))
+        expected = serial.render(nested_pattern(sampler, serial))
+        
+        with RenderScheduler(max_workers=2, kind='process') as scheduler:
+            scheduled = Sequencer(22050, scheduler=scheduler, render_cache=MemoryCache(0))
+            result = scheduled.render(nested_pattern(sampler, scheduled))
+        
+        np.testing.assert_array_equal(expected, result)
+    
+    def test_scheduler_renders_each_unique_leaf_once(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        
+        with RenderScheduler(max_workers=2) as scheduler:
+            futures = scheduler.submit_leaves(
+                sequencer, nested_pattern(sampler, sequencer))
+            self.assertEqual(2, len(futures))
+    
+    def test_identical_patterns_have_identical_fingerprints(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050)
+        self.assertEqual(
+            nested_pattern(sampler, sequencer).fingerprint(),
+            nested_pattern(sampler, sequencer).fingerprint())
+    
+    def test_fingerprint_changes_with_event_time_and_gain(self):
+        params = SamplerParameters(url='https://example.com/sound')
+        event = Event(gain=1, time=0, synth=1, params=params)
+        self.assertNotEqual(event.fingerprint(), (event >> 1).fingerprint())
+        self.assertNotEqual(
+            event.fingerprint(), 
+            Event(gain=0.5, time=0, synth=1, params=params).fingerprint())
+    
+    def test_fingerprint_changes_with_nested_params(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050)
+        a = nested_pattern(sampler, sequencer)
+        
+        bar = a.events[0].params
+        first = bar.events[0]
+        changed = replace(
+            bar, 
+            events=[
+                replace(first, params=replace(first.params, start_seconds=0.1)), 
+                *bar.events[1:]])
+        b = replace(
+            a, events=[replace(a.events[0], params=changed), *a.events[1:]])
+        
+        self.assertNotEqual(a.fingerprint(), b.fingerprint())
+    
+    def test_closures_from_one_factory_are_not_served_each_others_renders(self):
+        def constant(value):
+            return lambda params: np.full(100, value)
+        
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2**28))
+        
+        def pattern(synth):
+            return SequencerParams(
+                events=[Event(gain=1, time=0, synth=synth, params=SamplerParameters(url='a'))],
+                speed=1,
+                normalize=False)
+        
+        self.assertIsNone(sequencer.cache_key(pattern(constant(1))))
+        np.testing.assert_array_equal(np.ones(100), sequencer.render(pattern(constant(1))))
+        np.testing.assert_array_equal(np.full(100, 2), sequencer.render(pattern(constant(2))))
+    
+    def test_fingerprint_includes_synth_cache_identity(self):
+        class Configured(object):
+            def __init__(self, value):
+                self.cache_identity = ('configured', value)
+            
+            def __call__(self, params):
+                return np.full(100, self.cache_identity[1])
+        
+        params = SamplerParameters(url='https://example.com/sound')
+        self.assertNotEqual(
+            Event(gain=1, time=0, synth=Configured(1), params=params).fingerprint(),
+            Event(gain=1, time=0, synth=Configured(2), params=params).fingerprint())
+    
+    def test_repeated_sub_pattern_is_mixed_once(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        cache = MemoryCache(2**28)
+        sequencer = Sequencer(22050, render_cache=cache)
+        
+        params = nested_pattern(sampler, sequencer)
+        sequencer.render(params)
+        
+        # one top-level pattern and one unique sub-pattern, shared by every
+        # event that plays it
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, len(params.table.voices))
+    
+    def test_unchanged_pattern_is_served_from_render_cache(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2**28))
+        a = sequencer.render(nested_pattern(sampler, sequencer))
+        b = sequencer.render(nested_pattern(sampler, sequencer))
+        self.assertIs(a, b)
+        self.assertFalse(a.flags.writeable)
+    
+    def test_renders_that_are_not_cached_are_writeable(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        samples = sequencer.render(nested_pattern(sampler, sequencer))
+        self.assertTrue(samples.flags.writeable)
+    
+    def test_streamed_blocks_are_identical_to_render(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = nested_pattern(sampler, sequencer)
+        
+        expected = sequencer.render(params)
+        blocks = list(sequencer.render_stream(params, block_size=1000))
+        
+        self.assertTrue(all(len(b) == 1000 for b in blocks[:-1]))
+        np.testing.assert_array_equal(expected, np.concatenate(blocks))
+    
+    def test_streamed_blocks_are_identical_to_unnormalized_render(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = replace(nested_pattern(sampler, sequencer), normalize=False)
+        
+        expected = sequencer.render(params)
+        streamed = np.concatenate(list(sequencer.render_stream(params, block_size=4096)))
+        np.testing.assert_array_equal(expected, streamed)
+    
+    def test_stream_renders_events_only_when_reached(self):
+        rendered = []
+        
+        def synth(params):
+            rendered.append(params.url)
+            return np.ones(100)
+        
+        events = [
+            Event(gain=1, time=t, synth=synth, params=SamplerParameters(url=f'https://example.com/{t}'))
+            for t in range(10)
+        ]
+        sequencer = Sequencer(22050)
+        stream = sequencer.render_stream(
+            SequencerParams(events=events, speed=1, normalize=False), block_size=22050)
+        
+        next(stream)
+        self.assertEqual(['https://example.com/0'], rendered)
+        next(stream)
+        self.assertEqual(['https://example.com/0', 'https://example.com/1'], rendered)
+    
+    def test_stream_raises_for_empty_pattern(self):
+        sequencer = Sequencer(22050)
+        stream = sequencer.render_stream(SequencerParams(events=[], speed=1, normalize=True))
+        self.assertRaises(ValueError, lambda: next(stream))
+    
+    def test_can_encode_blocks_as_memoryview(self):
+        blocks = [np.random.uniform(-1, 1, 1024) for _ in range(8)]
+        encoded = encode_sample_blocks(blocks, samplerate=22050, format='FLAC', subtype='PCM_16')
+        self.assertIsInstance(encoded, memoryview)
+        
+        with SoundFile(BytesIO(encoded), mode='r') as sf:
+            self.assertEqual(1024 * 8, len(sf.read()))
+    
+    def test_blocks_are_written_as_they_arrive(self):
+        flo = BytesIO()
+        written_before_second_block = []
+        
+        def blocks():
+            yield np.random.uniform(-1, 1, 1024)
+            written_before_second_block.append(flo.tell())
+            yield np.random.uniform(-1, 1, 1024)
+        
+        write_sample_blocks(flo, blocks(), samplerate=22050)
+        self.assertGreater(written_before_second_block[0], 1024 * 2)
+    
+    def test_sequencer_write_matches_render(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = nested_pattern(sampler, sequencer)
+        
+        expected = sequencer.render(params)
+        flo = sequencer.write(params, BytesIO(), format='WAV', subtype='FLOAT')
+        
+        with SoundFile(flo, mode='r') as sf:
+            np.testing.assert_array_equal(expected, sf.read(dtype='float32'))
+
+    def test_sequencer_write_mixes_once_when_render_fits_in_cache(self):
+        rendered = []
+        
+        class Tone(object):
+            cache_identity = 'tone'
+            
+            def max_render_length(self, params):
+                return 22050
+            
+            def __call__(self, params):
+                rendered.append(params.url)
+                return np.ones(22050)
+        
+        tone = Tone()
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2 ** 28))
+        params = SequencerParams(
+            events=[
+                Event(gain=1, time=t, synth=tone, params=SamplerParameters(url=f'bar-{t}'))
+                for t in range(10)],
+            speed=1)
+        
+        flo = sequencer.write(params, BytesIO(), format='WAV', subtype='FLOAT')
+        
+        self.assertEqual(10, len(rendered))
+        with SoundFile(flo, mode='r') as sf:
+            np.testing.assert_array_equal(sequencer.render(params), sf.read(dtype='float32'))
+        self.assertEqual(10, len(rendered))
+    
+    def test_stream_streams_nested_patterns_placed_once(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        whole = []
+        
+        class Recording(Sequencer):
+            def render(self, params, *args, **kwargs):
+                whole.append(params)
+                return super().render(params, *args, **kwargs)
+        
+        sequencer = Recording(22050, render_cache=MemoryCache(0), mixing='direct')
+        sections = [
+            SequencerParams(
+                events=[
+                    Event(
+                        gain=1,
+                        time=t * 0.5,
+                        synth=sampler,
+                        params=SamplerParameters(url=f'https://example.com/{s}', duration_seconds=0.5))
+                    for t in range(8)],
+                speed=1)
+            for s in range(3)
+        ]
+        params = SequencerParams(
+            events=[section.once(sequencer) >> (i * 4) for i, section in enumerate(sections)],
+            speed=1)
+        
+        streamed = np.concatenate(list(sequencer.render_stream(params, block_size=1000)))
+        self.assertEqual([], whole)
+        np.testing.assert_allclose(sequencer.render(params), streamed, atol=1e-6)
+    
+    def test_fft_convolve_is_linear_convolution(self):
+        a = np.random.uniform(-1, 1, 1000)
+        b = np.random.uniform(-1, 1, 333)
+        np.testing.assert_allclose(np.convolve(a, b), fft_convolve(a, b), atol=1e-9)
+    
+    def test_trim_tail_drops_low_energy_tail(self):
+        ir = np.concatenate([np.ones(100), np.full(1000, 1e-4)])
+        trimmed = trim_tail(ir, 0.01)
+        self.assertEqual(100, len(trimmed))
+        self.assertEqual(len(ir), len(trim_tail(ir, 0)))
+    
+    def test_impulse_response_spectrum_is_reused(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher)
+        url = 'https://example.com/spectrum-reuse-ir'
+        
+        for start in [0, 0.1]:
+            sampler.render(SamplerParameters(
+                url='https://example.com/sound',
+                start_seconds=start,
+                duration_seconds=0.5,
+                reverb=ReverbParameters(url=url, mix=0.5, trim_threshold=0.01)))
+        
+        spectra = [
+            k for k in impulse_response_cache._items 
+            if k[0] == url and len(k) == 4]
+        self.assertEqual(1, len(spectra))
+    
+    def test_reverb_trim_threshold_round_trips(self):
+        params = ReverbParameters(url='https://example.com/ir', mix=0.5, trim_threshold=0.001)
+        restored = ReverbParameters.from_dict(json.loads(json.dumps(params.to_dict())))
+        self.assertEqual(params, restored)
+        self.assertNotEqual(params, ReverbParameters(url='https://example.com/ir', mix=0.5))
+    
+    def test_partitioned_convolution_of_irregular_blocks_is_linear_convolution(self):
+        signal = np.random.uniform(-1, 1, 10000)
+        ir = np.random.uniform(-1, 1, 3000)
+        convolver = PartitionedConvolver.from_impulse_response(ir, block_size=512)
+        
+        blocks = np.split(signal, [100, 1500, 1501, 7000])
+        output = list(convolver.convolve_blocks(blocks))
+        
+        self.assertTrue(all(len(b) == 512 for b in output[:-1]))
+        np.testing.assert_allclose(
+            np.convolve(signal, ir), np.concatenate(output), atol=1e-9)
+    
+    def test_partitioned_convolver_memory_is_independent_of_input_length(self):
+        ir = np.random.uniform(-1, 1, 3000)
+        convolver = PartitionedConvolver.from_impulse_response(ir, block_size=512)
+        before = convolver._delay_line.nbytes + convolver._overlap.nbytes
+        for _ in convolver.convolve_blocks(np.zeros(512) for _ in range(100)):
+            pass
+        after = convolver._delay_line.nbytes + convolver._overlap.nbytes
+        self.assertEqual(before, after)
+    
+    def test_long_impulse_response_reverb_matches_single_fft_reverb(self):
+        fetcher = DeterministicAudioFetcher(lambda url: 3)
+        dry = np.random.uniform(-1, 1, 22050)
+        params = ReverbParameters(url='https://example.com/long-ir', mix=0.5)
+        
+        expected = reverb(dry, fetcher(params.url), params.mix)
+        np.testing.assert_allclose(
+            expected, cached_reverb(dry, params, fetcher), atol=1e-9)
+    
+    def _bus_pattern(self, normalize=False):
+        def synth(params):
+            return np.ones(1000) * params.start_seconds
+        
+        events = [
+            Event(
+                gain=1, 
+                time=t * 0.01, 
+                synth=synth, 
+                params=SamplerParameters(url='https://example.com/sound', start_seconds=1 + t)
+            ).send('hall', 0.5)
+            for t in range(4)
+        ]
+        return SequencerParams(
+            events=events, 
+            speed=1, 
+            normalize=normalize, 
+            buses=dict(hall=ReverbParameters(url='https://example.com/hall', mix=0.8)))
+    
+    def test_bus_is_convolved_once_with_summed_sends(self):
+        fetcher = DeterministicAudioFetcher(lambda url: 0.1)
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), fetcher=fetcher)
+        params = self._bus_pattern()
         
+        dry = np.zeros(1000 + int(0.03 * 22050), dtype=np.float32)
+        send = np.zeros(len(dry))
+        for event in params.events:
+            start = int(event.time * 22050)
+            dry[start: start + 1000] += np.ones(1000) * event.params.start_seconds
+            send[start: start + 1000] += np.ones(1000) * event.params.start_seconds * 0.5
         
+        ir = fetcher('https://example.com/hall')
+        wet = np.convolve(send, ir) * (0.8 / np.linalg.norm(ir))
+        expected = np.pad(dry, [(0, len(wet) - len(dry))]) + wet
+        
+        np.testing.assert_allclose(expected, sequencer.render(params), rtol=1e-5, atol=1e-4)
+    
+    def test_streamed_bus_matches_render(self):
+        fetcher = DeterministicAudioFetcher(lambda url: 0.1)
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), fetcher=fetcher)
+        params = self._bus_pattern(normalize=True)
+        
+        expected = sequencer.render(params)
+        streamed = np.concatenate(list(sequencer.render_stream(params, block_size=512)))
+        
+        self.assertEqual(expected.shape, streamed.shape)
+        np.testing.assert_allclose(expected, streamed, atol=1e-5)
+    
+    def test_buses_and_sends_round_trip(self):
+        params = self._bus_pattern()
+        params = replace(params, events=[replace(e, synth=1) for e in params.events])
+        
+        d = json.loads(json.dumps(params.to_dict()))
+        fetcher = AudioFetcher(22050)
+        restored = SequencerParams.from_dict(
+            d, restore_params_from_dict, lambda id: get_synth(fetcher, id))
+        
+        self.assertEqual(params.buses, restored.buses)
+        self.assertEqual(params.events[0].sends, restored.events[0].sends)
+    
+    def test_sending_to_undeclared_bus_raises(self):
+        sequencer = Sequencer(22050, fetcher=DeterministicAudioFetcher(one_second))
+        params = replace(self._bus_pattern(), buses={})
+        self.assertRaises(ValueError, lambda: sequencer.render(params))
+    
+    def test_sequencer_without_fetcher_cannot_render_buses(self):
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        self.assertRaises(ValueError, lambda: sequencer.render(self._bus_pattern()))
+    
+    def _stretched(self, gain: float) -> SamplerParameters:
+        return SamplerParameters(
+            url='https://example.com/stretched',
+            duration_seconds=0.5,
+            time_stretch=1.5,
+            filter=FilterParameters(center_frequency=0.1, bandwidth=0.1),
+            gain=GainParameters(
+                interpolation='linear', 
+                keypoints=[
+                    GainKeyPoint(time_seconds=0, gain_value=0), 
+                    GainKeyPoint(time_seconds=1, gain_value=gain)]))
+    
+    def test_changing_late_stage_only_recomputes_later_stages(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second), stage_cache=StageCache(2**26))
+        sampler.render(self._stretched(gain=1))
+        sampler.render(self._stretched(gain=2))
+        
+        stats = sampler.stage_stats
+        self.assertEqual(1, stats['stretch'].misses)
+        self.assertEqual(1, stats['filter'].misses)
+        self.assertEqual(1, stats['filter'].hits)
+        self.assertEqual(0, stats['stretch'].hits)
+        self.assertEqual(2, stats['gain'].misses)
+    
+    def test_unchanged_params_hit_final_stage(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second), stage_cache=StageCache(2**26))
+        a = sampler.render(self._stretched(gain=1))
+        b = sampler.render(self._stretched(gain=1))
+        self.assertIs(a, b)
+        self.assertEqual(1, sampler.stage_stats['gain'].hits)
+        self.assertEqual(0.5, sampler.stage_stats['gain'].hit_rate)
+    
+    def test_cached_stage_output_is_read_only(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second), stage_cache=StageCache(2**26))
+        rendered = sampler.render(self._stretched(gain=1))
+        expected = rendered.copy()
+        
+        def modify():
+            rendered[:] = 0
+        
+        self.assertRaises(ValueError, modify)
+        np.testing.assert_array_equal(expected, sampler.render(self._stretched(gain=1)))
+    
+    def test_cached_stages_produce_identical_output(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher, stage_cache=StageCache(2**26))
+        sampler.render(self._stretched(gain=1))
+        cached = sampler.render(self._stretched(gain=2))
+        
+        uncached = Sampler(fetcher, stage_cache=StageCache(0)).render(self._stretched(gain=2))
+        np.testing.assert_array_equal(uncached, cached)
+    
+    def test_wsola_time_stretch_has_same_length_as_phase_vocoder(self):
+        samples = np.random.uniform(-1, 1, 22050)
+        for rate in [0.5, 0.8, 1.25, 2]:
+            stretched = wsola_time_stretch(samples, rate)
+            self.assertEqual(int(round(len(samples) / rate)), len(stretched))
+    
+    def test_resample_pitch_shift_preserves_length_and_shifts_frequency(self):
+        t = np.arange(22050) / 22050
+        samples = np.sin(2 * np.pi * 440 * t)
+        shifted = resample_pitch_shift(samples, n_steps=12)
+        
+        self.assertEqual(len(samples), len(shifted))
+        spectrum = np.abs(np.fft.rfft(shifted))
+        peak_hz = np.argmax(spectrum) * 22050 / len(shifted)
+        self.assertAlmostEqual(880, peak_hz, delta=5)
+    
+    def test_sampler_rejects_unknown_quality(self):
+        self.assertRaises(
+            ValueError, 
+            lambda: Sampler(DeterministicAudioFetcher(one_second), quality='ultra'))
+    
+    def test_quality_tiers_are_cached_separately(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        cache = StageCache(2**26)
+        params = SamplerParameters(url='https://example.com/tiers', pitch_shift=3)
+        
+        fast = Sampler(fetcher, stage_cache=cache, quality='fast').render(params)
+        standard = Sampler(fetcher, stage_cache=cache, quality='standard').render(params)
+        
+        self.assertEqual(len(fast), len(standard))
+        self.assertEqual(2, cache.stats['pitch'].misses)
+    
+    def test_patterns_of_different_quality_samplers_are_cached_separately(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2**28))
+        params = SamplerParameters(url='https://example.com/tiers', pitch_shift=3)
+        
+        def pattern(quality):
+            sampler = Sampler(fetcher, stage_cache=StageCache(2**26), quality=quality)
+            return SequencerParams(
+                events=[Event(gain=1, time=0, synth=sampler, params=params)], speed=1)
+        
+        self.assertNotEqual(pattern('fast'), pattern('high'))
+        self.assertNotEqual(pattern('fast').fingerprint(), pattern('high').fingerprint())
+        
+        fast = sequencer.render(pattern('fast'))
+        high = sequencer.render(pattern('high'))
+        self.assertIsNot(fast, high)
+        np.testing.assert_allclose(
+            Sequencer(22050, render_cache=MemoryCache(0)).render(pattern('high')), high)
+    
+    def test_sample_bank_contains_every_combination(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        fetcher.memory_cache = MemoryCache(2**26)
+        sampler = Sampler(fetcher, stage_cache=StageCache(2**26), quality='fast')
+        
+        bank = sampler.build_bank(
+            'https://example.com/bank', pitch_shifts=[0, 2, 4], time_stretches=[0, 1.5])
+        
+        self.assertEqual(5, len(bank))
+        self.assertNotIn((0, 0), bank)
+        self.assertEqual(int(round(22050 / 1.5)), len(bank[(1.5, 4)]))
+    
+    def test_bank_lookups_do_not_count_as_fetch_misses(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        fetcher.memory_cache = MemoryCache(2**26)
+        sampler = Sampler(fetcher, stage_cache=StageCache(0), quality='fast')
+        
+        sampler.render(SamplerParameters(url='https://example.com/sound', pitch_shift=2))
+        
+        # probing for a bank entry that was never built isn't a fetch miss
+        self.assertEqual(0, fetcher.cache_stats.misses)
+    
+    def test_sample_bank_workers_are_cancelled_with_the_request(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher, stage_cache=StageCache(2**26), quality='fast')
+        token = CancellationToken()
+        token.cancel()
+        
+        with cancellable(token):
+            self.assertRaises(
+                RenderCancelled, 
+                lambda: sampler.build_bank('https://example.com/bank', pitch_shifts=[2, 4]))
+        
+        self.assertEqual(0, sampler.stage_stats['pitch'].misses)
+    
+    def test_render_uses_sample_bank_entry(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        fetcher.memory_cache = MemoryCache(2**26)
+        sampler = Sampler(fetcher, stage_cache=StageCache(2**26), quality='fast')
+        bank = sampler.build_bank('https://example.com/bank', pitch_shifts=[3])
+        
+        other = Sampler(fetcher, stage_cache=StageCache(2**26), quality='fast')
+        params = SamplerParameters(url='https://example.com/bank', pitch_shift=3)
+        rendered = other.render(params)
+        
+        np.testing.assert_array_equal(bank[(0, 3)], rendered)
+        self.assertEqual(1, other.stage_stats['bank'].hits)
+        self.assertEqual(0, other.stage_stats['pitch'].misses)
+    
+    def test_sample_bank_is_persisted_to_disk_cache(self):
+        with TemporaryDirectory() as path:
+            disk = LmdbAudioCache(path, map_size=2**26)
+            fetcher = DeterministicAudioFetcher(one_second)
+            fetcher.memory_cache = MemoryCache(2**26)
+            fetcher.disk_cache = disk
+            
+            bank = Sampler(fetcher, stage_cache=StageCache(0), quality='fast') \
+                .build_bank('https://example.com/bank', pitch_shifts=[-5])
+            
+            fresh = DeterministicAudioFetcher(one_second)
+            fresh.memory_cache = MemoryCache(2**26)
+            fresh.disk_cache = disk
+            sampler = Sampler(fresh, stage_cache=StageCache(0), quality='fast')
+            rendered = sampler.render(
+                SamplerParameters(url='https://example.com/bank', pitch_shift=-5))
+            
+            np.testing.assert_array_equal(bank[(0, -5)], rendered)
+            self.assertEqual(1, sampler.stage_stats['bank'].hits)
+            del bank, rendered, sampler, fetcher, fresh
+            disk.close()
+    
+    def test_repeat_produces_columnar_table(self):
+        params = SamplerParameters(url='https://example.com/sound')
+        table = repeat(every=0.5, fur=50000, evt=Event(gain=1, time=0, synth=1, params=params))
+        
+        self.assertIsInstance(table, EventTable)
+        self.assertEqual(100000, len(table))
+        self.assertEqual(1, len(table.voices))
+        np.testing.assert_array_equal(np.arange(0, 50000, 0.5), table.times)
+    
+    def test_vectorized_operations_match_event_operations(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        params = nested_pattern(sampler, Sequencer(22050)).events[0].params
+        
+        shifted = (params.time_scale(2) >> 1).events
+        expected = [e.time_scale(2) >> 1 for e in params.events]
+        
+        self.assertEqual([e.time for e in expected], [e.time for e in shifted])
+        self.assertEqual([e.gain for e in expected], [e.gain for e in shifted])
+        self.assertEqual([e.params for e in expected], [e.params for e in shifted])
+    
+    def test_overlaying_patterns_merges_shared_voices(self):
+        hat = SamplerParameters(url='https://example.com/hat')
+        kick = SamplerParameters(url='https://example.com/kick')
+        a = SequencerParams(events=[Event(gain=1, time=0, synth=1, params=hat)], speed=1)
+        b = SequencerParams(
+            events=[
+                Event(gain=1, time=1, synth=1, params=kick), 
+                Event(gain=1, time=2, synth=1, params=hat)], 
+            speed=1)
+        
+        overlaid = a + b
+        self.assertEqual(3, len(overlaid.table))
+        self.assertEqual(2, len(overlaid.table.voices))
+        self.assertEqual([hat, kick, hat], [e.params for e in overlaid.events])
+    
+    def test_repeated_pattern_renders_like_event_list(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        hat = SamplerParameters(url='https://example.com/hat', duration_seconds=0.25)
+        event = Event(gain=2, time=0, synth=sampler, params=hat)
+        
+        columnar = SequencerParams(events=repeat(0.5, 4, event), speed=1)
+        listed = SequencerParams(events=[event >> t for t in np.arange(0, 4, 0.5)], speed=1)
+        
+        np.testing.assert_array_equal(sequencer.render(listed), sequencer.render(columnar))
+        self.assertEqual(listed.fingerprint(), columnar.fingerprint())
+    
+    def test_nested_pattern_round_trips_through_dict(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sequencer = Sequencer(22050, fetcher=fetcher)
+        params = nested_pattern(Sampler(fetcher), sequencer)
+        
+        d = json.loads(json.dumps(params.to_dict()))
+        restored = restore_params_from_dict('sequencer', d, fetcher)
+        
+        self.assertEqual(params.fingerprint(), restored.fingerprint())
+        self.assertIsInstance(restored.events[0].params, SequencerParams)
+        sequencer.validate(restored)
+    
+    def test_legacy_event_list_is_restored(self):
+        fetcher = AudioFetcher(22050)
+        data = dict(
+            speed=1, 
+            normalize=True, 
+            events=[
+                dict(synth=1, time=t, gain=1, params=dict(url='https://example.com/hat')) 
+                for t in range(4)])
+        
+        restored = restore_params_from_dict(2, data, fetcher)
+        self.assertEqual(4, len(restored.table))
+        self.assertEqual(1, len(restored.table.voices))
+    
+    def test_params_and_events_are_immutable(self):
+        params = SamplerParameters(url='https://example.com/sound')
+        event = Event(gain=1, time=0, synth=1, params=params)
+        pattern = SequencerParams(events=[event], speed=1)
+        
+        self.assertRaises(FrozenInstanceError, lambda: setattr(params, 'url', 'x'))
+        self.assertRaises(FrozenInstanceError, lambda: setattr(event, 'time', 1))
+        self.assertRaises(FrozenInstanceError, lambda: setattr(pattern, 'speed', 2))
+        self.assertRaises(ValueError, lambda: pattern.table.times.__setitem__(0, 1))
+    
+    def test_sends_buses_and_voices_are_immutable(self):
+        params = SamplerParameters(url='https://example.com/sound')
+        event = Event(gain=1, time=0, synth=1, params=params).send('room', 0.5)
+        room = ReverbParameters(url='https://example.com/room', mix=0.5)
+        hall = ReverbParameters(url='https://example.com/hall', mix=0.5)
+        pattern = SequencerParams(events=[event], speed=1, buses={'room': room, 'hall': hall})
+        
+        self.assertRaises(TypeError, lambda: event.sends.__setitem__('room', 1))
+        self.assertRaises(TypeError, lambda: pattern.buses.pop('room'))
+        self.assertRaises(TypeError, lambda: pattern.table.sends.clear())
+        self.assertRaises(AttributeError, lambda: pattern.table.voices.append(None))
+        
+        # the order in which buses are declared doesn't matter
+        reordered = SequencerParams(events=[event], speed=1, buses={'hall': hall, 'room': room})
+        self.assertEqual(pattern, reordered)
+        self.assertEqual(hash(pattern), hash(reordered))
+        self.assertEqual(pattern.fingerprint(), reordered.fingerprint())
+        
+        restored = pickle.loads(pickle.dumps(pattern))
+        self.assertEqual(pattern, restored)
+        self.assertRaises(TypeError, lambda: restored.buses.__setitem__('room', hall))
+    
+    def test_events_accept_params_that_cannot_be_hashed(self):
+        
+        @dataclass
+        class Tone(object):
+            frequency: float
+            
+            def to_dict(self) -> dict:
+                return dict(frequency=self.frequency)
+        
+        def synth(params: Tone) -> np.ndarray:
+            return np.sin(np.linspace(0, params.frequency, 100))
+        
+        params = Tone(frequency=440)
+        event = Event(gain=1, time=0, synth=synth, params=params)
+        
+        self.assertEqual(event, event >> 1)
+        self.assertRaises(TypeError, lambda: hash(event))
+        
+        pattern = SequencerParams(events=[event, event >> 1], speed=1, normalize=False)
+        self.assertEqual(1, len(pattern.table.voices))
+        
+        samples = Sequencer(100, render_cache=MemoryCache(0)).render(pattern)
+        self.assertEqual(200, len(samples))
+    
+    def test_transforms_share_unchanged_params(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        params = nested_pattern(sampler, Sequencer(22050))
+        
+        shifted = (params >> 1).time_scale(2)
+        
+        self.assertIs(params.table.voices[0].params, shifted.table.voices[0].params)
+        self.assertIs(params.events[0].params, (params.events[0] >> 1).params)
+        self.assertIs(params, params.once(Sequencer(22050)).params)
+    
+    def test_hash_is_consistent_after_pickling(self):
+        params = SamplerParameters(
+            url='https://example.com/sound',
+            gain=GainParameters(
+                interpolation='linear', 
+                keypoints=[GainKeyPoint(time_seconds=0, gain_value=1)]))
+        restored = pickle.loads(pickle.dumps(params))
+        
+        self.assertEqual(params, restored)
+        self.assertEqual(hash(params), hash(restored))
+        self.assertIsInstance(restored.gain.keypoints, tuple)
+    
+    def _grain_cloud(self, sampler: Sampler, sends: bool = False) -> SequencerParams:
+        rng = np.random.default_rng(0)
+        grain = SamplerParameters(url='https://example.com/grain', duration_seconds=0.5)
+        events = [
+            Event(gain=g, time=t, synth=sampler, params=grain, sends={'hall': 0.5} if sends else {}) 
+            for t, g in zip(rng.uniform(0, 2, 400), rng.uniform(0.5, 1, 400))]
+        hat = SamplerParameters(url='https://example.com/hat', duration_seconds=0.25)
+        events.append(Event(gain=1, time=1, synth=sampler, params=hat))
+        
+        return SequencerParams(
+            events=events, 
+            speed=1, 
+            normalize=False,
+            buses={'hall': ReverbParameters(url='https://example.com/hall', mix=0.5)} if sends else {})
+    
+    def test_impulse_train_mixing_matches_direct_mixing(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        params = self._grain_cloud(Sampler(fetcher), sends=True)
+        
+        direct = Sequencer(22050, render_cache=MemoryCache(0), fetcher=fetcher, mixing='direct')
+        impulse = Sequencer(22050, render_cache=MemoryCache(0), fetcher=fetcher, mixing='impulse')
+        
+        np.testing.assert_allclose(direct.render(params), impulse.render(params), atol=1e-4)
+    
+    def test_auto_mixing_convolves_only_dense_groups(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = self._grain_cloud(sampler)
+        
+        renders = [synth(p) for synth, p in params.table.voices]
+        
+        self.assertEqual(
+            [0], sequencer._impulse_train_voices(sequencer._events(params), renders))
+        
+        # a bar of sparse hats and kicks is cheaper to mix directly
+        bar = nested_pattern(sampler, sequencer).events[0].params
+        renders = [synth(p) for synth, p in bar.table.voices]
+        self.assertEqual(
+            [], sequencer._impulse_train_voices(sequencer._events(bar), renders))
+    
+    def test_sequencer_rejects_unknown_mixing_mode(self):
+        self.assertRaises(ValueError, lambda: Sequencer(22050, mixing='fastest'))
+    
+    def test_loop_renders_like_expanded_repetitions(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), mixing='direct')
+        bar = nested_pattern(sampler, sequencer).events[0].params
+        
+        looped = sequencer.render(Loop(pattern=bar, period=4, count=4))
+        expanded = sequencer.render(SequencerParams(
+            events=[bar.once(sequencer) >> t for t in range(0, 16, 4)], 
+            speed=1, 
+            normalize=False))
+        
+        np.testing.assert_array_equal(expanded, looped)
+    
+    def test_loop_period_is_measured_at_its_patterns_speed(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), mixing='direct')
+        bar = replace(nested_pattern(sampler, sequencer).events[0].params, speed=2)
+        
+        looped = sequencer.render(Loop(pattern=bar, period=4, count=4))
+        repeated = sequencer.render(bar.repeat(4, 16))
+        np.testing.assert_allclose(repeated, looped, atol=1e-5)
+        
+        # repetitions placed in an enclosing pattern follow its speed instead
+        enclosing = SequencerParams(
+            events=[bar.once(sequencer) >> t for t in range(0, 16, 4)], 
+            speed=1, 
+            normalize=False)
+        self.assertEqual(len(sequencer.render(enclosing)) - 6 * 22050, len(looped))
+    
+    def test_loop_renders_its_pattern_once(self):
+        calls = []
+        
+        def synth(params):
+            calls.append(params)
+            return np.ones(22050 * 3)
+        
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2**28))
+        pattern = SequencerParams(
+            events=[Event(gain=1, time=0, synth=synth, params=SamplerParameters(url='drone'))],
+            speed=1, 
+            normalize=False)
+        
+        rendered = sequencer.render(Loop(pattern=pattern, period=2, duration=1000))
+        
+        self.assertEqual(1, len(calls))
+        self.assertEqual(499 * 44100 + 22050 * 3, len(rendered))
+        # the tail of each repetition overlaps the start of the next
+        self.assertEqual(2, rendered[44100 + 100])
+    
+    def test_streamed_loop_matches_render(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), mixing='direct')
+        loop = Loop(pattern=nested_pattern(sampler, sequencer).events[0].params, period=3, count=5)
+        
+        expected = sequencer.render(loop)
+        streamed = np.concatenate(list(sequencer.render_stream(loop, block_size=1000)))
+        np.testing.assert_array_equal(expected, streamed)
+    
+    def test_loop_round_trips_compactly(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sequencer = Sequencer(22050, fetcher=fetcher)
+        bar = nested_pattern(Sampler(fetcher), sequencer).events[0].params
+        params = SequencerParams(
+            events=[bar.loop(sequencer, period=4, duration=8 * 60 * 60)], speed=1)
+        
+        d = json.loads(json.dumps(params.to_dict()))
+        restored = restore_params_from_dict('sequencer', d, fetcher)
+        
+        loop = restored.events[0].params
+        self.assertIsInstance(loop, Loop)
+        self.assertEqual(7200, loop.repetitions)
+        self.assertEqual(params.fingerprint(), restored.fingerprint())
+        self.assertLess(len(json.dumps(d)), 2 * len(json.dumps(bar.to_dict())))
+    
+    def test_loop_requires_count_or_duration(self):
+        pattern = SequencerParams(events=[], speed=1)
+        self.assertRaises(ValueError, lambda: Loop(pattern=pattern, period=1))
+        self.assertRaises(ValueError, lambda: Loop(pattern=pattern, period=1, count=2, duration=2))
+        self.assertRaises(ValueError, lambda: Loop(pattern=pattern, period=0, count=2))
+    
+    def test_flattened_render_matches_nested_render(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        nested = Sequencer(22050, render_cache=MemoryCache(0))
+        flat = Sequencer(22050, render_cache=MemoryCache(0), flatten_nested=True)
+        
+        params = nested_pattern(sampler, nested)
+        expected = nested.render(params)
+        rendered = flat.render(params)
+        
+        length = min(len(expected), len(rendered))
+        self.assertLessEqual(abs(len(expected) - len(rendered)), 1)
+        np.testing.assert_allclose(expected[:length], rendered[:length], atol=1e-4)
+    
+    def test_flatten_accumulates_times_and_gains(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050)
+        hat = SamplerParameters(url='https://example.com/hat', duration_seconds=0.25)
+        bar = SequencerParams(
+            events=[Event(gain=0.5, time=t, synth=sampler, params=hat) for t in range(2)],
+            speed=2,
+            normalize=False)
+        params = SequencerParams(
+            events=[replace(bar.once(sequencer), gain=0.5) >> t for t in [1, 3]], 
+            speed=1, 
+            normalize=False)
+        
+        flat = sequencer.flatten(params)
+        
+        self.assertEqual([(sampler, hat)], flat.voices)
+        np.testing.assert_array_equal(
+            [22050, 33075, 66150, 77175], np.sort(flat.starts))
+        np.testing.assert_allclose([0.25] * 4, flat.gains)
+    
+    def test_flatten_keeps_nested_normalization(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050)
+        params = nested_pattern(sampler, sequencer)
+        bar = params.events[0].params
+        
+        flat = sequencer.flatten(params)
+        peak = Sequencer(22050, render_cache=MemoryCache(0)).render(
+            replace(bar, normalize=False)).max()
+        
+        hats = [i for i, (_, p) in enumerate(flat.voices) if p.url.endswith('hat')]
+        np.testing.assert_allclose(
+            0.5 / (peak + 1e-8), flat.gains[flat.voice_index == hats[0]], rtol=1e-5)
+    
+    def test_flatten_leaves_buses_and_loops_intact(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher)
+        sequencer = Sequencer(22050, fetcher=fetcher)
+        bar = nested_pattern(sampler, sequencer).events[0].params
+        wet = replace(bar, buses={'hall': ReverbParameters(url='https://example.com/hall', mix=0.5)})
+        
+        params = SequencerParams(
+            events=[
+                wet.once(sequencer), 
+                bar.loop(sequencer, period=4, count=2) >> 4,
+            ],
+            speed=1)
+        
+        flat = sequencer.flatten(params)
+        self.assertEqual([wet, Loop(pattern=bar, period=4, count=2)], [p for _, p in flat.voices])
+    
+    def test_incremental_render_matches_full_render_after_edits(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), fetcher=fetcher, mixing='direct')
+        renderer = IncrementalRenderer(sequencer)
+        
+        params = self._grain_cloud(Sampler(fetcher), sends=True)
+        events = list(params.events)
+        edits = [
+            params,
+            replace(params, events=[events[0] >> 1, *events[1:]]),
+            replace(params, events=events[:-1]),
+            replace(params, events=[*events, events[-1] >> 3]),
+            replace(params, events=[replace(events[0], gain=0.1), *events[1:]]),
+        ]
+        
+        for edited in edits:
+            np.testing.assert_allclose(
+                sequencer.render(edited), renderer.render(edited), atol=1e-4)
+    
+    def test_incremental_render_is_as_long_as_full_render(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher)
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), fetcher=fetcher, mixing='direct')
+        renderer = IncrementalRenderer(sequencer)
+        
+        # the last event to end sends nothing to the bus
+        params = self._grain_cloud(sampler, sends=True)
+        hat = SamplerParameters(url='https://example.com/hat', duration_seconds=0.25)
+        params = replace(params, events=[*params.events, Event(gain=1, time=3, synth=sampler, params=hat)])
+        
+        with patch('wiggle.incremental.convolve_impulse_response', wraps=convolve_impulse_response) as convolve:
+            incremental = renderer.render(params)
+        
+        full = sequencer.render(params)
+        self.assertEqual(len(full), len(incremental))
+        np.testing.assert_allclose(full, incremental, atol=1e-4)
+        
+        # every event's send is convolved together, once per bus
+        self.assertEqual(1, convolve.call_count)
+    
+    def test_incremental_render_only_applies_changed_events(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        renderer = IncrementalRenderer(sequencer)
+        
+        params = nested_pattern(sampler, sequencer).events[0].params
+        renderer.render(params)
+        self.assertEqual(len(params.events), renderer.edited)
+        
+        events = list(params.events)
+        renderer.render(replace(params, events=[events[0] >> 0.25, *events[1:]]))
+        self.assertEqual(2, renderer.edited)
+        
+        renderer.render(replace(params, events=[events[0] >> 0.25, *events[1:]]))
+        self.assertEqual(0, renderer.edited)
+    
+    def test_window_matches_slice_of_full_render(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher)
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), fetcher=fetcher, mixing='direct')
+        
+        nested = nested_pattern(sampler, sequencer)
+        patterns = [
+            nested,
+            self._grain_cloud(sampler, sends=True),
+            Loop(pattern=nested.events[0].params, period=3, count=5),
+        ]
+        
+        for params in patterns:
+            full = sequencer.render(params)
+            
+            for start, end in [(0, 0.5), (1.3, 2.9), (2.5, None), (len(full) / 22050 - 0.1, None)]:
+                rendered = sequencer.render(params, start=start, end=end)
+                expected = full[int(start * 22050): None if end is None else int(end * 22050)]
+                np.testing.assert_allclose(expected, rendered, atol=1e-4)
+    
+    def test_window_renders_only_events_within_it(self):
+        rendered = []
+        
+        class Tone(object):
+            def max_render_length(self, params):
+                return 22050
+            
+            def __call__(self, params):
+                rendered.append(params.url)
+                return np.ones(22050)
+        
+        tone = Tone()
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = SequencerParams(
+            events=[
+                Event(gain=1, time=t, synth=tone, params=SamplerParameters(url=f'bar-{t}'))
+                for t in range(1000)],
+            speed=1,
+            normalize=False)
+        
+        window = sequencer.render(params, start=32.5, end=36)
+        
+        self.assertEqual(22050 * 3.5, len(window))
+        self.assertEqual(['bar-32', 'bar-33', 'bar-34', 'bar-35'], rendered)
+        np.testing.assert_array_equal(np.ones(len(window)), window)
+
+    def test_window_fetches_only_events_within_it(self):
+        fetcher = RecordingAudioFetcher()
+        sampler = Sampler(fetcher, stage_cache=StageCache(0))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2 ** 28))
+        params = SequencerParams(
+            events=[
+                Event(
+                    gain=1,
+                    time=t,
+                    synth=sampler,
+                    params=SamplerParameters(url=f'https://example.com/{t}', duration_seconds=0.5))
+                for t in range(200)],
+            speed=1,
+            normalize=False)
+        
+        sequencer.render(params, start=100, end=101)
+        
+        self.assertEqual(['https://example.com/100'], fetcher.fetched)
+    
+    def test_normalized_window_streams_the_whole_pattern_only_once(self):
+        rendered = []
+        
+        class Tone(object):
+            cache_identity = 'tone'
+            
+            def max_render_length(self, params):
+                return 22050
+            
+            def __call__(self, params):
+                rendered.append(params.url)
+                return np.ones(22050)
+        
+        tone = Tone()
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2 ** 28))
+        params = SequencerParams(
+            events=[
+                Event(gain=1, time=t, synth=tone, params=SamplerParameters(url=f'bar-{t}'))
+                for t in range(100)],
+            speed=1)
+        
+        # the first window mixes every event to find the pattern's peak
+        sequencer.render(params, start=10, end=11)
+        self.assertEqual(101, len(rendered))
+        
+        rendered.clear()
+        window = sequencer.render(params, start=50, end=51)
+        self.assertEqual(['bar-50'], rendered)
+        np.testing.assert_allclose(np.ones(22050), window, atol=1e-6)
+    
+    def test_window_includes_events_of_unknown_length(self):
+        fetcher = RecordingAudioFetcher(lambda url: 10)
+        sampler = Sampler(fetcher, stage_cache=StageCache(0))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = SequencerParams(
+            events=[
+                Event(gain=1, time=t, synth=sampler, params=SamplerParameters(url=f'https://example.com/{t}'))
+                for t in [0, 20]],
+            speed=1,
+            normalize=False)
+        
+        window = sequencer.render(params, start=5, end=6)
+        
+        self.assertEqual(['https://example.com/0'], fetcher.fetched)
+        self.assertTrue(np.any(window))
+    
+    def test_window_past_the_end_is_silent(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = nested_pattern(sampler, sequencer)
+        
+        window = sequencer.render(params, start=100, end=101)
+        np.testing.assert_array_equal(np.zeros(22050), window)
+        self.assertRaises(ValueError, lambda: sequencer.render(params, start=2, end=1))
+    
+    def test_sparse_render_matches_dense_render(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        sampler = Sampler(fetcher)
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0), fetcher=fetcher)
+        
+        nested = nested_pattern(sampler, sequencer)
+        patterns = [
+            nested,
+            self._grain_cloud(sampler, sends=True),
+            Loop(pattern=nested.events[0].params, period=3, count=5),
+        ]
+        
+        for params in patterns:
+            expected = sequencer.render(params)
+            canvas = sequencer.render_sparse(params, block_size=1000)
+            self.assertEqual(len(expected), len(canvas))
+            np.testing.assert_allclose(expected, canvas.to_array(), atol=1e-4)
+    
+    def test_sparse_render_only_allocates_touched_blocks(self):
+        sampler = Sampler(DeterministicAudioFetcher(one_second))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        hit = SamplerParameters(url='https://example.com/hit', duration_seconds=0.5)
+        params = SequencerParams(
+            events=[Event(gain=1, time=t, synth=sampler, params=hit) for t in [0, 1800, 3599]],
+            speed=1)
+        
+        canvas = sequencer.render_sparse(params, block_size=22050)
+        
+        self.assertEqual(3599 * 22050 + 11025, len(canvas))
+        self.assertEqual(3, len(canvas.blocks))
+        self.assertAlmostEqual(1, canvas.peak(), places=5)
+        
+        blocks = list(canvas.iter_blocks())
+        self.assertEqual(3600, len(blocks))
+        np.testing.assert_array_equal(np.zeros(22050), blocks[1])
+    
+    def test_sparse_canvas_tracks_peak_per_block(self):
+        canvas = BlockSparseCanvas(block_size=4)
+        canvas.add(2, np.array([1, 2, 3]))
+        canvas.add(20, np.array([-1]))
+        
+        self.assertEqual(3, canvas.peak())
+        self.assertEqual([(0, 8), (20, 1)], [(start, len(run)) for start, run in canvas.runs()])
+        
+        canvas.add(5, np.array([5]), gain=2)
+        self.assertEqual(10, canvas.peak())
+        
+        canvas.normalize()
+        np.testing.assert_allclose(
+            np.array([0, 0, 0.1, 0.2, 0.3, 1, 0, 0, *[0] * 12, -0.1]), canvas.to_array(), atol=1e-6)
+    
+    def test_plan_estimates_without_rendering(self):
+        fetcher = RecordingAudioFetcher()
+        sampler = Sampler(fetcher, stage_cache=StageCache(2 ** 28))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2 ** 28), fetcher=fetcher)
+        params = nested_pattern(sampler, sequencer)
+        
+        plan = sequencer.plan(params)
+        
+        self.assertEqual([], fetcher.fetched)
+        self.assertEqual(0, sampler.stage_stats['slice'].misses)
+        
+        self.assertEqual(4 + 12, plan.events)
+        self.assertEqual(1, plan.depth)
+        self.assertEqual(2, plan.leaf_renders)
+        self.assertEqual(0, plan.cached_renders)
+        self.assertEqual(0, plan.unknown_lengths)
+        self.assertEqual(
+            set(['https://example.com/hat', 'https://example.com/kick']), plan.urls)
+        
+        rendered = sequencer.render(params)
+        self.assertGreaterEqual(plan.duration_seconds * 22050, len(rendered))
+        self.assertLess(plan.duration_seconds - (len(rendered) / 22050), 0.01)
+        self.assertGreater(plan.peak_bytes, rendered.nbytes)
+        self.assertGreater(plan.cost, 0)
+        
+        replanned = sequencer.plan(params)
+        self.assertEqual(2, replanned.cached_renders)
+        self.assertEqual(0, replanned.cost)
+    
+    def test_plan_reports_unknown_lengths(self):
+        sampler = Sampler(FakeAudioFetcher())
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = SequencerParams(
+            events=[Event(gain=1, time=0, synth=sampler, params=SamplerParameters(url='https://example.com/loop'))],
+            speed=1)
+        
+        plan = sequencer.plan(params)
+        self.assertIsNone(plan.duration_seconds)
+        self.assertEqual(1, plan.unknown_lengths)
+        self.assertEqual(set(['https://example.com/loop']), plan.uncached_urls)
+    
+    def test_wiggle_rejects_requests_over_limits_before_rendering(self):
+        fetcher = RecordingAudioFetcher()
+        usages = []
+        wiggle = Wiggle(
+            22050, 
+            fetcher, 
+            Permissions(fetch_external=True, limits=ResourceLimits(max_events=10)),
+            report_usage=usages.append)
+        
+        sequencer = wiggle.get_synth(SynthType.Sequencer)
+        params = nested_pattern(Sampler(fetcher), sequencer)
+        
+        with self.assertRaises(ResourceLimitExceeded) as context:
+            wiggle.render(SynthType.Sequencer, params)
+        
+        self.assertEqual('events', context.exception.resource)
+        self.assertEqual([], fetcher.fetched)
+        self.assertEqual('events', usages[0].exceeded)
+    
+    def test_wiggle_reports_usage(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        usages = []
+        wiggle = Wiggle(
+            22050, 
+            fetcher, 
+            Permissions(fetch_external=True, limits=ResourceLimits(max_duration_seconds=60, max_depth=1)),
+            report_usage=usages.append)
+        
+        params = nested_pattern(Sampler(fetcher), wiggle.get_synth(SynthType.Sequencer))
+        samples = wiggle.render(SynthType.Sequencer, params)
+        
+        usage, = usages
+        self.assertIsNone(usage.exceeded)
+        self.assertEqual(16, usage.events)
+        self.assertEqual(1, usage.depth)
+        self.assertEqual(len(samples) / 22050, usage.duration_seconds)
+        self.assertGreater(usage.wall_seconds, 0)
+    
+    def test_governor_stops_rendering_partway(self):
+        rendered = []
+        
+        def slow(params):
+            rendered.append(params)
+            time.sleep(0.01)
+            return np.ones(100)
+        
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = SequencerParams(
+            events=[
+                Event(gain=1, time=t, synth=slow, params=SamplerParameters(url=f'https://example.com/{t}'))
+                for t in range(100)],
+            speed=1)
+        
+        with self.assertRaises(ResourceLimitExceeded):
+            with ResourceGovernor(ResourceLimits(max_wall_seconds=0.05)):
+                list(sequencer.render_stream(params, block_size=22050))
+        
+        self.assertLess(len(rendered), 100)
+    
+    def test_governor_limits_fetched_bytes_and_urls(self):
+        governor = ResourceGovernor(ResourceLimits(max_fetched_bytes=1000, max_urls=2))
+        governor.record_fetch('https://example.com/a', 600)
+        self.assertRaises(
+            ResourceLimitExceeded, lambda: governor.record_fetch('https://example.com/b', 600))
+        self.assertRaises(
+            ResourceLimitExceeded, lambda: governor.record_fetch('https://example.com/c', 0))
+        self.assertEqual(1200, governor.usage.fetched_bytes)
+    
+    def test_governor_stops_download_that_exceeds_byte_limit(self):
+        session = StreamingSession(chunks=100, chunk_size=1024)
+        
+        with self.assertRaises(ResourceLimitExceeded):
+            with ResourceGovernor(ResourceLimits(max_fetched_bytes=10 * 1024)) as governor:
+                fetch_audio_from_url('https://example.com/large', session=session)
+        
+        self.assertEqual(11, session.read)
+        self.assertEqual('fetched bytes', governor.usage.exceeded)
+    
+    def test_governor_rejects_download_by_content_length(self):
+        session = StreamingSession(chunks=100, chunk_size=1024, content_length=True)
+        
+        with self.assertRaises(ResourceLimitExceeded):
+            with ResourceGovernor(ResourceLimits(max_fetched_bytes=10 * 1024)):
+                fetch_audio_from_url('https://example.com/large', session=session)
+        
+        self.assertEqual(0, session.read)
+        
+        # within budget, the body is read in full
+        with ResourceGovernor(ResourceLimits(max_fetched_bytes=100 * 1024)):
+            content = fetch_audio_from_url('https://example.com/large', session=session)
+        self.assertEqual(100 * 1024, len(content))
+    
+    def test_cancelled_render_stops_promptly(self):
+        token = CancellationToken()
+        rendered = []
+        
+        def slow(params):
+            rendered.append(params)
+            time.sleep(0.01)
+            return np.ones(100)
+        
+        sequencer = Sequencer(22050, render_cache=MemoryCache(0))
+        params = SequencerParams(
+            events=[
+                Event(gain=1, time=t, synth=slow, params=SamplerParameters(url=f'https://example.com/{t}'))
+                for t in range(500)],
+            speed=1)
+        
+        timer = threading.Timer(0.05, token.cancel)
+        timer.start()
+        started = time.perf_counter()
+        
+        self.assertRaises(RenderCancelled, lambda: sequencer.render(params, token=token))
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertLess(len(rendered), 500)
+    
+    def test_cancelled_render_discards_its_cache_entries(self):
+        token = CancellationToken()
+        sampler = Sampler(DeterministicAudioFetcher(one_second), stage_cache=StageCache(2 ** 26))
+        sequencer = Sequencer(22050, render_cache=MemoryCache(2 ** 28))
+        
+        def cancel(params):
+            token.cancel()
+            return np.ones(100)
+        
+        first = nested_pattern(sampler, sequencer).events[0].params
+        second = SequencerParams(
+            events=[Event(gain=1, time=0, synth=cancel, params=SamplerParameters(url='cancel'))], 
+            speed=1)
+        params = SequencerParams(
+            events=[first.once(sequencer), second.once(sequencer) >> 4], 
+            speed=1)
+        
+        self.assertRaises(RenderCancelled, lambda: sequencer.render(params, token=token))
+        self.assertIsNone(sequencer.cached(first))
+        self.assertEqual(0, len(sampler.stage_cache.cache))
+        
+        # the same pattern renders normally without the token
+        sequencer.render(params)
+        self.assertIsNotNone(sequencer.cached(first))
+    
+    def test_wiggle_render_honours_deadline(self):
+        fetcher = DeterministicAudioFetcher(one_second)
+        usages = []
+        wiggle = Wiggle(22050, fetcher, Permissions(fetch_external=True), report_usage=usages.append)
+        params = nested_pattern(Sampler(fetcher), wiggle.get_synth(SynthType.Sequencer))
+        
+        self.assertRaises(
+            RenderCancelled, 
+            lambda: wiggle.render(SynthType.Sequencer, params, token=CancellationToken(timeout=0)))
+        self.assertEqual(1, len(usages))
+    
+    def test_concurrent_identical_async_renders_are_coalesced(self):
+        fetched = []
+        
+        class SlowFetcher(DeterministicAudioFetcher):
+            def __call__(self, url):
+                fetched.append(url)
+                time.sleep(0.05)
+                return super().__call__(url)
+        
+        fetcher = SlowFetcher(one_second)
+        wiggle = Wiggle(22050, fetcher, Permissions(fetch_external=True), report_usage=lambda usage: None)
+        params = SamplerParameters(url='https://example.com/coalesced', pitch_shift=1.5)
+        
+        async def preview():
+            return await asyncio.gather(
+                *[wiggle.render_async(SynthType.Sampler, params) for _ in range(10)])
+        
+        results = asyncio.run(preview())
+        
+        self.assertEqual(['https://example.com/coalesced'], fetched)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertFalse(results[0].flags.writeable)
+        self.assertEqual(0, len(wiggle.flights))
+    
+    def test_concurrent_async_fetches_are_coalesced(self):
+        fetched = []
+        
+        class SlowFetcher(DeterministicAudioFetcher):
+            def fetch(self, url):
+                fetched.append(url)
+                time.sleep(0.05)
+                return super().fetch(url)
+        
+        fetcher = SlowFetcher(one_second)
+        
+        async def fetch():
+            return await fetcher.prefetch_async(
+                ['https://example.com/a', 'https://example.com/b', 'https://example.com/a'])
+        
+        async def fetch_twice():
+            return await asyncio.gather(fetch(), fetch())
+        
+        first, second = asyncio.run(fetch_twice())
+        
+        self.assertEqual(['https://example.com/a', 'https://example.com/b'], sorted(fetched))
+        self.assertIs(first['https://example.com/a'], second['https://example.com/a'])
+    
+    def test_abandoned_flight_is_cancelled(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        
+        def forever():
+            started.set()
+            while True:
+                checkpoint()
+                time.sleep(0.001)
+        
+        async def abandon():
+            waiters = [asyncio.ensure_future(flights.run('key', forever)) for _ in range(3)]
+            await asyncio.get_running_loop().run_in_executor(None, started.wait)
+            
+            waiters[0].cancel()
+            await asyncio.sleep(0.01)
+            self.assertEqual(1, len(flights))
+            
+            for waiter in waiters[1:]:
+                waiter.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+            return len(flights)
         
-        
\ No newline at end of file
+        self.assertEqual(0, asyncio.run(abandon()))
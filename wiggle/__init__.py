@@ -4,11 +4,20 @@ from .sampler import Sampler
 from .sourcematerial import SourceMaterial
 from .sequencer import Sequencer, SequencerParams, Event, FourFourInterval, \
     whole, half, quarter, eighth, sixteenth, thirtysecond, sixtyfourth, triplet, \
-    repeat, measure
+    repeat, measure, EventTable, Loop, RenderPlan
 from .samplerparams import \
     SamplerParameters, ReverbParameters, GainParameters, GainKeyPoint, \
     FilterParameters
 from .fetch import AudioFetcher
+from .scheduler import RenderScheduler
+from .incremental import IncrementalRenderer
+from .cache import MemoryCache, CacheStats, set_default_cache_bytes
+from .cancellation import CancellationToken, RenderCancelled
+from .singleflight import SingleFlight
+from .governor import ResourceGovernor, ResourceLimits, ResourceUsage, ResourceLimitExceeded
+from .canvas import BlockSparseCanvas
+from .lmdbcache import LmdbAudioCache
 from .synths import list_synths, get_synth_by_id, get_synth_by_name, get_synth, \
     render, restore_params_from_dict
-from .basesynth import write_samples, encode_samples
+from .basesynth import write_samples, encode_samples, write_sample_blocks, \
+    encode_sample_blocks
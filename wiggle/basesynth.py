@@ -3,15 +3,45 @@ import numpy as np
 from soundfile import SoundFile
 from io import BytesIO
 from abc import ABC, abstractmethod
-from typing import IO, Any, Protocol, Set
+from functools import lru_cache
+from typing import IO, Any, Iterable, Iterator, Protocol
 import jsonschema
 import jsonschema.exceptions
+import jsonschema.validators
 import os
 import json
 
 from .dictserialiazable import DictSerializable
 
 
+@lru_cache(maxsize=None)
+def load_schema(path: str) -> dict:
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def load_validator(path: str) -> Any:
+    """
+    Check the schema at `path` and build its validator, once, rather than 
+    on every validation
+    """
+    schema = load_schema(path)
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+@lru_cache(maxsize=4096)
+def validate_params(path: str, params: DictSerializable) -> None:
+    """
+    Validate immutable `params` against the schema at `path`, remembering 
+    those already found to be valid, so that repeated renders, e.g. cache 
+    hits, don't pay for validation again
+    """
+    load_validator(path).validate(params.to_dict())
+
+
 class HasId(Protocol):
     @property
     def id(self):
@@ -28,27 +58,69 @@ def infer_channels(arr: np.ndarray):
         return 1
     return arr.shape[1]
 
-def write_samples(
+def write_sample_blocks(
         flo: IO, 
-        samples: np.ndarray, 
+        blocks: Iterable[np.ndarray], 
         samplerate: int, 
         format='WAV', 
         subtype='PCM_16') -> IO:
+    """
+    Encode blocks of samples as they arrive, in any format supported by 
+    libsndfile, so that nothing needs to hold the complete audio
+    """
+    blocks = iter(blocks)
+    first = next(blocks, None)
+    if first is None:
+        raise ValueError('At least one block of samples is required')
     
     with SoundFile(
             flo, 
             'w', 
             samplerate=samplerate, 
-            channels=infer_channels(samples),
+            channels=infer_channels(first),
             format=format,
             subtype=subtype) as sf:
         
-        for chunk in iter_sample_chunks(samples):
-            sf.write(chunk)
+        sf.write(first)
+        for block in blocks:
+            sf.write(block)
     
     return flo
 
 
+def write_samples(
+        flo: IO, 
+        samples: np.ndarray, 
+        samplerate: int, 
+        format='WAV', 
+        subtype='PCM_16') -> IO:
+    
+    return write_sample_blocks(
+        flo, 
+        iter_sample_chunks(samples), 
+        samplerate=samplerate, 
+        format=format, 
+        subtype=subtype)
+
+
+def encode_sample_blocks(
+        blocks: Iterable[np.ndarray], 
+        samplerate: int, 
+        format='WAV', 
+        subtype='PCM_16') -> memoryview:
+    """
+    Encode blocks of samples, returning a view of the encoded bytes 
+    rather than a copy
+    """
+    io = write_sample_blocks(
+        BytesIO(), 
+        blocks, 
+        samplerate=samplerate, 
+        format=format, 
+        subtype=subtype)
+    return io.getbuffer()
+
+
 def encode_samples(
         samples: np.ndarray, 
         samplerate: int, 
@@ -61,8 +133,10 @@ def encode_samples(
         samplerate=samplerate, 
         format=format, 
         subtype=subtype)
-    io.seek(0)
-    return io.read()
+    
+    # unlike seeking and reading, this shares the buffer that was written
+    # to, rather than copying it
+    return io.getvalue()
 
 class BaseSynth(ABC):
     def __init__(self):
@@ -79,17 +153,26 @@ class BaseSynth(ABC):
         pass
     
     @property
-    def schema(self) -> dict:
+    def cache_identity(self) -> Any:
+        """
+        Identifies this synth in cache keys, such that synths sharing an
+        identity render identical audio for identical parameters.  Synths
+        whose output depends on their configuration must include it.
+        """
+        return self.id
+    
+    @property
+    def _schema_path(self) -> str:
         module_dir = os.path.dirname(os.path.abspath(__file__))
-        path = os.path.join(module_dir, f'{self.name}.json')
-        with open(path, 'r') as f:
-            return json.load(f)
+        return os.path.join(module_dir, f'{self.name}.json')
+    
+    @property
+    def schema(self) -> dict:
+        return load_schema(self._schema_path)
     
     def validate(self, params: DictSerializable):
-        params_dict = params.to_dict()
-        
         try:
-            jsonschema.validate(params_dict, self.schema)
+            validate_params(self._schema_path, params)
         except jsonschema.exceptions.ValidationError as e:
             raise ValueError(f'The provided sampler parameters are not valid with error {e}')
         except jsonschema.exceptions.SchemaError as e:
@@ -106,6 +189,14 @@ class BaseSynth(ABC):
     @abstractmethod
     def render(self, params: Any) -> np.ndarray:
         pass
+    
+    def render_blocks(self, params: Any, block_size: int = 2048) -> Iterator[np.ndarray]:
+        """
+        Yield the render in blocks of at most `block_size` samples.  Synths
+        able to produce audio incrementally should override this, so that
+        the first block is available before the whole render is.
+        """
+        yield from iter_sample_chunks(self.render(params), chunksize=block_size)
 
     def play(self, params: Any, wait_for_user_input=True) -> None:
         io = self.write(params, BytesIO())
@@ -119,18 +210,34 @@ class BaseSynth(ABC):
         if wait_for_user_input:
             input('Next')
 
-    def write(self, params: Any, flo: IO) -> IO:
-        samples = self.render(params)
-        with SoundFile(
-                flo, 
-                mode='w',
-                samplerate=self.samplerate,
-                format='wav',
-                subtype='pcm_16',
-                channels=1) as sf:
-
-            for chunk in iter_sample_chunks(samples, chunksize=2048):
-                sf.write(chunk)
+    def write(
+            self, 
+            params: Any, 
+            flo: IO, 
+            format: str = 'WAV', 
+            subtype: str = 'PCM_16',
+            block_size: int = 2048) -> IO:
+        
+        write_sample_blocks(
+            flo, 
+            self.render_blocks(params, block_size), 
+            samplerate=self.samplerate, 
+            format=format, 
+            subtype=subtype)
+        
+        if flo.seekable():
+            flo.seek(0)
+        return flo
+    
+    def encode(
+            self, 
+            params: Any, 
+            format: str = 'WAV', 
+            subtype: str = 'PCM_16', 
+            block_size: int = 2048) -> memoryview:
         
-        flo.seek(0)
-        return flo
\ No newline at end of file
+        return encode_sample_blocks(
+            self.render_blocks(params, block_size), 
+            samplerate=self.samplerate, 
+            format=format, 
+            subtype=subtype)
\ No newline at end of file
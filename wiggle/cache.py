@@ -0,0 +1,226 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import RLock
+from typing import Any, Callable, Dict, Hashable
+import numpy as np
+
+from wiggle.cancellation import track_entry
+
+
+def size_in_bytes(value: Any) -> int:
+    """
+    Best-effort estimate of the memory held by a cached value
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return int(nbytes)
+
+    return 0
+
+
+@dataclass
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    resident_bytes: int
+    max_bytes: int
+    items: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if total == 0:
+            return 0
+        return self.hits / total
+
+
+class MemoryCache(object):
+    """
+    A thread-safe, least-recently-used, in-memory cache whose capacity
+    is expressed in bytes rather than in a number of items, since cached
+    audio can vary in size by several orders of magnitude
+    """
+
+    def __init__(
+            self,
+            max_bytes: int,
+            sizeof: Callable[[Any], int] = size_in_bytes):
+
+        super().__init__()
+
+        if max_bytes < 0:
+            raise ValueError(f'max_bytes must be non-negative but was {max_bytes}')
+
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._items: OrderedDict = OrderedDict()
+        self._sizes = dict()
+        self._lock = RLock()
+        self._resident_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __getstate__(self):
+        # caches are process-local, so a copy sent to another process
+        # starts empty
+        return dict(max_bytes=self.max_bytes, sizeof=self.sizeof)
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'], state['sizeof'])
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._items
+
+    @property
+    def resident_bytes(self) -> int:
+        return self._resident_bytes
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                resident_bytes=self._resident_bytes,
+                max_bytes=self.max_bytes,
+                items=len(self._items))
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self._misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Retrieve an item without affecting recency or statistics
+        """
+        with self._lock:
+            return self._items.get(key, default)
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+
+        with self._lock:
+            self._remove(key)
+
+            # items that could never fit are simply not cached, rather than
+            # flushing everything else out of the cache
+            if size > self.max_bytes:
+                return
+
+            self._items[key] = value
+            self._sizes[key] = size
+            self._resident_bytes += size
+            self._evict()
+
+        # entries added for a request that's later abandoned are removed
+        track_entry(self, key)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is not sentinel:
+            return value
+
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._resident_bytes = 0
+
+    def resize(self, max_bytes: int) -> None:
+        """
+        Change the cache's capacity, evicting the least recently used items
+        that no longer fit
+        """
+        if max_bytes < 0:
+            raise ValueError(f'max_bytes must be non-negative but was {max_bytes}')
+
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    def _remove(self, key: Hashable) -> None:
+        if key not in self._items:
+            return
+
+        del self._items[key]
+        self._resident_bytes -= self._sizes.pop(key)
+
+    def _evict(self) -> None:
+        while self._resident_bytes > self.max_bytes and self._items:
+            key, _ = self._items.popitem(last=False)
+            self._resident_bytes -= self._sizes.pop(key)
+            self._evictions += 1
+
+
+# the combined capacity of the module-level caches shared by every fetcher,
+# sampler and sequencer that isn't given its own, divided between them in
+# these proportions
+default_cache_bytes = 256 * 1024 * 1024
+default_cache_shares: Dict[str, float] = dict(
+    audio=0.4,
+    stages=0.3,
+    renders=0.2,
+    impulse_responses=0.1)
+
+default_caches: Dict[str, MemoryCache] = dict()
+
+
+def default_cache(name: str) -> MemoryCache:
+    """
+    Create the shared, module-level cache `name`, with its share of 
+    `default_cache_bytes`
+    """
+    cache = MemoryCache(max_bytes=int(default_cache_bytes * default_cache_shares[name]))
+    default_caches[name] = cache
+    return cache
+
+
+def set_default_cache_bytes(max_bytes: int) -> None:
+    """
+    Change the combined capacity of the shared, module-level caches,
+    dividing it between them as before, and evicting whatever no longer
+    fits
+    """
+    global default_cache_bytes
+
+    if max_bytes < 0:
+        raise ValueError(f'max_bytes must be non-negative but was {max_bytes}')
+
+    default_cache_bytes = max_bytes
+    for name, cache in default_caches.items():
+        cache.resize(int(max_bytes * default_cache_shares[name]))
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Event, Lock
+from time import perf_counter
+from typing import Any, Hashable, Iterator, List, Optional, Tuple
+
+
+class RenderCancelled(RuntimeError):
+    pass
+
+
+class CancellationToken(object):
+    """
+    Signals that a request's work should stop, either because it was
+    cancelled, e.g. when a client disconnects, or because its deadline,
+    `timeout` seconds after the token was created, has passed.
+
+    Render paths check the current token between events, blocks, pipeline
+    stages and chunks of downloaded audio.  Cache entries added while a
+    token is current are recorded, so that they can be removed if the
+    work is abandoned.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        super().__init__()
+        self.deadline = None if timeout is None else perf_counter() + timeout
+        self._cancelled = Event()
+        self._lock = Lock()
+        self._entries: List[Tuple[Any, Hashable]] = []
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() \
+            or (self.deadline is not None and perf_counter() >= self.deadline)
+
+    def remaining(self) -> Optional[float]:
+        """
+        Seconds until the deadline, or `None` if there is none
+        """
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - perf_counter())
+
+    def raise_if_cancelled(self) -> None:
+        if self._cancelled.is_set():
+            raise RenderCancelled('Render was cancelled')
+        if self.deadline is not None and perf_counter() >= self.deadline:
+            raise RenderCancelled('Render passed its deadline')
+
+    def track(self, cache: Any, key: Hashable) -> None:
+        with self._lock:
+            self._entries.append((cache, key))
+
+    def discard_entries(self) -> None:
+        """
+        Remove every cache entry added on behalf of this token
+        """
+        with self._lock:
+            entries, self._entries = self._entries, []
+
+        for cache, key in entries:
+            cache.discard(key)
+
+
+current_token: ContextVar[Optional[CancellationToken]] = \
+    ContextVar('current_token', default=None)
+
+
+@contextmanager
+def cancellable(token: Optional[CancellationToken]) -> Iterator[Optional[CancellationToken]]:
+    """
+    Make `token` current for the duration of the block, discarding any
+    cache entries added within it if the work is abandoned
+    """
+    if token is None:
+        yield token
+        return
+
+    reset = current_token.set(token)
+    try:
+        yield token
+    except RenderCancelled:
+        token.discard_entries()
+        raise
+    finally:
+        current_token.reset(reset)
+
+
+def raise_if_cancelled() -> None:
+    token = current_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def track_entry(cache: Any, key: Hashable) -> None:
+    token = current_token.get()
+    if token is not None:
+        token.track(cache, key)
+
+
+def remaining() -> Optional[float]:
+    token = current_token.get()
+    return None if token is None else token.remaining()
@@ -0,0 +1,144 @@
+from typing import Dict, Iterator, Tuple, Union
+import numpy as np
+
+
+class BlockSparseCanvas(object):
+    """
+    A canvas divided into fixed-size blocks, only those of which touched by
+    some signal are allocated, so that long, sparse arrangements don't
+    require allocating long stretches of silence.
+
+    The peak of each block is tracked, and normalization only changes a
+    single scale factor, applied as blocks are read, so that neither
+    requires filling in silence.  Silence is only filled in by `iter_blocks`
+    and `to_array`, i.e., once the audio is streamed or encoded.
+    """
+
+    def __init__(self, block_size: int = 2 ** 14):
+        super().__init__()
+
+        if block_size <= 0:
+            raise ValueError(f'block_size must be positive but was {block_size}')
+
+        self.block_size = block_size
+        self.length = 0
+        self.scale = 1.0
+        self.blocks: Dict[int, np.ndarray] = dict()
+        self._peaks: Dict[int, float] = dict()
+
+    @classmethod
+    def from_array(cls, samples: np.ndarray, block_size: int = 2 ** 14) -> 'BlockSparseCanvas':
+        canvas = cls(block_size)
+        for start in range(0, len(samples), block_size):
+            block = samples[start: start + block_size]
+            if np.any(block):
+                canvas.add(start, block)
+        canvas.extend(len(samples))
+        return canvas
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def n_blocks(self) -> int:
+        return -(-self.length // self.block_size)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.nbytes for block in self.blocks.values())
+
+    def extend(self, length: int) -> None:
+        self.length = max(self.length, length)
+
+    def _block(self, index: int) -> np.ndarray:
+        block = self.blocks.get(index)
+        if block is None:
+            block = self.blocks[index] = np.zeros((self.block_size,), dtype=np.float32)
+        return block
+
+    def add(
+            self,
+            start: int,
+            samples: Union[np.ndarray, 'BlockSparseCanvas'],
+            gain: float = 1) -> None:
+        """
+        Add a signal, scaled by `gain`, beginning at `start`
+        """
+        if isinstance(samples, BlockSparseCanvas):
+            for index, block in samples.blocks.items():
+                self.add(
+                    start + index * samples.block_size,
+                    block[:samples.length - index * samples.block_size],
+                    gain * samples.scale)
+            self.extend(start + len(samples))
+            return
+
+        end = start + len(samples)
+        self.extend(end)
+
+        # samples are added unscaled, so must be divided by the current scale
+        # to keep their level relative to what's already on the canvas
+        gain = gain / self.scale
+
+        position = start
+        while position < end:
+            index = position // self.block_size
+            offset = position - (index * self.block_size)
+            n = min(self.block_size - offset, end - position)
+
+            block = self._block(index)
+            block[offset: offset + n] += samples[position - start: position - start + n] * gain
+            self._peaks.pop(index, None)
+            position += n
+
+    def _peak(self, index: int) -> float:
+        peak = self._peaks.get(index)
+        if peak is None:
+            length = min(self.block_size, self.length - index * self.block_size)
+            peak = self._peaks[index] = float(self.blocks[index][:length].max())
+        return peak
+
+    def peak(self) -> float:
+        """
+        The canvas's maximum, including any silence
+        """
+        peaks = [self._peak(index) for index in self.blocks]
+        if len(self.blocks) < self.n_blocks:
+            peaks.append(0)
+        return max(peaks, default=0) * self.scale
+
+    def normalize(self) -> 'BlockSparseCanvas':
+        self.scale = self.scale / (self.peak() + 1e-8)
+        return self
+
+    def runs(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Yield the start and samples of each run of contiguous, allocated
+        blocks
+        """
+        indices = sorted(self.blocks)
+
+        while indices:
+            first = last = indices.pop(0)
+            while indices and indices[0] == last + 1:
+                last = indices.pop(0)
+
+            start = first * self.block_size
+            end = min((last + 1) * self.block_size, self.length)
+            samples = np.concatenate([self.blocks[i] for i in range(first, last + 1)])
+            yield start, samples[:end - start] * self.scale
+
+    def iter_blocks(self) -> Iterator[np.ndarray]:
+        """
+        Yield dense blocks in time order, filling in silence
+        """
+        for index in range(self.n_blocks):
+            length = min(self.block_size, self.length - index * self.block_size)
+            block = self.blocks.get(index)
+            if block is None:
+                yield np.zeros((length,), dtype=np.float32)
+            else:
+                yield block[:length] * np.float32(self.scale)
+
+    def to_array(self) -> np.ndarray:
+        return np.concatenate(list(self.iter_blocks()) or [np.zeros((0,), dtype=np.float32)])
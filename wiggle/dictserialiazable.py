@@ -2,5 +2,7 @@ from typing import Protocol
 
 
 class DictSerializable(Protocol):
+    __slots__ = ()
+    
     def to_dict(self) -> dict:
         raise NotImplementedError('')
\ No newline at end of file
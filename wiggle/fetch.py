@@ -1,15 +1,22 @@
+import asyncio
 import requests
-# import conjure
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import Executor, ThreadPoolExecutor
 from soundfile import SoundFile
 from io import BytesIO
 import numpy as np
 import librosa
-from functools import lru_cache
-from typing import IO, Protocol
+import logging
+from typing import IO, Any, Dict, Iterable, Optional, Protocol
 
-# TODO: Fix conjure typing
-# TODO: Make sure that the path is configurable
-# collection = conjure.LmdbCollection(path='audio-data')
+from .cache import CacheStats, MemoryCache, default_cache
+from .cancellation import remaining
+from .governor import admit_fetch, checkpoint, in_current_context, record_fetch
+from .singleflight import SingleFlight
+from .lmdbcache import LmdbAudioCache
+
+logger = logging.getLogger(__name__)
 
 def audio_io(
         samples: np.ndarray, 
@@ -18,7 +25,14 @@ def audio_io(
         subtype: str = 'PCM_16'):
     io = BytesIO()
     
-    with SoundFile(io, mode='w', samplerate=samplerate, format=format, subtype=subtype) as sf:
+    with SoundFile(
+            io, 
+            mode='w', 
+            samplerate=samplerate, 
+            channels=1 if len(samples.shape) == 1 else samples.shape[1],
+            format=format, 
+            subtype=subtype) as sf:
+        
         sf.write(samples)
     
     io.seek(0)
@@ -31,31 +45,50 @@ def audio_bytes(
         subtype: str='PCM_16') -> bytes:
     
     io = audio_io(samples, samplerate, format, subtype)
-    return io.read()
-
-# @conjure.conjure(
-#     content_type='application/octet-stream',
-#     storage=collection,
-#     func_identifier=conjure.LiteralFunctionIdentifier('fetchaudio'),
-#     param_identifier=conjure.ParamsHash(),
-#     serializer=conjure.IdentitySerializer(),
-#     deserializer=conjure.IdentityDeserializer(),
-#     prefer_cache=True,
-#     read_from_cache_hook=lambda x: print(f'Reading from cache for url {x}')
-# )
-def fetch_audio_from_url(url: str) -> bytes:
-    resp = requests.get(url)
-    resp.raise_for_status()
-    print(f'fetched audio from URL {url} with len {len(resp.content)}')
-    return resp.content
-    
-
-# @conjure.numpy_conjure(
-#     storage=collection,
-#     content_type='application/octet-stream',
-#     read_hook=lambda x: print(f'Resampled version already cached'))
-def fetch_audio_data_at_samplerate(url: str, samplerate: int) -> np.ndarray:
-    audio_bytes = fetch_audio_from_url(url)
+    return io.getvalue()
+
+download_chunk_size = 64 * 1024
+
+
+def fetch_audio_from_url(
+        url: str, 
+        disk_cache: Optional[LmdbAudioCache] = None,
+        session: Optional[requests.Session] = None) -> bytes:
+    
+    if disk_cache is not None:
+        cached = disk_cache.get_raw(url)
+        if cached is not None:
+            logger.debug(f'Reading from cache for url {url}')
+            return cached
+    
+    checkpoint()
+    
+    # the body is read in chunks, so that a request that is cancelled, or 
+    # exceeds its byte budget, stops downloading promptly, and nothing 
+    # partial is ever cached
+    chunks = []
+    with (session or requests).get(url, stream=True, timeout=remaining()) as resp:
+        resp.raise_for_status()
+        
+        declared = resp.headers.get('Content-Length')
+        if declared is not None and declared.isdigit():
+            admit_fetch(url, int(declared))
+        
+        for chunk in resp.iter_content(chunk_size=download_chunk_size):
+            checkpoint()
+            record_fetch(url, len(chunk))
+            chunks.append(chunk)
+    
+    content = b''.join(chunks)
+    logger.debug(f'fetched audio from URL {url} with len {len(content)}')
+    
+    if disk_cache is not None:
+        disk_cache.put_raw(url, content)
+    
+    return content
+    
+
+def decode_audio(audio_bytes: bytes, samplerate: int) -> np.ndarray:
     with SoundFile(BytesIO(audio_bytes)) as sf:
         sf.seek(0)
         samples = sf.read()
@@ -69,16 +102,68 @@ def fetch_audio_data_at_samplerate(url: str, samplerate: int) -> np.ndarray:
         
         if sf.channels > 1:
             samples = np.sum(samples, axis=1) * 0.5
-            
-        print(f'Returned samples from url {url} with sample length {len(samples)}')
+        
         return samples
 
-# TODO: In-memory cache size should be configurable.  Also, the size of
-# cache items can be highly variable, so an approach that expresses
-# storage limits in bytes is probably more appropriate
-@lru_cache(maxsize=1024)
-def fetch_audio_data(url: str, samplerate: int):
-    return fetch_audio_data_at_samplerate(url, samplerate)
+
+def fetch_audio_data_at_samplerate(
+        url: str, 
+        samplerate: int, 
+        disk_cache: Optional[LmdbAudioCache] = None,
+        session: Optional[requests.Session] = None) -> np.ndarray:
+    
+    if disk_cache is not None:
+        cached = disk_cache.get_samples(url, samplerate)
+        if cached is not None:
+            logger.debug(f'Resampled version already cached')
+            return cached
+    
+    samples = decode_audio(
+        fetch_audio_from_url(url, disk_cache, session), samplerate)
+    logger.debug(f'Returned samples from url {url} with sample length {len(samples)}')
+    
+    if disk_cache is not None and disk_cache.put_samples(url, samplerate, samples):
+        # prefer the memory-mapped copy, so the decoded samples can be
+        # released from the heap
+        return disk_cache.get_samples(url, samplerate)
+    
+    return samples
+
+# decoded audio is keyed by (url, samplerate) in a cache shared by all
+# fetchers that aren't given one explicitly
+default_memory_cache = default_cache('audio')
+
+
+def fetch_audio_data(
+        url: str, 
+        samplerate: int, 
+        cache: MemoryCache = default_memory_cache,
+        disk_cache: Optional[LmdbAudioCache] = None,
+        session: Optional[requests.Session] = None) -> np.ndarray:
+    
+    return cache.get_or_compute(
+        (url, samplerate), 
+        lambda: fetch_audio_data_at_samplerate(url, samplerate, disk_cache, session))
+
+
+def pooled_session(max_connections: int, retries: int) -> requests.Session:
+    """
+    Build a session whose connections are re-used across requests, and
+    which retries transient failures with exponential backoff
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.25,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET'])
+    adapter = HTTPAdapter(
+        pool_connections=max_connections, 
+        pool_maxsize=max_connections, 
+        max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 class HasSamplerate(Protocol):
@@ -89,18 +174,153 @@ class AudioFetcher(HasSamplerate):
     """
     Class for fetching audio over HTTP with multiple levels
     of caching, both on-disk and in-memory.    
+    
+    Decoded audio is cached in memory under a byte budget.  By default, all
+    fetchers share a single, module-level cache, but either a cache instance
+    or a budget in bytes (which creates a cache private to this fetcher)
+    may be provided.
+    
+    An optional, persistent LMDB tier sits beneath the in-memory cache, 
+    storing both the raw bytes fetched over HTTP and decoded audio at each
+    samplerate requested.
+    
+    All HTTP requests made by a fetcher share a pool of connections, and 
+    `prefetch` downloads and decodes many URLs in parallel, with at most
+    `max_concurrency` requests in flight at once.
+    
+    `fetch_async` and `prefetch_async` run fetches in `executor`, or the 
+    event loop's default executor, and concurrent requests for the same URL
+    share a single fetch.
     """
-    def __init__(self, samplerate: int, format: str='WAV', subtype: str='PCM_16'):
+    def __init__(
+            self, 
+            samplerate: int, 
+            format: str='WAV', 
+            subtype: str='PCM_16',
+            memory_cache: Optional[MemoryCache] = None,
+            memory_cache_bytes: Optional[int] = None,
+            disk_cache: Optional[LmdbAudioCache] = None,
+            max_concurrency: int = 8,
+            retries: int = 3,
+            executor: Optional[Executor] = None):
+        
         super().__init__()
         self.samplerate = samplerate
         self.format = format
         self.subtype = subtype
+        
+        if memory_cache is not None and memory_cache_bytes is not None:
+            raise ValueError('Provide either memory_cache or memory_cache_bytes, but not both')
+        
+        if memory_cache_bytes is not None:
+            memory_cache = MemoryCache(max_bytes=memory_cache_bytes)
+        
+        self.memory_cache = \
+            default_memory_cache if memory_cache is None else memory_cache
+        self.disk_cache = disk_cache
+        self.max_concurrency = max_concurrency
+        self.session = pooled_session(max_concurrency, retries)
+        self.flights = SingleFlight(executor)
+    
+    @property
+    def cache_stats(self) -> CacheStats:
+        return self.memory_cache.stats
     
     def __call__(self, url: str) -> np.ndarray:
         return self.fetch(url)
     
     def fetch(self, url: str) -> np.ndarray:
-        return fetch_audio_data(url, self.samplerate)
+        return fetch_audio_data(
+            url, 
+            self.samplerate, 
+            self.memory_cache, 
+            self.disk_cache, 
+            self.session)
+    
+    def fetch_derived(self, key: str) -> Optional[np.ndarray]:
+        """
+        Retrieve audio derived from fetched audio, e.g. a pitch-shifted 
+        sample bank entry, from any cache tier, or `None` if it is absent.
+        
+        Most renders probe for derived audio that was never stored, so the
+        probe doesn't count towards the fetched audio's hit rate
+        """
+        samples = self.memory_cache.peek(('derived', key))
+        if samples is not None:
+            return samples
+        
+        if self.disk_cache is None:
+            return None
+        
+        samples = self.disk_cache.get_derived(key)
+        if samples is not None:
+            self.memory_cache.put(('derived', key), samples)
+        return samples
+    
+    def store_derived(self, key: str, samples: np.ndarray) -> None:
+        if self.disk_cache is not None and self.disk_cache.put_derived(key, samples):
+            samples = self.disk_cache.get_derived(key)
+        
+        self.memory_cache.put(('derived', key), samples)
+    
+    def is_cached(self, url: str) -> bool:
+        return (url, self.samplerate) in self.memory_cache
+    
+    def peek(self, url: str) -> Optional[np.ndarray]:
+        """
+        Decoded audio from any cache tier, or `None` if it would have to be
+        fetched
+        """
+        samples = self.memory_cache.peek((url, self.samplerate))
+        if samples is None and self.disk_cache is not None:
+            samples = self.disk_cache.get_samples(url, self.samplerate)
+        return samples
+    
+    def prefetch(self, urls: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Fetch and decode each unique URL not already held in memory, in 
+        parallel, returning the samples for every URL requested
+        """
+        urls = list(dict.fromkeys(urls))
+        
+        results = {}
+        missing = []
+        for url in urls:
+            cached = self.memory_cache.peek((url, self.samplerate))
+            if cached is None:
+                missing.append(url)
+            else:
+                results[url] = cached
+        
+        if len(missing) == 1:
+            results[missing[0]] = self.fetch(missing[0])
+        elif missing:
+            workers = min(self.max_concurrency, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(in_current_context(self.fetch), url) for url in missing]
+                for url, future in zip(missing, futures):
+                    results[url] = future.result()
+        
+        return {url: results[url] for url in urls}
+    
+    async def fetch_async(self, url: str) -> np.ndarray:
+        cached = self.memory_cache.peek((url, self.samplerate))
+        if cached is not None:
+            return cached
+        
+        return await self.flights.run((url, self.samplerate), lambda: self.fetch(url))
+    
+    async def prefetch_async(self, urls: Iterable[str]) -> Dict[str, np.ndarray]:
+        urls = list(dict.fromkeys(urls))
+        results = await asyncio.gather(*[self.fetch_async(url) for url in urls])
+        return dict(zip(urls, results))
+    
+    def prefetch_for(self, params: Any) -> Dict[str, np.ndarray]:
+        """
+        Fetch all source material required to render `params`, which may be
+        any parameters exposing `source_material`
+        """
+        return self.prefetch(sm.url for sm in params.source_material)
     
     def fetch_io(self, url: str) -> IO:
         samples = self.fetch(url)
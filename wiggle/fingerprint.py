@@ -0,0 +1,84 @@
+from hashlib import sha1
+from typing import Any
+import inspect
+import json
+
+
+class UnstableIdentity(ValueError):
+    """
+    Raised when fingerprinting a synth with no identity that is stable, and
+    unique to the audio it renders, e.g. a closure or lambda
+    """
+    pass
+
+
+def digest(data: Any) -> str:
+    """
+    Produce a stable digest of JSON-serializable data, which, unlike
+    python's built-in `hash`, is consistent across processes
+    """
+    encoded = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return sha1(encoded.encode()).hexdigest()
+
+
+def synth_identifier(synth: Any) -> Any:
+    """
+    Identify a synth by its id, whether it is a synth instance, a bound
+    method of one (e.g. `Sequencer.render`), or a bare id or name
+    """
+    if isinstance(synth, (int, str)):
+        return synth
+
+    if hasattr(synth, 'id'):
+        return synth.id
+
+    owner = getattr(synth, '__self__', None)
+    if owner is not None and hasattr(owner, 'id'):
+        return owner.id
+
+    module = getattr(synth, '__module__', None)
+    name = getattr(synth, '__qualname__', None) or synth.__class__.__qualname__
+    return f'{module}.{name}'
+
+
+def synth_fingerprint(synth: Any) -> Any:
+    """
+    Identify a synth for caching, such that synths sharing an identity
+    render identical audio for identical parameters.
+
+    Synths, or the owners of bound methods, may define a `cache_identity`
+    covering any configuration that changes their output, e.g. a quality
+    setting.  Otherwise, synths are identified by their id, and functions
+    by their module and name.  Closures and lambdas can't be told apart by
+    name, so have no stable identity, and raise `UnstableIdentity`.
+    """
+    if isinstance(synth, (int, str)):
+        return synth
+
+    owner = getattr(synth, '__self__', None)
+    for candidate in (synth, owner):
+        if candidate is not None and hasattr(candidate, 'cache_identity'):
+            return candidate.cache_identity
+
+    for candidate in (synth, owner):
+        if candidate is not None and hasattr(candidate, 'id'):
+            return candidate.id
+
+    if inspect.isfunction(synth) \
+            and synth.__closure__ is None and '<' not in synth.__qualname__:
+        return f'{synth.__module__}.{synth.__qualname__}'
+
+    raise UnstableIdentity(f'{synth!r} has no stable identity, and can\'t be fingerprinted')
+
+
+def fingerprint(params: Any) -> str:
+    """
+    Content fingerprint for any parameters, preferring a `fingerprint`
+    method when one is defined, and otherwise digesting the parameters'
+    dictionary representation
+    """
+    method = getattr(params, 'fingerprint', None)
+    if method is not None:
+        return method()
+
+    return digest(params.to_dict())
@@ -0,0 +1,174 @@
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Optional, Set, TypeVar
+
+from wiggle.cancellation import raise_if_cancelled
+
+T = TypeVar('T')
+
+
+@dataclass
+class ResourceLimits:
+    """
+    Per-request limits, where `None` means unlimited
+    """
+    max_duration_seconds: Optional[float] = None
+    max_events: Optional[int] = None
+    max_depth: Optional[int] = None
+    max_urls: Optional[int] = None
+    max_fetched_bytes: Optional[int] = None
+    max_wall_seconds: Optional[float] = None
+
+
+@dataclass
+class ResourceUsage:
+    duration_seconds: float = 0
+    events: int = 0
+    depth: int = 0
+    urls: Set[str] = field(default_factory=set)
+    fetched_bytes: int = 0
+    wall_seconds: float = 0
+
+    # the limit that stopped the request, if any
+    exceeded: Optional[str] = None
+
+
+class ResourceLimitExceeded(ValueError):
+    def __init__(self, resource: str, value: float, limit: float):
+        super().__init__(f'Request exceeded its {resource} limit of {limit} with {value}')
+        self.resource = resource
+        self.value = value
+        self.limit = limit
+
+
+class ResourceGovernor(object):
+    """
+    Enforces a single request's resource limits.
+
+    Limits that can be estimated up front are checked by `admit`, before
+    any rendering begins.  While a governor is active, i.e., within its
+    `with` block, render paths call `checkpoint` between units of work,
+    and fetches report the bytes they download, so that a request
+    exceeding a limit partway through stops at the next checkpoint.
+    """
+
+    def __init__(self, limits: ResourceLimits):
+        super().__init__()
+        self.limits = limits
+        self.usage = ResourceUsage()
+        self._started = perf_counter()
+        self._lock = Lock()
+        self._token = None
+
+    def __enter__(self):
+        self._started = perf_counter()
+        self._token = current_governor.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        current_governor.reset(self._token)
+        self.usage.wall_seconds = perf_counter() - self._started
+        if isinstance(exc_val, ResourceLimitExceeded):
+            self.usage.exceeded = exc_val.resource
+
+    def _check(self, resource: str, value: float, limit: Optional[float]) -> None:
+        if limit is not None and value > limit:
+            raise ResourceLimitExceeded(resource, value, limit)
+
+    def admit(
+            self,
+            duration_seconds: Optional[float],
+            events: int,
+            depth: int,
+            urls: Set[str]) -> None:
+        """
+        Check a request's estimated size, before rendering it
+        """
+        self._check('events', events, self.limits.max_events)
+        self._check('depth', depth, self.limits.max_depth)
+        self._check('urls', len(urls), self.limits.max_urls)
+        if duration_seconds is not None:
+            self._check('duration', duration_seconds, self.limits.max_duration_seconds)
+
+        self.usage.events = events
+        self.usage.depth = depth
+
+    def record_duration(self, duration_seconds: float) -> None:
+        """
+        Check the length of audio about to be allocated, or produced
+        """
+        self._check('duration', duration_seconds, self.limits.max_duration_seconds)
+        with self._lock:
+            self.usage.duration_seconds = max(self.usage.duration_seconds, duration_seconds)
+
+    def admit_fetch(self, url: str, nbytes: int) -> None:
+        """
+        Check a download's declared size, before reading its body
+        """
+        with self._lock:
+            urls = len(self.usage.urls | set([url]))
+            fetched = self.usage.fetched_bytes + nbytes
+
+        self._check('urls', urls, self.limits.max_urls)
+        self._check('fetched bytes', fetched, self.limits.max_fetched_bytes)
+
+    def record_fetch(self, url: str, nbytes: int) -> None:
+        """
+        Count `nbytes` more downloaded from `url`, e.g. a single chunk
+        """
+        with self._lock:
+            self.usage.urls.add(url)
+            self.usage.fetched_bytes += nbytes
+            urls = len(self.usage.urls)
+            fetched = self.usage.fetched_bytes
+
+        self._check('urls', urls, self.limits.max_urls)
+        self._check('fetched bytes', fetched, self.limits.max_fetched_bytes)
+
+    def checkpoint(self) -> None:
+        self._check('wall time', perf_counter() - self._started, self.limits.max_wall_seconds)
+
+
+current_governor: ContextVar[Optional[ResourceGovernor]] = \
+    ContextVar('current_governor', default=None)
+
+
+def checkpoint() -> None:
+    """
+    Stop the current request if it has been cancelled, or has exceeded any
+    of its limits
+    """
+    raise_if_cancelled()
+    governor = current_governor.get()
+    if governor is not None:
+        governor.checkpoint()
+
+
+def record_duration(duration_seconds: float) -> None:
+    governor = current_governor.get()
+    if governor is not None:
+        governor.record_duration(duration_seconds)
+
+
+def admit_fetch(url: str, nbytes: int) -> None:
+    governor = current_governor.get()
+    if governor is not None:
+        governor.admit_fetch(url, nbytes)
+
+
+def record_fetch(url: str, nbytes: int) -> None:
+    governor = current_governor.get()
+    if governor is not None:
+        governor.record_fetch(url, nbytes)
+
+
+def in_current_context(func: Callable[..., T]) -> Callable[..., T]:
+    """
+    Wrap `func` to run in a copy of the calling thread's context, so that
+    work submitted to a thread pool is governed, and can be cancelled, by
+    the request that submitted it
+    """
+    context = copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
@@ -0,0 +1,77 @@
+from dataclasses import fields
+from typing import Any, Hashable
+
+
+class FrozenDict(dict):
+    """
+    A dictionary that can't be modified once constructed, and which is 
+    hashed by its items, regardless of their order
+    """
+    
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{self.__class__.__name__} cannot be modified')
+    
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+    
+    def __hash__(self) -> int:
+        return hash(frozenset(self.items()))
+    
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+class Immutable(object):
+    """
+    Base class for frozen, slotted dataclasses, e.g.
+    `@dataclass(frozen=True, slots=True, eq=False)`.
+
+    Instances are compared and hashed by `_identity`, and the hash is
+    computed only once, when it's first needed, so that instances whose
+    members can't be hashed may still be constructed and compared, as 
+    long as they aren't hashed.  Since instances can't change,
+    transformed copies may share any unchanged members with the original,
+    rather than copying them.
+    """
+    __slots__ = ('_hash',)
+
+    def _freeze(self) -> None:
+        """
+        Convert any mutable members, e.g. lists, to immutable equivalents.
+        Called at construction.
+        """
+        pass
+
+    def _identity(self) -> Hashable:
+        return tuple(getattr(self, f.name) for f in fields(self))
+
+    def __post_init__(self):
+        self._freeze()
+
+    def __hash__(self) -> int:
+        try:
+            return self._hash
+        except AttributeError:
+            h = hash(self._identity())
+            object.__setattr__(self, '_hash', h)
+            return h
+
+    def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
+
+        if type(self) is not type(other):
+            return False
+
+        # differing hashes, where both are already known, settle it cheaply
+        a = getattr(self, '_hash', None)
+        b = getattr(other, '_hash', None)
+        if a is not None and b is not None and a != b:
+            return False
+
+        return self._identity() == other._identity()
+
+    def __reduce__(self):
+        # string hashes differ between processes, so the cached hash must
+        # be recomputed, rather than copied, when unpickling
+        return (self.__class__, tuple(getattr(self, f.name) for f in fields(self)))
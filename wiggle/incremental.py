@@ -0,0 +1,158 @@
+from collections import Counter
+from typing import Dict, Hashable, List, Tuple
+import numpy as np
+
+from wiggle.sampler import convolve_impulse_response
+from wiggle.sequencer import Sequencer, SequencerParams, Voice, voice_key
+
+
+class IncrementalRenderer(object):
+    """
+    Re-renders successive edits of a pattern, e.g. from an editor, doing
+    work proportional to the size of each edit, rather than to the length
+    of the pattern.
+
+    The un-normalized mix of the previous pattern is kept, along with the
+    events that produced it.  Each new pattern is diffed against those
+    events, the contributions of removed or changed events are subtracted,
+    and those of added or changed events are added.  Normalization is only
+    applied to the output.
+
+    Convolution is linear, so the signals each edit sends to a bus are 
+    summed, spanning only the edited events, and convolved once, rather 
+    than once per event.
+
+    Nested patterns are treated as leaves, so editing an event within a
+    nested pattern replaces every event that plays it.  Changing the
+    pattern's buses starts over from an empty canvas.
+    """
+
+    def __init__(self, sequencer: Sequencer):
+        super().__init__()
+        self.sequencer = sequencer
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget the previous pattern, so that the next is rendered in full
+        """
+        self._canvas = np.zeros((0,))
+        self._buses = dict()
+        self._names: List[str] = []
+        self._events: Counter = Counter()
+        self._ends: Counter = Counter()
+        self._uses: Counter = Counter()
+        self._voices: Dict[Hashable, Voice] = dict()
+        self._renders: Dict[Hashable, np.ndarray] = dict()
+
+        # the number of events added or removed by the most recent render
+        self.edited = 0
+
+    def _keys(self, params: SequencerParams) -> Counter:
+        flat = self.sequencer._events(params)
+
+        keys = [voice_key(voice) for voice in flat.voices]
+        for key, voice in zip(keys, flat.voices):
+            self._voices.setdefault(key, voice)
+
+        zeros = np.zeros(len(flat))
+        levels = [flat.sends.get(name, zeros).tolist() for name in self._names]
+
+        return Counter(zip(
+            flat.starts.tolist(),
+            flat.gains.tolist(),
+            [keys[i] for i in flat.voice_index.tolist()],
+            *levels))
+
+    def _ensure_length(self, length: int) -> None:
+        if length <= len(self._canvas):
+            return
+
+        # grow geometrically, so that appending events is amortized
+        canvas = np.zeros((max(length, int(len(self._canvas) * 1.5)),))
+        canvas[:len(self._canvas)] = self._canvas
+        self._canvas = canvas
+
+    def _apply(
+            self, 
+            event: Tuple, 
+            count: int, 
+            sends: Dict[str, List[Tuple[int, np.ndarray]]]) -> None:
+        
+        start, gain, key, *levels = event
+
+        if key not in self._renders:
+            synth, params = self._voices[key]
+            self._renders[key] = synth(params)
+
+        render = self._renders[key]
+        end = start + len(render)
+
+        contribution = render * (gain * count)
+        self._ensure_length(end)
+        self._canvas[start: end] += contribution
+
+        for name, level in zip(self._names, levels):
+            if level:
+                sends[name].append((start, contribution * level))
+
+        self._uses[key] += count
+        self._ends[end] += count
+
+    def _apply_sends(self, sends: Dict[str, List[Tuple[int, np.ndarray]]]) -> None:
+        for name, signals in sends.items():
+            if not signals:
+                continue
+
+            lo = min(start for start, _ in signals)
+            hi = max(start + len(signal) for start, signal in signals)
+            summed = np.zeros((hi - lo,))
+            for start, signal in signals:
+                summed[start - lo: start - lo + len(signal)] += signal
+
+            bus = self._buses[name]
+            wet = convolve_impulse_response(summed, bus, self.sequencer.fetcher)
+            self._ensure_length(lo + len(wet))
+            self._canvas[lo: lo + len(wet)] += wet * self.sequencer._bus_gain(bus)
+
+    def render(self, params: SequencerParams) -> np.ndarray:
+        if len(params.table) == 0:
+            raise ValueError('Cannot render a pattern with no events')
+
+        active = self.sequencer._active_buses(params)
+
+        if params.buses != self._buses:
+            self.reset()
+            self._buses = dict(params.buses)
+            self._names = sorted(params.buses)
+
+        events = self._keys(params)
+        removed = self._events - events
+        added = events - self._events
+
+        sends = {name: [] for name in self._names}
+        for event, count in removed.items():
+            self._apply(event, -count, sends)
+        for event, count in added.items():
+            self._apply(event, count, sends)
+        self._apply_sends(sends)
+
+        self._events = events
+        self._uses = +self._uses
+        self._ends = +self._ends
+        self.edited = sum(removed.values()) + sum(added.values())
+
+        # renders are kept only for as long as some event still plays them
+        self._renders = {k: v for k, v in self._renders.items() if k in self._uses}
+        self._voices = {k: v for k, v in self._voices.items() if k in self._uses}
+
+        # the full render always extends to the end of the longest tail, 
+        # even when the last event to end sends nothing to any bus
+        length = max(self._ends) + self.sequencer._tail(active)
+        self._ensure_length(length)
+        canvas = self._canvas[:length].astype(np.float32)
+
+        if params.normalize:
+            canvas = canvas / (canvas.max() + 1e-8)
+
+        return canvas
@@ -0,0 +1,195 @@
+import logging
+from threading import Lock
+from typing import Optional, Union
+from weakref import WeakSet
+import lmdb
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class _ReadTransaction(object):
+    """
+    A read-only LMDB transaction shared by every view handed out between
+    two writes.  LMDB guarantees that pages visible to a live read
+    transaction are never reused, so views remain valid for as long as
+    they (and therefore this object) are referenced.
+    """
+
+    def __init__(self, env: lmdb.Environment):
+        super().__init__()
+        self.txn = env.begin(buffers=True)
+        self.lock = Lock()
+
+    def get(self, key: bytes, db) -> Optional[memoryview]:
+        with self.lock:
+            return self.txn.get(key, db=db)
+
+    def __del__(self):
+        # begin may have failed, e.g. with all reader slots in use
+        txn = getattr(self, 'txn', None)
+        if txn is None:
+            return
+        try:
+            txn.abort()
+        except lmdb.Error:
+            pass
+
+
+class _MappedBuffer(object):
+    """
+    Exposes a memoryview into the LMDB memory map via the numpy array
+    interface, while keeping the read transaction backing it alive
+    """
+
+    def __init__(self, txn: _ReadTransaction, buf: memoryview, dtype: np.dtype):
+        super().__init__()
+        self._txn = txn
+        self._buf = buf
+        self.__array_interface__ = np.frombuffer(buf, dtype=dtype).__array_interface__
+
+
+class LmdbAudioCache(object):
+    """
+    Persistent, on-disk cache for raw audio bytes, as fetched over HTTP, 
+    decoded audio resampled to a particular samplerate, and audio derived 
+    from either, e.g. pitch-shifted sample banks.
+
+    Values are returned as read-only, zero-copy views into LMDB's memory
+    map rather than being copied onto the heap.
+
+    Each view keeps the read transaction it came from, and so one of the
+    environment's reader slots, alive.  Views handed out between two
+    writes share a transaction, and at most `max_pinned_readers`, by
+    default half of `max_readers`, are kept alive by views at once.
+    Beyond that, values are copied out of a short-lived transaction
+    instead, until earlier views are released.
+
+    Closing the environment unmaps the memory those views point into, so
+    the cache can't be closed while any view is still referenced.
+    """
+
+    def __init__(
+            self,
+            path: str = 'audio-data',
+            map_size: int = 10 * (1024 ** 3),
+            max_readers: int = 1024,
+            max_pinned_readers: Optional[int] = None):
+
+        super().__init__()
+        self.path = path
+        self.map_size = map_size
+        self.max_readers = max_readers
+        self.max_pinned_readers = \
+            max(1, max_readers // 2) if max_pinned_readers is None else max_pinned_readers
+
+        self.env = lmdb.open(
+            path,
+            map_size=map_size,
+            max_dbs=3,
+            max_readers=max_readers,
+            readahead=False)
+
+        self._raw = self.env.open_db(b'raw')
+        self._samples = self.env.open_db(b'samples')
+        self._derived = self.env.open_db(b'derived')
+        self._write_lock = Lock()
+        self._reader: Optional[_ReadTransaction] = None
+        # read transactions still referenced, either as the current reader,
+        # or by views handed out before a later write
+        self._pinned: WeakSet = WeakSet()
+
+    def __getstate__(self):
+        return dict(
+            path=self.path,
+            map_size=self.map_size,
+            max_readers=self.max_readers,
+            max_pinned_readers=self.max_pinned_readers)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def _samples_key(url: str, samplerate: int) -> bytes:
+        return f'{samplerate}:{url}'.encode()
+
+    def _read(self, key: bytes, db) -> Optional[tuple]:
+        with self._write_lock:
+            reader = self._reader
+            if reader is None and len(self._pinned) < self.max_pinned_readers:
+                reader = self._reader = _ReadTransaction(self.env)
+                self._pinned.add(reader)
+
+        if reader is None:
+            # too many earlier generations are pinned by views still in
+            # use, so copy the value rather than pinning another
+            with self.env.begin() as txn:
+                value = txn.get(key, db=db)
+            return None if value is None else (None, value)
+
+        buf = reader.get(key, db)
+        if buf is None:
+            return None
+        return reader, buf
+
+    @staticmethod
+    def _array(reader: Optional[_ReadTransaction], buf, dtype: np.dtype) -> np.ndarray:
+        if reader is None:
+            # arrays over bytes are read-only, like views into the map
+            return np.frombuffer(buf, dtype=dtype)
+        return np.asarray(_MappedBuffer(reader, buf, dtype))
+
+    def _write(self, key: bytes, value: Union[bytes, memoryview], db) -> bool:
+        with self._write_lock:
+            try:
+                with self.env.begin(write=True, db=db) as txn:
+                    txn.put(key, value)
+            except lmdb.MapFullError:
+                logger.warning(f'LMDB cache at {self.path} is full; not persisting {key}')
+                return False
+
+            # views handed out from here on should see this write
+            self._reader = None
+            return True
+
+    def get_raw(self, url: str) -> Optional[memoryview]:
+        result = self._read(url.encode(), self._raw)
+        if result is None:
+            return None
+        return memoryview(self._array(*result, np.uint8))
+
+    def put_raw(self, url: str, data: bytes) -> bool:
+        return self._write(url.encode(), data, self._raw)
+
+    def get_samples(self, url: str, samplerate: int) -> Optional[np.ndarray]:
+        result = self._read(self._samples_key(url, samplerate), self._samples)
+        if result is None:
+            return None
+        return self._array(*result, np.float64)
+
+    def put_samples(self, url: str, samplerate: int, samples: np.ndarray) -> bool:
+        samples = np.ascontiguousarray(samples, dtype=np.float64)
+        return self._write(
+            self._samples_key(url, samplerate), memoryview(samples), self._samples)
+
+    def get_derived(self, key: str) -> Optional[np.ndarray]:
+        result = self._read(key.encode(), self._derived)
+        if result is None:
+            return None
+        return self._array(*result, np.float64)
+    
+    def put_derived(self, key: str, samples: np.ndarray) -> bool:
+        samples = np.ascontiguousarray(samples, dtype=np.float64)
+        return self._write(key.encode(), memoryview(samples), self._derived)
+
+    def close(self) -> None:
+        """
+        Close the environment, once every view handed out has been released
+        """
+        with self._write_lock:
+            self._reader = None
+            if len(self._pinned):
+                raise RuntimeError(
+                    f'Cannot close the LMDB cache at {self.path} while '
+                    f'{len(self._pinned)} transaction(s) are pinned by views')
+            self.env.close()
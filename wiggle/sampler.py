@@ -1,12 +1,20 @@
-from typing import Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import product
+from threading import Lock
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
 import numpy as np
 from scipy.interpolate import interp1d
-from wiggle.basesynth import BaseSynth
+from wiggle.basesynth import BaseSynth, iter_sample_chunks
 from wiggle.fetch import AudioFetcher
-from wiggle.samplerparams import FilterParameters, GainParameters, SamplerParameters, get_interpolation
-from librosa.effects import time_stretch, pitch_shift
+from wiggle.cache import MemoryCache, default_cache
+from wiggle.cancellation import CancellationToken, cancellable
+from wiggle.governor import checkpoint, in_current_context
+from wiggle.samplerparams import FilterParameters, GainParameters, ReverbParameters, SamplerParameters, get_interpolation
+from wiggle.stretch import get_quality, shift_pitch, stretch
 from scipy.stats import norm
-from functools import lru_cache
+from scipy.fft import next_fast_len
+import json
 
 def ensure_length(samples: np.ndarray, desired_length: int) -> np.ndarray:
     if len(samples) == desired_length:
@@ -31,18 +39,55 @@ def normalize_lengths(a: np.ndarray, b: np.ndarray) -> Tuple[np.ndarray, np.ndar
     return a, b
     
 
+def convolution_size(a_length: int, b_length: int) -> int:
+    """
+    The smallest FFT size that is both efficient to compute and large 
+    enough to avoid circular wrap-around
+    """
+    return next_fast_len(a_length + b_length - 1, real=True)
+
+
+def convolve_spectrum(
+        a: np.ndarray, 
+        b_spec: np.ndarray, 
+        b_length: int, 
+        n_fft: int) -> np.ndarray:
+    """
+    Linear convolution of `a` with a signal whose spectrum, computed with
+    an FFT of size `n_fft`, is already known
+    """
+    a_spec = np.fft.rfft(a, n=n_fft, axis=-1)
+    final = np.fft.irfft(a_spec * b_spec, n=n_fft, axis=-1)
+    return final[:len(a) + b_length - 1]
+
+
 def fft_convolve(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Full, linear convolution of two signals
+    """
     if len(a.shape) > 1 or len(b.shape) > 1:
         raise ValueError('1D arrays only are supported')
     
-    a, b = normalize_lengths(a, b)
+    n_fft = convolution_size(len(a), len(b))
+    b_spec = np.fft.rfft(b, n=n_fft, axis=-1)
+    return convolve_spectrum(a, b_spec, len(b), n_fft)
+
+
+def trim_tail(samples: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Drop the longest tail of `samples` containing no more than `threshold`
+    of the signal's total energy
+    """
+    if not 0 <= threshold < 1:
+        raise ValueError(f'threshold must be in the range [0, 1) but was {threshold}')
     
-    a_spec = np.fft.rfft(a, axis=-1, norm='ortho')
-    b_spec = np.fft.rfft(b, axis=-1, norm='ortho')
+    energy = np.cumsum(samples ** 2)
+    total = energy[-1] if len(energy) else 0
+    if total == 0:
+        return samples[:1]
     
-    conv = a_spec * b_spec
-    final = np.fft.irfft(conv, axis=-1, norm='ortho')
-    return final
+    keep = np.searchsorted(energy, total * (1 - threshold)) + 1
+    return samples[:keep]
 
 def apply_envelope(samples: np.ndarray, params: GainParameters) -> np.ndarray:
     points = np.array([[x.time_seconds, x.gain_value] for x in params.keypoints])
@@ -75,71 +120,542 @@ def bandpass_filter(samples: np.ndarray, params: FilterParameters) -> np.ndarray
     return samples
 
 
-def reverb(dry: np.ndarray, impulse_response: np.ndarray, mix: float) -> np.ndarray:
-    wet = fft_convolve(dry, impulse_response)
+def mix_wet(dry: np.ndarray, wet: np.ndarray, mix: float) -> np.ndarray:
+    # scaling the full convolution by its orthonormal factor keeps the wet 
+    # signal's level independent of the impulse response's length
+    wet = wet / np.sqrt(len(wet))
     dry, wet = normalize_lengths(dry, wet)
     samples = (dry * (1 - mix)) + (wet * mix)
     return samples
 
 
-# TODO: In-memory cache size should be configurable.  Also, the size of
-# cache items can be highly variable, so an approach that expresses
-# storage limits in bytes is probably more appropriate
-@lru_cache(maxsize=1024)
-def render(params: SamplerParameters, samplerate: int, fetcher: AudioFetcher) -> np.ndarray:
-    # first, get the audio
-    samples = fetcher(params.url)
+def reverb(dry: np.ndarray, impulse_response: np.ndarray, mix: float) -> np.ndarray:
+    wet = fft_convolve(dry, impulse_response)
+    return mix_wet(dry, wet, mix)
+
+
+# impulse responses, and their spectra at each FFT size requested, are 
+# keyed by url, samplerate and trim threshold
+impulse_response_cache = default_cache('impulse_responses')
+
+
+def impulse_response(fetcher: AudioFetcher, params: ReverbParameters) -> np.ndarray:
+    if params.trim_threshold is None:
+        return fetcher(params.url)
+    
+    return impulse_response_cache.get_or_compute(
+        (params.url, fetcher.samplerate, params.trim_threshold),
+        lambda: trim_tail(fetcher(params.url), params.trim_threshold))
+
+
+def impulse_response_spectrum(
+        fetcher: AudioFetcher, 
+        params: ReverbParameters, 
+        n_fft: int) -> np.ndarray:
+    
+    return impulse_response_cache.get_or_compute(
+        (params.url, fetcher.samplerate, params.trim_threshold, n_fft),
+        lambda: np.fft.rfft(impulse_response(fetcher, params), n=n_fft))
+
+
+class PartitionedConvolver(object):
+    """
+    Uniformly-partitioned, overlap-add convolution.
+    
+    The impulse response is split into partitions of `block_size` samples,
+    whose spectra are computed once.  Input is then processed one block at
+    a time, using a frequency-domain delay line of the spectra of recent 
+    input blocks, so that memory use and latency are bounded by the block 
+    size and the impulse response's length, regardless of the input's 
+    length.
+    """
+    
+    def __init__(self, partitions: np.ndarray, ir_length: int, block_size: int):
+        super().__init__()
+        self.partitions = partitions
+        self.ir_length = ir_length
+        self.block_size = block_size
+        self._delay_line = np.zeros_like(partitions)
+        self._overlap = np.zeros(block_size)
+    
+    @staticmethod
+    def partition(impulse_response: np.ndarray, block_size: int) -> np.ndarray:
+        n_partitions = max(1, -(-len(impulse_response) // block_size))
+        padded = ensure_length(impulse_response, n_partitions * block_size)
+        blocks = padded.reshape((n_partitions, block_size))
+        return np.fft.rfft(blocks, n=block_size * 2, axis=-1)
+    
+    @classmethod
+    def from_impulse_response(
+            cls, 
+            impulse_response: np.ndarray, 
+            block_size: int) -> 'PartitionedConvolver':
+        
+        return cls(
+            cls.partition(impulse_response, block_size), 
+            len(impulse_response), 
+            block_size)
+    
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """
+        Convolve the next block of at most `block_size` input samples, 
+        returning the next `block_size` samples of output
+        """
+        if len(block) > self.block_size:
+            raise ValueError(f'Blocks may have at most {self.block_size} samples but had {len(block)}')
+        
+        self._delay_line[1:] = self._delay_line[:-1]
+        self._delay_line[0] = np.fft.rfft(block, n=self.block_size * 2)
+        
+        spec = np.einsum('pf,pf->f', self._delay_line, self.partitions)
+        result = np.fft.irfft(spec, n=self.block_size * 2)
+        
+        output = result[:self.block_size] + self._overlap
+        self._overlap = result[self.block_size:]
+        return output
+    
+    def convolve_blocks(self, blocks: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+        """
+        Convolve a stream of input blocks of any size, yielding output in 
+        blocks of `block_size` samples, ending with the impulse response's 
+        tail.  The concatenated output is the full, linear convolution.
+        """
+        pending = np.zeros(0)
+        total = 0
+        emitted = 0
+        
+        for block in blocks:
+            total += len(block)
+            pending = np.concatenate([pending, block])
+            while len(pending) >= self.block_size:
+                yield self.process(pending[:self.block_size])
+                pending = pending[self.block_size:]
+                emitted += self.block_size
+        
+        length = total + self.ir_length - 1 if total else 0
+        
+        while emitted < length:
+            output = self.process(pending)
+            pending = pending[:0]
+            yield output[:length - emitted]
+            emitted += len(output)
+    
+    def convolve(self, samples: np.ndarray) -> np.ndarray:
+        blocks = iter_sample_chunks(samples, chunksize=self.block_size)
+        return np.concatenate([np.zeros(0), *self.convolve_blocks(blocks)])
+
+
+# impulse responses longer than this are convolved in partitions, rather 
+# than with a single, large FFT
+partitioned_ir_length = 2 ** 15
+reverb_block_size = 2 ** 14
+
+
+def impulse_response_partitions(
+        fetcher: AudioFetcher, 
+        params: ReverbParameters, 
+        block_size: int) -> np.ndarray:
+    
+    return impulse_response_cache.get_or_compute(
+        (params.url, fetcher.samplerate, params.trim_threshold, 'partitions', block_size),
+        lambda: PartitionedConvolver.partition(
+            impulse_response(fetcher, params), block_size))
+
+
+def reverb_convolver(
+        fetcher: AudioFetcher, 
+        params: ReverbParameters, 
+        block_size: int = reverb_block_size) -> PartitionedConvolver:
+    """
+    A new convolver for the impulse response, sharing its cached partitions
+    with every other convolver for the same impulse response
+    """
+    ir = impulse_response(fetcher, params)
+    partitions = impulse_response_partitions(fetcher, params, block_size)
+    return PartitionedConvolver(partitions, len(ir), block_size)
+
+
+def convolve_impulse_response(
+        samples: np.ndarray, 
+        params: ReverbParameters, 
+        fetcher: AudioFetcher) -> np.ndarray:
+    """
+    Full, linear convolution with the impulse response, re-using its 
+    spectrum whenever it has already been computed at the required FFT 
+    size.  Long impulse responses are convolved in partitions, to avoid 
+    very large transforms.
+    """
+    ir = impulse_response(fetcher, params)
+    
+    if len(ir) > partitioned_ir_length:
+        return reverb_convolver(fetcher, params).convolve(samples)
+    
+    n_fft = convolution_size(len(samples), len(ir))
+    spec = impulse_response_spectrum(fetcher, params, n_fft)
+    return convolve_spectrum(samples, spec, len(ir), n_fft)
+
+
+def cached_reverb(
+        dry: np.ndarray, 
+        params: ReverbParameters, 
+        fetcher: AudioFetcher) -> np.ndarray:
+    
+    wet = convolve_impulse_response(dry, params, fetcher)
+    return mix_wet(dry, wet, params.mix)
+
+
+@dataclass
+class StageStats:
+    hits: int
+    misses: int
+    
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if total == 0:
+            return 0
+        return self.hits / total
+
+
+stage_names = ['bank', 'slice', 'stretch', 'pitch', 'filter', 'reverb', 'gain', 'normalize']
+
+
+class StageCache(object):
+    """
+    Caches the output of each stage of the sampler's pipeline under a key 
+    built from the source and the parameters of every stage up to and 
+    including it, so that changing a late-stage parameter only recomputes
+    the stages that follow it
+    """
+    
+    def __init__(self, max_bytes: int = 0, cache: Optional[MemoryCache] = None):
+        super().__init__()
+        self.cache = MemoryCache(max_bytes=max_bytes) if cache is None else cache
+        self._lock = Lock()
+        self._hits = {name: 0 for name in stage_names}
+        self._misses = {name: 0 for name in stage_names}
+    
+    def __getstate__(self):
+        return dict(max_bytes=self.cache.max_bytes)
+    
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+    
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        return self.cache.get(key)
+    
+    def put(self, key: Hashable, samples: np.ndarray) -> None:
+        # cached outputs are shared by every later render, and returned to
+        # callers, so guard against in-place modification
+        samples.flags.writeable = False
+        self.cache.put(key, samples)
+    
+    def record(self, stage: str, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self._hits[stage] += 1
+            else:
+                self._misses[stage] += 1
+    
+    @property
+    def stats(self) -> Dict[str, StageStats]:
+        with self._lock:
+            return {
+                name: StageStats(hits=self._hits[name], misses=self._misses[name]) 
+                for name in stage_names
+            }
+
+
+default_stage_cache = StageCache(cache=default_cache('stages'))
+
+
+Stage = Tuple[str, Hashable, Callable[[np.ndarray], np.ndarray]]
+
+
+def slice_samples(
+        samples: np.ndarray, 
+        start_seconds: float, 
+        duration_seconds: float, 
+        samplerate: int) -> np.ndarray:
     
     # slice the audio if start and duration are provided
-    start_sample = params.start_seconds * samplerate
+    start_sample = start_seconds * samplerate
     
     # If the duration is zero, then we assume we'd like all available samples
     # after the start
-    duration = (params.duration_seconds * samplerate) or (len(samples) * samplerate)
+    duration = (duration_seconds * samplerate) or (len(samples) * samplerate)
     
-    samples = samples[int(start_sample): int(start_sample + duration)]
+    return samples[int(start_sample): int(start_sample + duration)]
+
+
+def stages(
+        params: SamplerParameters, 
+        samplerate: int, 
+        fetcher: AudioFetcher, 
+        quality: str = 'standard') -> List[Stage]:
+    """
+    The enabled stages of the pipeline for these parameters, each with the 
+    parameters that affect only that stage
+    """
+    result: List[Stage] = [
+        ('slice', 
+         (params.start_seconds, params.duration_seconds), 
+         lambda x: slice_samples(x, params.start_seconds, params.duration_seconds, samplerate))
+    ]
     
     if params.time_stretch:
-        samples = time_stretch(samples, params.time_stretch)
+        result.append((
+            'stretch', 
+            (params.time_stretch, quality), 
+            lambda x: stretch(x, params.time_stretch, quality)))
     
     if params.pitch_shift:
-        samples = pitch_shift(
-            samples, samplerate, n_steps=params.pitch_shift)
+        result.append((
+            'pitch', 
+            (params.pitch_shift, quality), 
+            lambda x: shift_pitch(x, samplerate, params.pitch_shift, quality)))
     
     if params.filter:
-        samples = bandpass_filter(samples, params.filter)
+        result.append((
+            'filter', 
+            params.filter, 
+            lambda x: bandpass_filter(x, params.filter)))
     
     if params.reverb:
-        impulse_response = fetcher(params.reverb.url)
-        samples = reverb(samples, impulse_response, mix=params.reverb.mix)
+        result.append((
+            'reverb', 
+            params.reverb, 
+            lambda x: cached_reverb(x, params.reverb, fetcher)))
     
     if params.gain:
-        samples = apply_envelope(samples, params.gain)
+        result.append((
+            'gain', 
+            params.gain, 
+            lambda x: apply_envelope(x, params.gain)))
     
     if params.normalize:
-        samples = normalize(samples)
+        result.append(('normalize', True, normalize))
+    
+    return result
+
+
+banked_stages = set(['slice', 'stretch', 'pitch'])
+
+
+def bank_key(
+        params: SamplerParameters, 
+        samplerate: int, 
+        quality: str = 'standard') -> Optional[str]:
+    """
+    Key under which a sample bank entry, i.e., the sliced, time-stretched
+    and pitch-shifted source audio, is stored, or `None` if these 
+    parameters neither stretch nor shift pitch
+    """
+    if not params.time_stretch and not params.pitch_shift:
+        return None
+    
+    return json.dumps([
+        'bank',
+        params.url, 
+        samplerate, 
+        float(params.start_seconds), 
+        float(params.duration_seconds), 
+        float(params.time_stretch or 0), 
+        float(params.pitch_shift or 0), 
+        quality
+    ])
+
+
+def stage_keys(
+        params: SamplerParameters, 
+        samplerate: int, 
+        pipeline: List[Stage]) -> List[Hashable]:
+    """
+    The key under which each stage's output is cached
+    """
+    keys = []
+    key: Hashable = (params.url, samplerate)
+    for name, stage_params, _ in pipeline:
+        key = (name, key, stage_params)
+        keys.append(key)
+    return keys
+
+
+def render(
+        params: SamplerParameters, 
+        samplerate: int, 
+        fetcher: AudioFetcher,
+        cache: StageCache = default_stage_cache,
+        quality: str = 'standard') -> np.ndarray:
+    
+    pipeline = stages(params, samplerate, fetcher, quality)
+    keys = stage_keys(params, samplerate, pipeline)
+    
+    # resume from the latest stage whose output is already available
+    samples = None
+    resume_from = 0
+    for i in reversed(range(len(pipeline))):
+        samples = cache.get(keys[i])
+        if samples is not None:
+            cache.record(pipeline[i][0], hit=True)
+            resume_from = i + 1
+            break
+    
+    # the last stage a precomputed sample bank entry could stand in for
+    banked = max(
+        i for i, (name, _, _) in enumerate(pipeline) if name in banked_stages)
+    
+    bank = bank_key(params, samplerate, quality)
+    if bank is not None and resume_from <= banked:
+        entry = fetcher.fetch_derived(bank)
+        cache.record('bank', hit=entry is not None)
+        if entry is not None:
+            samples = entry
+            resume_from = banked + 1
+            cache.put(keys[banked], samples)
+    
+    if samples is None:
+        # first, get the audio
+        samples = fetcher(params.url)
+    
+    for i in range(resume_from, len(pipeline)):
+        checkpoint()
+        name, _, func = pipeline[i]
+        samples = func(samples)
+        cache.record(name, hit=False)
+        cache.put(keys[i], samples)
     
     return samples
 
 class Sampler(BaseSynth):
+    """
+    Renders slices of source audio, with optional time-stretching, 
+    pitch-shifting, filtering, reverb and gain envelopes.
     
-    def __init__(self, fetcher: AudioFetcher):
+    `quality` trades accuracy for speed when time-stretching and 
+    pitch-shifting.  `standard` and `high` use librosa's phase vocoder, 
+    with `high` using larger FFTs and a higher-quality resampler, while 
+    `fast` uses WSOLA time-stretching and polyphase resampling, which are
+    many times faster and well-suited to auditioning.
+    """
+    
+    def __init__(
+            self, 
+            fetcher: AudioFetcher, 
+            stage_cache: Optional[StageCache] = None,
+            quality: str = 'standard'):
+        
         super().__init__()
         self.fetcher = fetcher
+        self.quality = get_quality(quality)
+        self.stage_cache = \
+            default_stage_cache if stage_cache is None else stage_cache
+    
+    @property
+    def stage_stats(self) -> Dict[str, StageStats]:
+        return self.stage_cache.stats
+    
+    def build_bank(
+            self, 
+            url: str,
+            pitch_shifts: Iterable[float] = (0,),
+            time_stretches: Iterable[float] = (0,),
+            start_seconds: float = 0,
+            duration_seconds: float = 0,
+            max_workers: Optional[int] = None) -> Dict[Tuple[float, float], np.ndarray]:
+        """
+        Precompute a bank of time-stretched and pitch-shifted renderings of
+        a single source, in parallel, keyed by `(time_stretch, pitch_shift)`.
+        
+        Each entry is stored in the fetcher's memory and disk tiers, so that
+        any later render of the same slice, at the same stretch, pitch and 
+        quality, skips the phase vocoder altogether, including in other
+        processes or sessions sharing the fetcher's disk cache
+        """
+        combinations = [
+            (s, p) for s, p in product(time_stretches, pitch_shifts) if s or p]
+        
+        def build(combination: Tuple[float, float]) -> np.ndarray:
+            time_stretch, pitch_shift = combination
+            params = SamplerParameters(
+                url=url,
+                start_seconds=start_seconds,
+                duration_seconds=duration_seconds,
+                time_stretch=time_stretch,
+                pitch_shift=pitch_shift)
+            
+            key = bank_key(params, self.samplerate, self.quality)
+            samples = self.fetcher.fetch_derived(key)
+            if samples is None:
+                samples = render(
+                    params, self.samplerate, self.fetcher, self.stage_cache, self.quality)
+                self.fetcher.store_derived(key, samples)
+            return samples
+        
+        # fetch the source once, up front, rather than once per worker
+        self.fetcher.fetch(url)
+        
+        # workers are governed, and can be cancelled, by the calling request
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(in_current_context(build), c) for c in combinations]
+            return dict(zip(combinations, (f.result() for f in futures)))
     
     def __eq__(self, other: 'Sampler'):
-        return self.id == other.id
+        return self.id == other.id and self.quality == getattr(other, 'quality', None)
     
     def __hash__(self) -> int:
-        return hash(self.id)
+        return hash(self.cache_identity)
+    
+    @property
+    def cache_identity(self) -> Tuple[int, str]:
+        # stretch and pitch quality change the rendered audio
+        return (self.id, self.quality)
         
     @property
     def samplerate(self):
         return self.fetcher.samplerate
     
-    def render(self, params: SamplerParameters) -> np.ndarray:
-        # self.validate(params)
-        return render(params, self.samplerate, self.fetcher)
+    def max_render_length(self, params: SamplerParameters) -> Optional[int]:
+        """
+        An upper bound on the length of the render, estimated without 
+        fetching or rendering anything, or `None` if it depends on audio 
+        that hasn't been fetched yet
+        """
+        if params.duration_seconds:
+            length = params.duration_seconds * self.samplerate + 1
+        else:
+            source = self.fetcher.peek(params.url)
+            if source is None:
+                return None
+            length = max(0, len(source) - params.start_seconds * self.samplerate) + 1
+
+        if params.time_stretch:
+            length = (length / params.time_stretch) + 1
+
+        if params.reverb:
+            # trimming only ever shortens the impulse response
+            ir = self.fetcher.peek(params.reverb.url)
+            if ir is None:
+                return None
+            length += len(ir)
+
+        return int(np.ceil(length))
+
+    def is_cached(self, params: SamplerParameters) -> bool:
+        """
+        Whether the render is already available, without rendering it
+        """
+        pipeline = stages(params, self.samplerate, self.fetcher, self.quality)
+        return stage_keys(params, self.samplerate, pipeline)[-1] in self.stage_cache.cache
+
+    def render(
+            self, 
+            params: SamplerParameters, 
+            token: Optional[CancellationToken] = None) -> np.ndarray:
+        self.validate(params)
+        with cancellable(token):
+            return render(
+                params, self.samplerate, self.fetcher, self.stage_cache, self.quality)
 
     @property
     def name(self) -> str:
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from typing import Any, Optional, Sequence, Set
 
+from wiggle.fingerprint import digest
+from wiggle.immutable import Immutable
 from wiggle.sourcematerial import SourceMaterial
 
 from .dictserialiazable import DictSerializable
@@ -14,86 +16,66 @@ def get_interpolation(name: str) -> str:
         raise ValueError(f'{name} is not an allowed interpolation type')
     return name
 
-@dataclass
-class NullObject(DictSerializable):
+@dataclass(frozen=True, slots=True, eq=False)
+class NullObject(Immutable, DictSerializable):
     
     def to_dict(self) -> dict:
         return {}
 
-@dataclass
-class ReverbParameters(DictSerializable):
+@dataclass(frozen=True, slots=True, eq=False)
+class ReverbParameters(Immutable, DictSerializable):
     url: str
     mix: float
-    
-    def __hash__(self) -> int:
-        return hash((self.url, self.mix))
-    
-    def __eq__(self, other: 'ReverbParameters'):
-        return self.url == other.url and self.mix == other.mix
+    # when provided, the impulse response's silent tail, holding no more
+    # than this fraction of its total energy, is dropped
+    trim_threshold: Optional[float] = None
 
     def to_dict(self) -> dict:
-        return self.__dict__
+        d = dict(url=self.url, mix=self.mix, trim_threshold=self.trim_threshold)
+        return {k: v for k, v in d.items() if v is not None}
     
     @staticmethod
     def from_dict(data: dict) -> 'ReverbParameters':
         return ReverbParameters(**data)
 
 
-@dataclass
-class FilterParameters:
+@dataclass(frozen=True, slots=True, eq=False)
+class FilterParameters(Immutable):
     center_frequency: float
     bandwidth: float
     
-    def __hash__(self) -> int:
-        return hash((self.center_frequency, self.bandwidth))
-    
-    def __eq__(self, other: 'FilterParameters'):
-        return self.center_frequency == other.center_frequency and self.bandwidth == other.bandwidth
-    
     def to_dict(self) -> dict:
-        return self.__dict__
+        return dict(center_frequency=self.center_frequency, bandwidth=self.bandwidth)
 
     @staticmethod
     def from_dict(data: dict) -> 'FilterParameters':
         return FilterParameters(**data)
 
-@dataclass
-class GainKeyPoint:
+@dataclass(frozen=True, slots=True, eq=False)
+class GainKeyPoint(Immutable):
     time_seconds: float
     gain_value: float
     
-    def __hash__(self) -> int:
-        return hash((self.time_seconds, self.gain_value))
-    
-    def __eq__(self, other: 'GainKeyPoint'):
-        return self.time_seconds == other.time_seconds and self.gain_value == other.gain_value
-    
     def to_dict(self) -> dict:
-        return self.__dict__
+        return dict(time_seconds=self.time_seconds, gain_value=self.gain_value)
     
     @staticmethod
     def from_dict(data: dict) -> 'GainKeyPoint':
         return GainKeyPoint(**data)
 
 
-@dataclass
-class GainParameters:
+@dataclass(frozen=True, slots=True, eq=False)
+class GainParameters(Immutable):
     interpolation: str
     keypoints: Sequence[GainKeyPoint]
     
-    def __hash__(self) -> int:
-        return hash((self.interpolation, *[hash(k) for k in self.keypoints]))
-    
-    def __eq__(self, other: 'GainParameters'):
-        if len(self.keypoints) != len(other.keypoints):
-            return False
-        
-        return \
-            self.interpolation == other.interpolation \
-            and all(a == b for a, b in zip(self.keypoints, other.keypoints))
+    def _freeze(self) -> None:
+        object.__setattr__(self, 'keypoints', tuple(self.keypoints))
     
     def to_dict(self) -> dict:
-        return self.__dict__
+        return dict(
+            interpolation=self.interpolation, 
+            keypoints=[k.to_dict() for k in self.keypoints])
     
     @staticmethod
     def from_dict(data: dict) -> 'GainParameters':
@@ -101,8 +83,17 @@ class GainParameters:
             interpolation=data['interpolation'], 
             keypoints=[GainKeyPoint.from_dict(x) for x in data['keypoints']])
 
-@dataclass
-class SamplerParameters(DictSerializable):
+def optional_from_dict(cls: Any, data: dict, key: str) -> Any:
+    # `to_dict` and the schema use e.g. `filter`, while older documents may 
+    # use e.g. `filter_parameters`
+    for k in (key, f'{key}_parameters'):
+        if data.get(k, None) is not None:
+            return cls.from_dict(data[k])
+    return None
+
+
+@dataclass(frozen=True, slots=True, eq=False)
+class SamplerParameters(Immutable, DictSerializable):
     url: str
     start_seconds: float = 0
     duration_seconds: float = 0
@@ -122,28 +113,8 @@ class SamplerParameters(DictSerializable):
         
         return set([SourceMaterial(url=self.url)])
     
-    def __hash__(self) -> int:
-        return hash((
-            self.url, 
-            self.start_seconds, 
-            self.duration_seconds, 
-            self.time_stretch, 
-            self.pitch_shift, 
-            hash(self.filter), 
-            self.normalize, 
-            hash(self.gain), 
-            hash(self.reverb)))
-    
-    def __eq__(self, other: 'SamplerParameters'):
-        return self.url == other.url \
-            and self.start_seconds == other.start_seconds \
-            and self.duration_seconds == other.duration_seconds \
-            and self.time_stretch == other.time_stretch \
-            and self.pitch_shift == other.pitch_shift \
-            and self.filter == other.filter \
-            and self.normalize == other.normalize \
-            and self.gain == other.gain \
-            and self.reverb == other.reverb
+    def fingerprint(self) -> str:
+        return digest(self.to_dict())
     
     @staticmethod
     def from_dict(data: dict) -> 'SamplerParameters':
@@ -153,10 +124,10 @@ class SamplerParameters(DictSerializable):
             duration_seconds=data.get('duration_seconds', 0),
             time_stretch=data.get('time_stretch', None),
             pitch_shift=data.get('pitch_shift', None),
-            filter=FilterParameters.from_dict(data['filter_parameters']) if 'filter_parameters' in data else None,
+            filter=optional_from_dict(FilterParameters, data, 'filter'),
             normalize=data.get('normalize', None),
-            gain=GainParameters.from_dict(data['gain_parameters']) if 'gain_parameters' in data else None,
-            reverb=ReverbParameters.from_dict(data['reverb_parameters']) if 'reverb_parameters' in data else None
+            gain=optional_from_dict(GainParameters, data, 'gain'),
+            reverb=optional_from_dict(ReverbParameters, data, 'reverb')
         )
 
     def to_dict(self) -> dict:
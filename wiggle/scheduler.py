@@ -0,0 +1,139 @@
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Dict, Hashable, Optional, Union
+import numpy as np
+
+from wiggle.governor import in_current_context
+from wiggle.sequencer import Loop, Sequencer, SequencerParams, Voice, nested_sequencer
+
+
+def render_leaf(synth: Any, params: Any) -> np.ndarray:
+    return synth(params)
+
+
+def leaf_key(voice: Voice) -> Hashable:
+    """
+    Identify a leaf render, such that voices sharing a synth and
+    parameters are rendered only once across the whole tree
+    """
+    key = (voice.synth, voice.params)
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return (id(voice.synth), id(voice.params))
+
+
+class RenderScheduler(object):
+    """
+    Renders a tree of nested patterns as a dependency graph.
+
+    Every unique leaf render across the whole tree is submitted to a thread
+    or process pool up front, skipping sub-patterns whose mix is already 
+    cached, so that only leaves are rendered in parallel.  Nested patterns 
+    are then mixed serially, depth-first, in the calling thread, using the
+    same code as the serial path, each waiting on its children's leaves 
+    as it reaches them.  Each mix is cached by its content fingerprint, so 
+    that a sub-pattern repeated throughout the tree is only mixed once.
+
+    NumPy's FFTs and librosa's phase vocoder release the GIL for much of
+    their work, so a thread pool is usually sufficient.  A process pool
+    requires synths and parameters to be picklable, and worker processes
+    do not share the parent's in-memory caches, so pairing it with an
+    on-disk cache is recommended.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, kind: str = 'thread'):
+        super().__init__()
+
+        if kind not in ('thread', 'process'):
+            raise ValueError(f'kind must be one of thread or process but was {kind}')
+
+        self.max_workers = max_workers
+        self.kind = kind
+        self._executor: Optional[Executor] = None
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.kind == 'thread':
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                else:
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def submit_leaves(
+            self, 
+            sequencer: Sequencer, 
+            params: Union[SequencerParams, Loop]) -> Dict[Hashable, Future]:
+        """
+        Submit each unique leaf render in the tree, skipping sub-patterns 
+        whose mixed render is already cached
+        """
+        futures = dict()
+        
+        def visit(seq: Sequencer, p: Union[SequencerParams, Loop]):
+            if isinstance(p, Loop):
+                if seq.cached(p.pattern) is None:
+                    visit(seq, p.pattern)
+                return
+            
+            for voice in p.table.voices:
+                nested = nested_sequencer(voice)
+                
+                if nested is None:
+                    key = leaf_key(voice)
+                    if key not in futures:
+                        # worker threads are governed by the request that
+                        # submitted them, but processes can't share a governor
+                        func = render_leaf if self.kind == 'process' else in_current_context(render_leaf)
+                        futures[key] = self.executor.submit(func, voice.synth, voice.params)
+                elif nested.cached(voice.params) is None:
+                    visit(nested, voice.params)
+        
+        visit(sequencer, params)
+        return futures
+
+    def render(self, sequencer: Sequencer, params: Union[SequencerParams, Loop]) -> np.ndarray:
+        sequencer.prefetch(params)
+
+        futures = self.submit_leaves(sequencer, params)
+
+        def mix(seq: Sequencer, p: Union[SequencerParams, Loop]) -> np.ndarray:
+            cached = seq.cached(p)
+            if cached is not None:
+                return cached
+            
+            if isinstance(p, Loop):
+                return seq.cache(p, seq.tile(p, mix(seq, p.pattern)))
+
+            renders = []
+            for voice in p.table.voices:
+                nested = nested_sequencer(voice)
+                if nested is None:
+                    renders.append(futures[leaf_key(voice)].result())
+                else:
+                    renders.append(mix(nested, voice.params))
+
+            return seq.cache(p, seq.mix(p, renders))
+
+        try:
+            return mix(sequencer, params)
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
@@ -1,12 +1,27 @@
-from dataclasses import dataclass
-from typing import Any, Callable, Sequence, Set, Union
+from dataclasses import dataclass, field, replace
+from hashlib import sha1
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Iterable, Iterator, List, \
+    NamedTuple, Optional, Protocol, Sequence, Set, Union
 import numpy as np
 from wiggle.dictserialiazable import DictSerializable
-from wiggle.basesynth import BaseSynth, HasId
-from copy import deepcopy
-import numpy as np
+from wiggle.basesynth import BaseSynth, HasId, iter_sample_chunks
+from itertools import chain
 
+from wiggle.fingerprint import UnstableIdentity, digest, fingerprint, synth_fingerprint, \
+    synth_identifier
+from wiggle.immutable import FrozenDict, Immutable
 from wiggle.sourcematerial import SourceMaterial
+from wiggle.cache import MemoryCache, default_cache
+from wiggle.canvas import BlockSparseCanvas
+from wiggle.fetch import AudioFetcher
+from wiggle.cancellation import CancellationToken, cancellable
+from wiggle.governor import checkpoint, record_duration
+from wiggle.samplerparams import ReverbParameters
+from wiggle.sampler import convolution_size, convolve_impulse_response, convolve_spectrum, \
+    ensure_length, impulse_response, reverb_convolver
+
+if TYPE_CHECKING:
+    from wiggle.scheduler import RenderScheduler
 
 
 class FourFourInterval:
@@ -30,36 +45,35 @@ thirtysecond = FourFourInterval.thirtysecond
 sixtyfourth = FourFourInterval.sixtyfourth
 triplet = FourFourInterval.triplet
 
-@dataclass
-class HasTime:
+class HasTime(Protocol):
     time: float
 
-@dataclass
-class HasGain:
+class HasGain(Protocol):
     gain: float
 
-@dataclass
-class Event(HasTime, HasGain):
+@dataclass(frozen=True, slots=True, eq=False)
+class Event(Immutable):
+    gain: float
+    time: float
     synth: Union[Callable, HasId]
     params: DictSerializable
+    # levels at which this event's signal is sent to each of the enclosing 
+    # pattern's named buses
+    sends: Dict[str, float] = field(default_factory=FrozenDict)
     
+    def _freeze(self) -> None:
+        object.__setattr__(self, 'sends', FrozenDict(self.sends))
     
-    def translate(self, amt: float) -> 'Event':
-        return Event(
-            time=self.time + amt, 
-            synth=self.synth, 
-            params=deepcopy(self.params), 
-            gain=self.gain)
+    def _identity(self) -> Hashable:
+        # events are considered equal when they render the same thing, 
+        # regardless of when, or how loudly
+        return (self.synth, self.params)
     
-    def __eq__(self, other: 'Event') -> bool:
-        return self.params == other.params and self.synth == other.synth
+    def translate(self, amt: float) -> 'Event':
+        return replace(self, time=self.time + amt)
     
     def time_scale(self, factor: float):
-        return Event(
-            time = self.time * factor, 
-            synth=self.synth, 
-            params=deepcopy(self.params), 
-            gain=self.gain)
+        return replace(self, time=self.time * factor)
     
     def __lshift__(self, other: float) -> 'Event':
         return self.translate(-other)
@@ -67,10 +81,32 @@ class Event(HasTime, HasGain):
     def __rshift__(self, other: float) -> 'Event':
         return self.translate(other)
     
+    def send(self, bus: str, level: float) -> 'Event':
+        """
+        Return a copy of this event that also sends its signal to the named
+        bus at the given level
+        """
+        return replace(self, sends={**self.sends, bus: level})
+    
+    def fingerprint(self) -> str:
+        return digest([
+            synth_fingerprint(self.synth), 
+            self.time, 
+            self.gain, 
+            fingerprint(self.params),
+            self.sends])
+    
     def to_dict(self):
-        return dict(
-            synth=self.synth.id if hasattr(self.synth, 'id') else self.synth, 
+        d = dict(
+            synth=synth_identifier(self.synth), 
+            time=self.time,
+            gain=self.gain,
             params=self.params.to_dict())
+        
+        if self.sends:
+            d['sends'] = dict(self.sends)
+        
+        return d
     
     @staticmethod
     def from_dict(data: dict, restore_params: Callable, restore_synth: Callable) -> 'Event':
@@ -81,12 +117,332 @@ class Event(HasTime, HasGain):
             synth=synth, 
             params=params, 
             gain=data.get('gain', None), 
-            time=data.get('time', None))
+            time=data.get('time', None),
+            sends=dict(data.get('sends', {})))
+    
+
+
+class Voice(NamedTuple):
+    """
+    A unique synth and parameters pair, shared by every event in a pattern
+    that renders it
+    """
+    synth: Union[Callable, HasId]
+    params: DictSerializable
+
+
+def synth_key(synth: Any) -> Hashable:
+    # synths compare equal by type, e.g. all samplers share an id, so 
+    # distinguish instances by identity, taking care that bound methods, 
+    # e.g. `Sequencer.render`, are distinct objects on every access
+    if isinstance(synth, (int, str)):
+        return synth
     
+    owner = getattr(synth, '__self__', None)
+    if owner is not None:
+        return (id(owner), getattr(synth, '__name__', None))
+    
+    return id(synth)
+
 
+def voice_key(voice: Voice) -> Hashable:
+    """
+    Identify a voice, such that voices with the same synth and equal 
+    parameters are stored only once
+    """
+    try:
+        return (synth_key(voice.synth), hash(voice.params), voice.params)
+    except TypeError:
+        return (synth_key(voice.synth), id(voice.params))
+
+
+def array_digest(arr: np.ndarray) -> str:
+    return sha1(np.ascontiguousarray(arr).tobytes()).hexdigest()
+
+
+class EventTable(object):
+    """
+    Columnar storage for a pattern's events.
+    
+    Times, gains and each event's send level for every named bus are numpy
+    arrays, while each event's synth and parameters are an index into a 
+    table of unique voices.  Very large patterns cost a few bytes per 
+    event, rather than an object each, and shifting, scaling, repeating 
+    and overlaying them are vectorized array operations.
+    
+    Iterating over, or indexing, a table produces `Event` instances.
+    
+    Tables are immutable; their columns are read-only, and their hash is
+    computed once, at construction.
+    """
+    
+    __slots__ = ('times', 'gains', 'voice_index', 'voices', 'sends', '_hash')
+    
+    def __init__(
+            self, 
+            times: Iterable[float], 
+            gains: Iterable[float], 
+            voice_index: Iterable[int], 
+            voices: Iterable[Voice],
+            sends: Optional[Dict[str, Iterable[float]]] = None):
+        
+        super().__init__()
+        self.times = np.asarray(times, dtype=np.float64)
+        self.gains = np.asarray(gains, dtype=np.float64)
+        self.voice_index = np.asarray(voice_index, dtype=np.int64)
+        self.voices = tuple(Voice(*v) for v in voices)
+        self.sends = FrozenDict(
+            (name, np.asarray(levels, dtype=np.float64)) 
+            for name, levels in (sends or {}).items())
+        
+        columns = [self.times, self.gains, self.voice_index, *self.sends.values()]
+        if len(set(len(c) for c in columns)) > 1:
+            raise ValueError('All columns of an event table must have the same length')
+        
+        if len(self.voice_index) and self.voice_index.max() >= len(self.voices):
+            raise ValueError('Event table refers to a voice that does not exist')
+        
+        for column in [self.times, self.gains, self.voice_index, *self.sends.values()]:
+            column.flags.writeable = False
+        
+        try:
+            voices = hash(tuple(self.voices))
+        except TypeError:
+            # parameters that can't be hashed are identified by identity
+            voices = hash(tuple(voice_key(v) for v in self.voices))
+        
+        self._hash = hash((
+            self.times.tobytes(), 
+            self.gains.tobytes(), 
+            self.voice_index.tobytes(), 
+            voices,
+            tuple(sorted((name, levels.tobytes()) for name, levels in self.sends.items()))))
+    
+    def __reduce__(self):
+        return (
+            EventTable, 
+            (self.times, self.gains, self.voice_index, self.voices, self.sends))
+    
+    def __hash__(self) -> int:
+        return self._hash
+    
+    @staticmethod
+    def empty() -> 'EventTable':
+        return EventTable([], [], [], [])
+    
+    @staticmethod
+    def from_events(events: Iterable[Event]) -> 'EventTable':
+        events = list(events)
+        
+        voices: List[Voice] = []
+        keys: Dict[Hashable, int] = dict()
+        voice_index = np.zeros(len(events), dtype=np.int64)
+        sends: Dict[str, np.ndarray] = dict()
+        
+        for i, event in enumerate(events):
+            voice = Voice(event.synth, event.params)
+            key = voice_key(voice)
+            if key not in keys:
+                keys[key] = len(voices)
+                voices.append(voice)
+            voice_index[i] = keys[key]
+            
+            for name, level in event.sends.items():
+                sends.setdefault(name, np.zeros(len(events)))[i] = level
+        
+        return EventTable(
+            times=[e.time for e in events],
+            gains=[e.gain for e in events],
+            voice_index=voice_index,
+            voices=voices,
+            sends=sends)
+    
+    def __len__(self) -> int:
+        return len(self.times)
+    
+    def __getitem__(self, index: Union[int, slice]) -> Union[Event, List[Event]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        
+        synth, params = self.voices[self.voice_index[index]]
+        return Event(
+            time=float(self.times[index]),
+            gain=float(self.gains[index]),
+            synth=synth,
+            params=params,
+            sends={
+                name: float(levels[index]) 
+                for name, levels in self.sends.items() if levels[index]})
+    
+    def __iter__(self) -> Iterator[Event]:
+        for i in range(len(self)):
+            yield self[i]
+    
+    def __eq__(self, other: 'EventTable') -> bool:
+        if self is other:
+            return True
+        
+        if not isinstance(other, EventTable) or self._hash != other._hash:
+            return False
+        
+        return np.array_equal(self.times, other.times) \
+            and np.array_equal(self.gains, other.gains) \
+            and np.array_equal(self.voice_index, other.voice_index) \
+            and self.voices == other.voices \
+            and self.sends.keys() == other.sends.keys() \
+            and all(np.array_equal(v, other.sends[k]) for k, v in self.sends.items())
+    
+    def __repr__(self) -> str:
+        return f'EventTable(events={len(self)}, voices={len(self.voices)})'
+    
+    def _replace(self, **columns) -> 'EventTable':
+        d = dict(
+            times=self.times, 
+            gains=self.gains, 
+            voice_index=self.voice_index, 
+            voices=self.voices, 
+            sends=self.sends)
+        d.update(columns)
+        return EventTable(**d)
+    
+    def translate(self, amt: float) -> 'EventTable':
+        return self._replace(times=self.times + amt)
+    
+    def time_scale(self, factor: float) -> 'EventTable':
+        return self._replace(times=self.times * factor)
+    
+    def tile(self, offsets: np.ndarray) -> 'EventTable':
+        """
+        Repeat all events once for each offset, in order
+        """
+        offsets = np.asarray(offsets, dtype=np.float64)
+        n = len(offsets)
+        return self._replace(
+            times=(offsets[:, None] + self.times[None, :]).reshape(-1),
+            gains=np.tile(self.gains, n),
+            voice_index=np.tile(self.voice_index, n),
+            sends={name: np.tile(levels, n) for name, levels in self.sends.items()})
+    
+    def repeat(self, every: float, fur: float) -> 'EventTable':
+        return self.tile(np.arange(start=0, stop=fur, step=every))
+    
+    def concat(self, other: 'EventTable') -> 'EventTable':
+        """
+        Overlay two tables, merging voices the two have in common
+        """
+        voices = list(self.voices)
+        keys = {voice_key(v): i for i, v in enumerate(voices)}
+        
+        remap = np.zeros(len(other.voices), dtype=np.int64)
+        for i, voice in enumerate(other.voices):
+            key = voice_key(voice)
+            if key not in keys:
+                keys[key] = len(voices)
+                voices.append(voice)
+            remap[i] = keys[key]
+        
+        names = [*self.sends, *[n for n in other.sends if n not in self.sends]]
+        sends = {
+            name: np.concatenate([
+                self.sends.get(name, np.zeros(len(self))), 
+                other.sends.get(name, np.zeros(len(other)))])
+            for name in names
+        }
+        
+        return EventTable(
+            times=np.concatenate([self.times, other.times]),
+            gains=np.concatenate([self.gains, other.gains]),
+            voice_index=np.concatenate([self.voice_index, remap[other.voice_index]]),
+            voices=voices,
+            sends=sends)
+    
+    def fingerprint(self) -> str:
+        return digest([
+            [[synth_fingerprint(v.synth), fingerprint(v.params)] for v in self.voices],
+            array_digest(self.times),
+            array_digest(self.gains),
+            array_digest(self.voice_index),
+            {name: array_digest(levels) for name, levels in self.sends.items()}])
+    
+    def to_dict(self) -> dict:
+        d = dict(
+            times=self.times.tolist(),
+            gains=self.gains.tolist(),
+            voice_index=self.voice_index.tolist(),
+            voices=[
+                dict(synth=synth_identifier(v.synth), params=v.params.to_dict()) 
+                for v in self.voices])
+        
+        if self.sends:
+            d['sends'] = {name: levels.tolist() for name, levels in self.sends.items()}
+        
+        return d
+    
+    @staticmethod
+    def from_dict(data: dict, restore_voice: Callable[[Any, dict], Voice]) -> 'EventTable':
+        return EventTable(
+            times=data['times'],
+            gains=data['gains'],
+            voice_index=data['voice_index'],
+            voices=[restore_voice(v['synth'], v['params']) for v in data['voices']],
+            sends=data.get('sends', {}))
+
+
+def leaf_source_material(event: Union[Event, Voice]) -> Set[SourceMaterial]:
+    """
+    Source material required directly by this event or voice, excluding 
+    that of any nested events, which are visited separately by 
+    `SequencerParams.walk_voices`
+    """
+    if sub_pattern(event.params) is not None:
+        return set()
+    
+    source_material = getattr(event.params, 'source_material', None)
+    if source_material is not None:
+        return source_material
+    
+    if hasattr(event.params, 'url'):
+        return set([SourceMaterial(url=event.params.url)])
+    
+    return set()
+
+
+def repeat(every: float, fur: float, evt: Event) -> EventTable:
+    return EventTable.from_events([evt]).repeat(every, fur)
+
+def sub_pattern(params: Any) -> Optional['SequencerParams']:
+    """
+    The pattern nested within these parameters, if they are a pattern, or 
+    a loop of one, and `None` otherwise
+    """
+    if isinstance(params, SequencerParams):
+        return params
+    
+    if isinstance(params, Loop):
+        return params.pattern
+    
+    return None
+
+
+def nested_sequencer(event: Union[Event, Voice]) -> Optional['Sequencer']:
+    """
+    Return the sequencer responsible for rendering this event or voice if 
+    it is a nested pattern, e.g. one produced by `SequencerParams.once` or 
+    `SequencerParams.loop`, or `None` if it is a leaf
+    """
+    if sub_pattern(event.params) is None:
+        return None
+    
+    synth = event.synth
+    if isinstance(synth, Sequencer):
+        return synth
+    
+    owner = getattr(synth, '__self__', None)
+    if isinstance(owner, Sequencer) and getattr(synth, '__name__', None) == 'render':
+        return owner
+    
+    return None
 
-def repeat(every: float, fur: float, evt: Event) -> Sequence[Event]:
-    return [evt >> x for x in np.arange(start=0, stop=fur, step=every)]
 
 class TransformContext:
     pass
@@ -96,22 +452,50 @@ Transform = Callable[['SequencerParams', TransformContext], 'SequencerParams']
 
 
 
-@dataclass
-class SequencerParams(DictSerializable):
-    # TODO: how to handle circular/nested type definitions?
-    events: Sequence[Event]
+@dataclass(frozen=True, slots=True, eq=False)
+class SequencerParams(Immutable, DictSerializable):
+    """
+    An immutable pattern of events, stored as a columnar `EventTable`.  
+    Events may be provided either as a table, or as any iterable of `Event` 
+    instances.
+    
+    Transformations produce new patterns that share their unchanged parts, 
+    e.g. event parameters, with the original.
+    """
+    events: EventTable
     speed: float
     normalize: bool = True
-        
+    # named, shared reverb buses.  Each is convolved once with the sum of 
+    # the signals sent to it by the pattern's events, and the result is 
+    # mixed back in at the bus's `mix` level
+    buses: Dict[str, ReverbParameters] = field(default_factory=FrozenDict)
+    
+    def _freeze(self) -> None:
+        if not isinstance(self.events, EventTable):
+            object.__setattr__(self, 'events', EventTable.from_events(self.events))
+        object.__setattr__(self, 'buses', FrozenDict(self.buses))
+    
+    def _identity(self) -> Hashable:
+        return (self.speed, self.normalize, self.buses, self.events)
+    
+    @property
+    def table(self) -> EventTable:
+        return self.events
+    
+    def _replace(self, table: EventTable) -> 'SequencerParams':
+        return replace(self, events=table)
     
     @property
     def source_material(self) -> Set[SourceMaterial]:
+        voices = list(self.walk_voices())
+        leaves = chain.from_iterable(leaf_source_material(v) for v in voices)
         
-        def has_url(event: Event):
-            return hasattr(event.params, 'url')
+        nested = [sub_pattern(v.params) for v in voices if sub_pattern(v.params) is not None]
+        buses = [
+            SourceMaterial(url=bus.url) 
+            for p in [self, *nested] for bus in p.buses.values()]
         
-        sampler_params = filter(has_url, self.walk())
-        return set(SourceMaterial(url=x.params.url) for x in sampler_params)
+        return set([*leaves, *buses])
     
     def walk(self):
         
@@ -137,9 +521,44 @@ class SequencerParams(DictSerializable):
                 
 
             yield nxt
+    
+    def walk_voices(self) -> Iterator[Voice]:
+        """
+        Yield the unique voices of this pattern and of every nested pattern,
+        visiting each nested pattern's table once per voice that refers to 
+        it, rather than once per event
+        """
+        to_walk = [*self.table.voices]
+        
+        while to_walk:
+            voice = to_walk.pop()
+            
+            nested = sub_pattern(voice.params)
+            if nested is not None:
+                to_walk.extend(nested.table.voices)
+            
+            yield voice
         
     def once(self, synth: 'Sequencer') -> 'Event':
-        return Event(gain=1, time=0, synth=synth.render, params=deepcopy(self))
+        return Event(gain=1, time=0, synth=synth.render, params=self)
+    
+    def loop(
+            self, 
+            synth: 'Sequencer', 
+            period: float, 
+            count: Optional[int] = None, 
+            duration: Optional[float] = None) -> 'Event':
+        """
+        An event that plays this pattern every `period` beats, either 
+        `count` times, or for `duration` beats, without expanding its 
+        events.  Beats are at this pattern's speed, rather than that of the
+        pattern the event is placed in.
+        """
+        return Event(
+            gain=1, 
+            time=0, 
+            synth=synth.render, 
+            params=Loop(pattern=self, period=period, count=count, duration=duration))
     
 
     def __radd__(self, other: 'SequencerParams') -> 'SequencerParams':
@@ -150,19 +569,23 @@ class SequencerParams(DictSerializable):
         Overlay two patterns
         """
         return SequencerParams(
-            events=[*self.events, *other.events], 
+            events=self.table.concat(other.table), 
             speed=self.speed, 
-            normalize=self.normalize)
+            normalize=self.normalize,
+            buses={**other.buses, **self.buses})
     
     def time_scale(self, factor: float) -> 'SequencerParams':
-        c = deepcopy(self)
-        c.events = [e.time_scale(factor) for e in c.events]
-        return c
+        return self._replace(self.table.time_scale(factor))
     
     def translate(self, amt: float) -> 'SequencerParams':
-        c = deepcopy(self)
-        c.events = [e.translate(amt) for e in c.events]
-        return c
+        return self._replace(self.table.translate(amt))
+    
+    def repeat(self, every: float, fur: float) -> 'SequencerParams':
+        """
+        Repeat all of the pattern's events every `every` beats, until `fur`
+        beats have elapsed
+        """
+        return self._replace(self.table.repeat(every, fur))
     
     def __lshift__(self, other: float) -> 'SequencerParams':
         return self.translate(-other)
@@ -171,30 +594,487 @@ class SequencerParams(DictSerializable):
         return self.translate(other)
         
     def transform(self, t: Transform) -> 'SequencerParams':
-        c = deepcopy(self)
         ctxt = TransformContext()
-        transformed = t(c, ctxt)
+        transformed = t(self, ctxt)
         return transformed
     
+    def fingerprint(self) -> str:
+        """
+        Stable digest of the pattern's content, identical for any two 
+        patterns that will produce identical renders
+        """
+        return digest([
+            'sequencer', 
+            self.speed, 
+            self.normalize, 
+            self.table.fingerprint(),
+            {name: bus.to_dict() for name, bus in self.buses.items()}])
+    
     @staticmethod
     def from_dict(data: dict, restore_func: Callable, restore_synth: Callable) -> 'SequencerParams':
+        """
+        Restore a pattern from its dictionary representation, in either the
+        columnar format produced by `to_dict`, or as a list of events
+        """
+        
+        # restore each synth once, so that voices sharing a synth and equal
+        # parameters are stored only once
+        synths = dict()
+        
+        def restore_voice(synth_name_or_id: Any, params: dict) -> Voice:
+            if synth_name_or_id not in synths:
+                synths[synth_name_or_id] = restore_synth(synth_name_or_id)
+            synth = synths[synth_name_or_id]
+            if isinstance(synth, Sequencer) and 'pattern' in params:
+                return Voice(synth, Loop.from_dict(params, restore_func, restore_synth))
+            if isinstance(synth, Sequencer):
+                return Voice(
+                    synth, SequencerParams.from_dict(params, restore_func, restore_synth))
+            return Voice(synth, restore_func(synth_name_or_id, params))
+        
+        events = data['events']
+        if isinstance(events, dict):
+            table = EventTable.from_dict(events, restore_voice)
+        else:
+            table = EventTable.from_events(
+                Event.from_dict(
+                    x, 
+                    lambda synth, params: restore_voice(synth, params).params, 
+                    # restored along with the event's params, above
+                    lambda synth: synths[synth]) 
+                for x in events)
+        
         return SequencerParams(
-            events=[Event.from_dict(x, restore_func, restore_synth) for x in data['events']],
+            events=table,
             speed=data.get('speed', None),
-            normalize=data.get('normalize', None)
+            normalize=data.get('normalize', None),
+            buses={
+                name: ReverbParameters.from_dict(bus) 
+                for name, bus in data.get('buses', {}).items()}
         )
 
     def to_dict(self) -> dict:
-        return dict(
+        d = dict(
             speed=self.speed, 
             normalize=self.normalize, 
-            events=[e.to_dict() for e in self.events])
+            events=self.table.to_dict())
+        
+        if self.buses:
+            d['buses'] = {name: bus.to_dict() for name, bus in self.buses.items()}
+        
+        return d
+
+
+allowed_mixing_modes = set([
+    'auto', 'direct', 'impulse'
+])
+
+
+def get_mixing_mode(name: str) -> str:
+    if name not in allowed_mixing_modes:
+        raise ValueError(f'{name} is not an allowed mixing mode')
+    return name
+
+
+# the approximate cost of adding an event's render directly into the 
+# canvas, per sample, in units of the cost of an FFT of size n, per 
+# n * log2(n), along with the fixed overhead of each add, in samples
+impulse_train_cost_factor = 2
+direct_add_overhead = 2000
+
+
+def direct_mix_cost(count: int, length: int) -> float:
+    return count * (length + direct_add_overhead)
+
+
+def impulse_train_mix_cost(span: int, length: int) -> float:
+    n_fft = convolution_size(span, length)
+    return impulse_train_cost_factor * n_fft * np.log2(n_fft)
+
+
+def impulse_train(onsets: np.ndarray, weights: np.ndarray, length: int) -> np.ndarray:
+    """
+    A signal of the given length that is zero everywhere, except at each
+    onset, where it is the sum of the weights of events starting there
+    """
+    train = np.zeros((length,))
+    np.add.at(train, onsets, weights)
+    return train
+
+
+def impulse_train_mix(
+        render: np.ndarray, 
+        onsets: np.ndarray, 
+        weights: Sequence[np.ndarray]) -> Sequence[np.ndarray]:
+    """
+    Mix copies of `render` starting at each onset, scaled by each event's 
+    weight, by convolving it with an impulse train, rather than adding 
+    each copy separately.  Each set of weights produces one mix, starting 
+    at the earliest onset, and the render's spectrum is computed only once.
+    """
+    first = onsets.min()
+    span = onsets.max() - first + 1
+    n_fft = convolution_size(span, len(render))
+    spectrum = np.fft.rfft(render, n=n_fft)
+    
+    return [
+        convolve_spectrum(impulse_train(onsets - first, w, span), spectrum, len(render), n_fft)
+        for w in weights
+    ]
+
+
+@dataclass(frozen=True, slots=True, eq=False)
+class Loop(Immutable, DictSerializable):
+    """
+    A pattern repeated every `period` beats, either `count` times, or as 
+    many times as begin within `duration` beats, without expanding its 
+    events.  The pattern is rendered once and tiled, with the tail of each
+    repetition overlapping those that follow, so that the cost of a loop's
+    render doesn't depend on its length.
+    
+    A loop is rendered without knowing which pattern, if any, encloses it,
+    so `period` and `duration` are beats at the looped pattern's own 
+    speed.  A loop sounds like `pattern.repeat(period, ...)`, but only 
+    like repetitions placed with `once()` in an enclosing pattern when 
+    both patterns share a speed.
+    """
+    pattern: SequencerParams
+    period: float
+    count: Optional[int] = None
+    duration: Optional[float] = None
+    
+    def _freeze(self) -> None:
+        if (self.count is None) == (self.duration is None):
+            raise ValueError('Exactly one of count or duration must be provided')
+        
+        if self.period <= 0:
+            raise ValueError(f'period must be positive but was {self.period}')
+        
+        if self.repetitions < 1:
+            raise ValueError('A loop must repeat its pattern at least once')
+    
+    @property
+    def repetitions(self) -> int:
+        if self.count is not None:
+            return self.count
+        return int(np.ceil(self.duration / self.period))
+    
+    @property
+    def source_material(self) -> Set[SourceMaterial]:
+        return self.pattern.source_material
+    
+    def fingerprint(self) -> str:
+        return digest([
+            'loop', self.period, self.count, self.duration, self.pattern.fingerprint()])
+    
+    def to_dict(self) -> dict:
+        d = dict(
+            pattern=self.pattern.to_dict(),
+            period=self.period, 
+            count=self.count, 
+            duration=self.duration)
+        return {k: v for k, v in d.items() if v is not None}
+    
+    @staticmethod
+    def from_dict(data: dict, restore_func: Callable, restore_synth: Callable) -> 'Loop':
+        return Loop(
+            pattern=SequencerParams.from_dict(data['pattern'], restore_func, restore_synth),
+            period=data['period'],
+            count=data.get('count', None),
+            duration=data.get('duration', None))
+
+
+@dataclass
+class FlatPattern(object):
+    """
+    Events with absolute start positions, in samples, and gains, e.g. a tree
+    of nested patterns compiled into a single list of leaf events
+    """
+    starts: np.ndarray
+    gains: np.ndarray
+    voice_index: np.ndarray
+    voices: List[Voice]
+    sends: Dict[str, np.ndarray]
+    
+    def __len__(self) -> int:
+        return len(self.starts)
+    
+    def select(self, mask: np.ndarray) -> 'FlatPattern':
+        return FlatPattern(
+            starts=self.starts[mask],
+            gains=self.gains[mask],
+            voice_index=self.voice_index[mask],
+            voices=self.voices,
+            sends={name: levels[mask] for name, levels in self.sends.items()})
+    
+    def scale(self, factor: float) -> 'FlatPattern':
+        return replace(self, gains=self.gains * factor)
+    
+    def place(self, starts: np.ndarray, gains: np.ndarray) -> 'FlatPattern':
+        """
+        Play all events once for each start position and gain, e.g. for each
+        event of a parent pattern that plays this one
+        """
+        n = len(starts)
+        return FlatPattern(
+            starts=(starts[:, None] + self.starts[None, :]).reshape(-1),
+            gains=(gains[:, None] * self.gains[None, :]).reshape(-1),
+            voice_index=np.tile(self.voice_index, n),
+            voices=self.voices,
+            sends={})
+    
+    def concat(self, other: 'FlatPattern') -> 'FlatPattern':
+        """
+        Combine two sets of events, merging the voices they have in common
+        """
+        voices = list(self.voices)
+        keys = {voice_key(v): i for i, v in enumerate(voices)}
+        
+        remap = np.zeros(len(other.voices), dtype=np.int64)
+        for i, voice in enumerate(other.voices):
+            key = voice_key(voice)
+            if key not in keys:
+                keys[key] = len(voices)
+                voices.append(voice)
+            remap[i] = keys[key]
+        
+        names = [*self.sends, *[n for n in other.sends if n not in self.sends]]
+        
+        return FlatPattern(
+            starts=np.concatenate([self.starts, other.starts]),
+            gains=np.concatenate([self.gains, other.gains]),
+            voice_index=np.concatenate([self.voice_index, remap[other.voice_index]]),
+            voices=voices,
+            sends={
+                name: np.concatenate([
+                    self.sends.get(name, np.zeros(len(self))), 
+                    other.sends.get(name, np.zeros(len(other)))])
+                for name in names
+            })
+    
+    def compact(self) -> 'FlatPattern':
+        """
+        Drop voices that no event refers to, e.g. nested patterns that have
+        been flattened
+        """
+        used = np.unique(self.voice_index)
+        remap = np.zeros(len(self.voices), dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        
+        return replace(
+            self, 
+            voice_index=remap[self.voice_index], 
+            voices=[self.voices[i] for i in used.tolist()])
+
+
+@dataclass
+class RenderPlan(object):
+    """
+    The estimated cost of rendering a pattern, found without rendering or 
+    fetching anything.
+    
+    Lengths, and so the duration, memory and cost, are upper bounds.  Those
+    of leaves whose length depends on audio that hasn't been fetched yet 
+    are unknown, in which case `duration_seconds` is `None`, and they are 
+    left out of `peak_bytes` and `cost`.
+    """
+    duration_seconds: Optional[float]
+    
+    # rows in the event tables of every unique pattern in the tree
+    events: int
+    depth: int
+    
+    # unique leaf renders, and how many of those are already cached, either
+    # themselves, or as part of a cached nested pattern
+    leaf_renders: int
+    cached_renders: int
+    unknown_lengths: int
+    
+    urls: Set[str]
+    cached_urls: Set[str]
+    
+    # the bytes of every render and canvas, if none are evicted, and the 
+    # number of samples rendered, mixed or convolved, a relative measure of 
+    # CPU cost
+    peak_bytes: int
+    cost: int
+    
+    @property
+    def uncached_urls(self) -> Set[str]:
+        return self.urls - self.cached_urls
+
+
+class EventIndex(object):
+    """
+    Events sorted by their start positions, along with an upper bound on 
+    each one's end, so that those overlapping a span of time can be found 
+    by binary search.
+    
+    Events marked `unbounded` have no known end, e.g. samples whose audio
+    hasn't been fetched yet, and may sound at any time after they start.
+    """
+    
+    def __init__(
+            self, 
+            starts: np.ndarray, 
+            ends: np.ndarray, 
+            unbounded: Optional[np.ndarray] = None):
+        
+        super().__init__()
+        self.order = np.argsort(starts, kind='stable')
+        self.starts = starts[self.order]
+        self.unbounded = np.zeros(len(starts), dtype=bool) \
+            if unbounded is None else np.asarray(unbounded, dtype=bool)[self.order]
+        self.ends = np.where(self.unbounded, np.iinfo(np.int64).max, ends[self.order])
+        self.max_length = int(np.max(
+            (self.ends - self.starts)[~self.unbounded], initial=0))
+    
+    @property
+    def nbytes(self) -> int:
+        return self.order.nbytes + self.starts.nbytes + self.ends.nbytes + self.unbounded.nbytes
+    
+    @property
+    def end(self) -> Optional[int]:
+        if np.any(self.unbounded):
+            return None
+        return int(np.max(self.ends, initial=0))
+    
+    def overlapping(self, start: int, end: int) -> np.ndarray:
+        """
+        The positions, in the original order, of events that may sound
+        within `[start, end)`
+        """
+        # no bounded event starting before `start - max_length` can reach 
+        # `start`
+        first = np.searchsorted(self.starts, start - self.max_length, side='right')
+        last = np.searchsorted(self.starts, end, side='left')
+        candidates = np.arange(first, last)
+        candidates = np.concatenate([
+            np.flatnonzero(self.unbounded[:first]), 
+            candidates[self.ends[candidates] > start]])
+        return np.sort(self.order[candidates])
+
+
+class StreamedRender(object):
+    """
+    A render produced block by block, and read in order, holding only the
+    samples that haven't been read yet
+    """
+    
+    def __init__(self, blocks: Iterator[np.ndarray]):
+        super().__init__()
+        self._blocks = blocks
+        self._buffer = np.zeros((0,), dtype=np.float32)
+        self._offset = 0
+        self.complete = False
+    
+    def __len__(self) -> int:
+        # the render's length once complete, and otherwise the number of 
+        # samples produced so far
+        return self._offset + len(self._buffer)
+    
+    def fill(self, end: int) -> None:
+        """
+        Produce blocks until at least `end` samples have been produced, or
+        the render is complete
+        """
+        produced = [self._buffer]
+        available = len(self)
+        
+        while not self.complete and available < end:
+            block = next(self._blocks, None)
+            if block is None:
+                self.complete = True
+            else:
+                produced.append(block)
+                available += len(block)
+        
+        if len(produced) > 1:
+            self._buffer = np.concatenate(produced)
+    
+    def __getitem__(self, index: slice) -> np.ndarray:
+        # reads never go backwards, so everything before this one is released
+        self._buffer = self._buffer[index.start - self._offset:]
+        self._offset = index.start
+        return self._buffer[:index.stop - index.start]
+
+
+def window(samples: np.ndarray, start: int, end: Optional[int]) -> np.ndarray:
+    """
+    Samples in `[start, end)`, where those past the end are silent
+    """
+    if end is None:
+        return samples[start:]
+    
+    result = samples[start: end]
+    return ensure_length(result, end - start) if len(result) < end - start else result
+
+
+def max_render_length(synth: Any, params: Any) -> Optional[int]:
+    """
+    An upper bound on the length of a render, if its synth can estimate one
+    without rendering
+    """
+    owner = getattr(synth, '__self__', synth)
+    estimate = getattr(owner, 'max_render_length', None)
+    return None if estimate is None else estimate(params)
+
+
+# nested patterns' peaks are found by streaming their mix in blocks of this
+# size, rather than allocating a canvas for each
+peak_block_size = 2 ** 14
+
+
+# mixed patterns are keyed by (fingerprint, samplerate) in a cache shared
+# by all sequencers that aren't given one explicitly
+default_render_cache = default_cache('renders')
 
 
 class Sequencer(BaseSynth):
-    def __init__(self, samplerate: int):
+    """
+    Mixes the renders of a pattern's events into a single canvas.
+    
+    By default, events are rendered serially.  If a `RenderScheduler` is 
+    provided, the whole tree of nested patterns is rendered by it instead, 
+    producing identical output.
+    
+    Mixed patterns, including nested sub-patterns, are cached by their
+    content fingerprint, so repeated or unchanged sub-patterns cost only 
+    a lookup.  Caching can be disabled by providing a cache with a budget 
+    of zero bytes.
+    
+    A fetcher is required to render patterns that declare reverb buses, 
+    in order to fetch their impulse responses.
+    
+    `mixing` determines how events sharing a synth and parameters are 
+    mixed.  `direct` adds each event's render into the canvas separately,
+    while `impulse` convolves the shared render, once, with an impulse 
+    train of the events' onsets and gains, whose cost depends only on the 
+    span of time the events cover.  `auto` chooses, for each group, 
+    whichever is estimated to be cheaper, so that dense patterns, e.g. 
+    granular clouds, mix in roughly constant time per group.
+    
+    When `flatten_nested` is true, nested patterns are compiled into a 
+    single list of leaf events (see `flatten`) and mixed directly into 
+    the output, rather than each being mixed into its own canvas first.
+    """
+    def __init__(
+            self, 
+            samplerate: int, 
+            scheduler: 'RenderScheduler' = None,
+            render_cache: Optional[MemoryCache] = None,
+            fetcher: Optional[AudioFetcher] = None,
+            mixing: str = 'auto',
+            flatten_nested: bool = False):
+        
         super().__init__()
         self._samplerate = samplerate
+        self.scheduler = scheduler
+        self.fetcher = fetcher
+        self.mixing = get_mixing_mode(mixing)
+        self.flatten_nested = flatten_nested
+        self.render_cache = \
+            default_render_cache if render_cache is None else render_cache
     
     @property
     def name(self) -> str:
@@ -203,7 +1083,7 @@ class Sequencer(BaseSynth):
     def __eq__(self, other: 'Sequencer'):
         return self.id == other.id
     
-    def hash(self):
+    def __hash__(self):
         return hash(self.id)
 
     @property
@@ -217,37 +1097,998 @@ class Sequencer(BaseSynth):
     def _calculate_time(self, event_time: float, speed: float):
         return event_time / speed
     
+    def _start_samples(self, params: SequencerParams) -> np.ndarray:
+        start_samples = (self._calculate_time(params.table.times, params.speed) \
+            * self.samplerate).astype(np.int64)
+        if np.any(start_samples < 0):
+            raise ValueError('Negative samples not supported')
+        return start_samples
     
-    def render(self, params: SequencerParams) -> np.ndarray:
+    @staticmethod
+    def _prefetch(sources: Iterable[tuple]) -> None:
+        """
+        Fetch `(fetcher, urls)` pairs in parallel, grouped by fetcher
+        """
+        by_fetcher = dict()
+        
+        for fetcher, urls in sources:
+            if fetcher is None or not hasattr(fetcher, 'prefetch'):
+                continue
+            _, pending = by_fetcher.setdefault(id(fetcher), (fetcher, set()))
+            pending.update(urls)
+        
+        for fetcher, urls in by_fetcher.values():
+            fetcher.prefetch(urls)
+    
+    @staticmethod
+    def _leaf_sources(voice: Voice) -> tuple:
+        return (
+            getattr(voice.synth, 'fetcher', None), 
+            [sm.url for sm in leaf_source_material(voice)])
+    
+    def prefetch(self, params: Union[SequencerParams, Loop]) -> None:
+        """
+        Fetch all source material for the pattern in parallel, grouped by
+        the fetcher belonging to each event's synth
+        """
+        params = sub_pattern(params)
+        sources = [(self.fetcher, [bus.url for bus in params.buses.values()])]
+        
+        for voice in params.walk_voices():
+            nested = nested_sequencer(voice)
+            if nested is None:
+                sources.append(self._leaf_sources(voice))
+            else:
+                sources.append((
+                    nested.fetcher, 
+                    [bus.url for bus in sub_pattern(voice.params).buses.values()]))
+        
+        self._prefetch(sources)
+    
+    def cache_key(self, params: SequencerParams) -> Optional[tuple]:
+        """
+        The key under which the pattern's mix is cached, or `None` if any of
+        its synths has no stable identity, e.g. a closure, in which case it
+        isn't cached at all
+        """
+        try:
+            return (params.fingerprint(), self.samplerate)
+        except UnstableIdentity:
+            return None
+    
+    def _cached(self, kind: str, params: SequencerParams) -> Any:
+        key = self.cache_key(params)
+        return None if key is None else self.render_cache.get((kind, *key))
+    
+    def _cache(self, kind: str, params: SequencerParams, value: Any) -> Any:
+        key = self.cache_key(params)
+        if key is not None:
+            self.render_cache.put((kind, *key), value)
+        return value
+    
+    def cached(self, params: SequencerParams) -> Optional[np.ndarray]:
+        key = self.cache_key(params)
+        return None if key is None else self.render_cache.get(key)
+    
+    def cache(self, params: SequencerParams, canvas: np.ndarray) -> np.ndarray:
+        """
+        Store the pattern's render, if it can be cached.  Stored canvases 
+        are shared by every later caller, so they're made read-only, while
+        those that aren't stored, e.g. because the pattern has no stable 
+        identity, or the canvas exceeds the cache's budget, are returned 
+        unchanged
+        """
+        key = self.cache_key(params)
+        if key is None or self.render_cache.sizeof(canvas) > self.render_cache.max_bytes:
+            return canvas
+        
+        canvas.flags.writeable = False
+        self.render_cache.put(key, canvas)
+        return canvas
+    
+    def _loop_starts(self, loop: Loop) -> np.ndarray:
+        # periods are beats of the looped pattern, the only speed known here
+        period = self._calculate_time(loop.period, loop.pattern.speed) * self.samplerate
+        
+        # positions are rounded individually, rather than accumulated, so 
+        # that long loops don't drift
+        return (np.arange(loop.repetitions) * period).astype(np.int64)
+    
+    def tile(self, loop: Loop, render: np.ndarray) -> np.ndarray:
+        """
+        Overlap-add a loop's repetitions, given a single render of its 
+        pattern
+        """
+        starts = self._loop_starts(loop)
+        record_duration((starts[-1] + len(render)) / self.samplerate)
+        canvas = np.zeros((starts[-1] + len(render),), dtype=np.float32)
+        
+        if self._use_impulse_train(len(starts), int(starts[-1]) + 1, len(render)):
+            mixed, = impulse_train_mix(render, starts, [np.ones(len(starts))])
+            canvas += mixed
+        else:
+            for start in starts.tolist():
+                checkpoint()
+                canvas[start: start + len(render)] += render
+        
+        return canvas
+    
+    def _index(self, params: SequencerParams) -> EventIndex:
+        index = self._cached('index', params)
+        if index is not None:
+            return index
+        
+        # nothing is fetched or rendered, so voices whose length can't be 
+        # estimated, e.g. those whose audio hasn't been fetched yet, are 
+        # unbounded
+        lengths = [max_render_length(synth, p) for synth, p in params.table.voices]
+        unknown = np.array([length is None for length in lengths], dtype=bool)
+        lengths = np.array([length or 0 for length in lengths], dtype=np.int64)
+        
+        voice_index = params.table.voice_index
+        starts = self._start_samples(params)
+        index = EventIndex(starts, starts + lengths[voice_index], unknown[voice_index])
+        
+        # unknown lengths may be known once audio is fetched, so only 
+        # complete indices are cached
+        return index if np.any(unknown) else self._cache('index', params, index)
+    
+    def _tail(self, buses: Dict[str, ReverbParameters]) -> int:
+        return max(
+            [len(impulse_response(self.fetcher, bus)) - 1 for bus in buses.values()], 
+            default=0)
+    
+    def max_render_length(self, params: Union[SequencerParams, Loop]) -> Optional[int]:
+        """
+        An upper bound on the length of the pattern's render, or `None` if 
+        it depends on audio that hasn't been fetched yet
+        """
+        cached = self.cached(params)
+        if cached is not None:
+            return len(cached)
+        
+        if isinstance(params, Loop):
+            length = self.max_render_length(params.pattern)
+            return None if length is None else int(self._loop_starts(params)[-1]) + length
+        
+        end = self._index(params).end
+        return None if end is None else end + self._tail(self._active_buses(params))
+    
+    def plan(self, params: Union[SequencerParams, Loop]) -> RenderPlan:
+        """
+        Estimate the cost of rendering the pattern, e.g. for admission 
+        control or scheduling, by walking the tree without rendering or 
+        fetching anything
+        """
+        leaves: Dict[Hashable, Optional[int]] = dict()
+        cached_leaves: Set[Hashable] = set()
+        fetchers = dict()
+        visited: Dict[Hashable, tuple] = dict()
+        totals = dict(events=0, bytes=0, cost=0)
+        
+        def tail(seq: Sequencer, buses: Dict[str, ReverbParameters]) -> Optional[int]:
+            lengths = [seq.fetcher.peek(bus.url) for bus in buses.values()]
+            if any(ir is None for ir in lengths):
+                return None
+            return max([len(ir) - 1 for ir in lengths], default=0)
+        
+        def visit(seq: Sequencer, p: Union[SequencerParams, Loop], cached: bool) -> tuple:
+            """
+            The length of the pattern's render, if known, and its depth
+            """
+            key = (id(seq), id(p), cached)
+            if key in visited:
+                return visited[key]
+            
+            if seq.fetcher is not None:
+                fetchers[id(seq.fetcher)] = seq.fetcher
+            
+            cache_key = seq.cache_key(p)
+            render = None if cache_key is None else seq.render_cache.peek(cache_key)
+            cached = cached or render is not None
+            
+            if isinstance(p, Loop):
+                length, depth = visit(seq, p.pattern, cached)
+                if length is not None:
+                    last = int(seq._loop_starts(p)[-1])
+                    if not cached:
+                        totals['bytes'] += (last + length) * 4
+                        totals['cost'] += p.repetitions * length
+                    length += last
+                visited[key] = (length, depth)
+                return visited[key]
+            
+            totals['events'] += len(p.table)
+            depth = 0
+            lengths = []
+            
+            for voice in p.table.voices:
+                nested = nested_sequencer(voice)
+                if nested is not None:
+                    length, d = visit(nested, voice.params, cached)
+                    depth = max(depth, d + 1)
+                else:
+                    owner = getattr(voice.synth, '__self__', voice.synth)
+                    fetcher = getattr(owner, 'fetcher', None)
+                    if fetcher is not None:
+                        fetchers[id(fetcher)] = fetcher
+                    
+                    length = max_render_length(*voice)
+                    
+                    leaf = voice_key(voice)
+                    leaves[leaf] = length
+                    is_cached = getattr(owner, 'is_cached', None)
+                    if cached or (is_cached is not None and is_cached(voice.params)):
+                        cached_leaves.add(leaf)
+                    elif length is not None:
+                        totals['bytes'] += length * 8
+                        totals['cost'] += length
+                
+                lengths.append(length)
+            
+            buses = seq._active_buses(p)
+            bus_tail = tail(seq, buses)
+            
+            if any(length is None for length in lengths) or bus_tail is None:
+                length = None
+            elif render is not None:
+                length = len(render)
+            else:
+                ends = seq._start_samples(p) + np.array(lengths, dtype=np.int64)[p.table.voice_index]
+                length = int(np.max(ends, initial=0)) + (bus_tail if buses else 0)
+                
+                if not cached:
+                    mixed = int(np.sum(np.array(lengths, dtype=np.int64)[p.table.voice_index]))
+                    totals['bytes'] += length * 4 + len(buses) * length * 8
+                    totals['cost'] += mixed + len(buses) * length
+            
+            visited[key] = (length, depth)
+            return visited[key]
+        
+        length, depth = visit(self, params, False)
+        urls = set(sm.url for sm in params.source_material)
+        
+        return RenderPlan(
+            duration_seconds=None if length is None else length / self.samplerate,
+            events=totals['events'],
+            depth=depth,
+            leaf_renders=len(leaves),
+            cached_renders=len(cached_leaves),
+            unknown_lengths=sum(1 for length in leaves.values() if length is None),
+            urls=urls,
+            cached_urls=set(
+                url for url in urls 
+                if any(f.peek(url) is not None for f in fetchers.values())),
+            peak_bytes=totals['bytes'],
+            cost=totals['cost'])
+    
+    def _peak(self, params: SequencerParams, flat: Optional[FlatPattern] = None) -> float:
+        """
+        The peak of the pattern's un-normalized mix, found by streaming it, 
+        and cached by the pattern's fingerprint
+        """
+        peak = self._cached('peak', params)
+        if peak is None:
+            peak = self._cache('peak', params, max(
+                block.max() for block in self._iter_blocks(params, peak_block_size, flat)))
+        return peak
+    
+    def _loop_window(self, loop: Loop, start: int, end: Optional[int]) -> np.ndarray:
+        render = self.render(loop.pattern)
+        starts = self._loop_starts(loop)
+        
+        if end is None:
+            end = max(start, int(starts[-1]) + len(render))
+        
+        canvas = np.zeros((end - start,), dtype=np.float32)
+        first = np.searchsorted(starts, start - len(render), side='right')
+        last = np.searchsorted(starts, end, side='left')
+        
+        for offset in starts[first: last].tolist():
+            lo = max(start, offset)
+            hi = min(end, offset + len(render))
+            canvas[lo - start: hi - start] += render[lo - offset: hi - offset]
+        
+        return canvas
+    
+    def _render_window(
+            self, 
+            params: Union[SequencerParams, Loop], 
+            start: int, 
+            end: Optional[int]) -> np.ndarray:
+        
+        cached = self.cached(params)
+        if cached is not None:
+            return window(cached, start, end)
+        
+        if isinstance(params, Loop):
+            return self._loop_window(params, start, end)
+        
+        if params.normalize and self._cached('peak', params) is None:
+            # the whole pattern is mixed to find its peak, so all of it is 
+            # fetched, in parallel, up front
+            self.prefetch(params)
+        
+        buses = self._active_buses(params)
+        tail = self._tail(buses)
+        
+        # signals sent to a bus ring on for the length of its impulse
+        # response, so events that end shortly before the window still 
+        # contribute to it
+        reach = max(0, start - tail)
+        members = self._index(params).overlapping(
+            reach, np.iinfo(np.int64).max if end is None else end)
+        
+        table = params.table
+        starts = self._start_samples(params)
+        renders: Dict[int, np.ndarray] = dict()
+        segments = []
+        
+        # only the source material of events within the window is fetched,
+        # while nested patterns fetch their own
+        voices = [table.voices[v] for v in np.unique(table.voice_index[members]).tolist()]
+        self._prefetch(
+            self._leaf_sources(voice) for voice in voices if nested_sequencer(voice) is None)
+        
+        for i in members.tolist():
+            checkpoint()
+            position = int(starts[i])
+            voice = int(table.voice_index[i])
+            offset = max(0, reach - position)
+            stop = None if end is None else end - position
+            
+            nested = nested_sequencer(table.voices[voice])
+            if nested is not None and nested.samplerate == self.samplerate:
+                segment = nested._render_window(table.voices[voice].params, offset, stop)
+            else:
+                if voice not in renders:
+                    synth, voice_params = table.voices[voice]
+                    renders[voice] = synth(voice_params)
+                segment = renders[voice][offset: stop]
+            
+            segments.append((i, position + offset, segment))
+        
+        if end is None:
+            end = max(
+                [position + len(segment) + (tail if buses else 0) for _, position, segment in segments], 
+                default=start)
+            end = max(start, end)
+        
+        canvas = np.zeros((end - start,), dtype=np.float32)
+        sends = {name: np.zeros((end - reach,)) for name in buses}
+        
+        for i, position, segment in segments:
+            contribution = segment * table.gains[i]
+            
+            lo = max(start, position)
+            hi = min(end, position + len(segment))
+            if lo < hi:
+                canvas[lo - start: hi - start] += contribution[lo - position: hi - position]
+            
+            for name in sends:
+                level = table.sends[name][i]
+                if level:
+                    hi = min(end, position + len(segment))
+                    sends[name][position - reach: hi - reach] += \
+                        contribution[:hi - position] * level
+        
+        for name, bus in buses.items():
+            wet = convolve_impulse_response(sends[name], bus, self.fetcher)
+            canvas += wet[start - reach: end - reach] * self._bus_gain(bus)
+        
+        if params.normalize:
+            canvas = canvas / (self._peak(params) + 1e-8)
+        
+        return canvas
+    
+    def render(
+            self, 
+            params: Union[SequencerParams, Loop], 
+            start: Optional[float] = None, 
+            end: Optional[float] = None,
+            token: Optional[CancellationToken] = None) -> np.ndarray:
+        """
+        Render the pattern, or only the span between `start` and `end`, in
+        seconds, if either is given.
+        
+        Renders held in, or served from, the render cache are shared, and 
+        so are read-only.  Callers that modify the samples in place must 
+        copy them first.
+        
+        If a `token` is given, rendering stops between events and blocks 
+        once it's cancelled or its deadline passes, raising 
+        `RenderCancelled`, and anything cached along the way is removed.
+        
+        Windows are rendered, and their source material fetched, from only 
+        the events that sound within them, found using an index of each 
+        event's span, so their cost is proportional to the window, rather 
+        than to the whole pattern.  Events whose length can't be estimated
+        without fetching, e.g. samples with no duration, are assumed to 
+        sound until the window.  Samples past the end of the pattern are 
+        silent.
+        
+        Normalizing a window requires the peak of the whole pattern, so the
+        first normalized window of a pattern fetches all of it and streams 
+        its mix.  The peak is then cached, and later windows cost only their
+        own events.
+        """
         # self.validate(params)
         
-        renders: Sequence[np.ndarray] = [event.synth(event.params) * event.gain for event in params.events]
+        if token is not None:
+            with cancellable(token):
+                return self.render(params, start, end)
+        
+        if start is not None or end is not None:
+            start = start or 0
+            if start < 0 or (end is not None and end < start):
+                raise ValueError(f'Invalid window from {start} to {end}')
+            
+            return self._render_window(
+                params, 
+                int(start * self.samplerate), 
+                None if end is None else int(end * self.samplerate))
+        
+        cached = self.cached(params)
+        if cached is not None:
+            return cached
+        
+        if self.scheduler is not None:
+            return self.scheduler.render(self, params)
+        
+        if isinstance(params, Loop):
+            return self.cache(params, self.tile(params, self.render(params.pattern)))
+        
+        self.prefetch(params)
+        
+        flat = self._compiled(params)
         
-        end_times = [
-            self._calculate_time(event.time, params.speed) + len(renders[i]) / self.samplerate 
-            for i, event in enumerate(params.events)
+        # each unique voice is rendered only once, however many events use it
+        renders: List[np.ndarray] = []
+        for synth, voice_params in flat.voices:
+            checkpoint()
+            renders.append(synth(voice_params))
+        
+        return self.cache(params, self._mix(params, flat, renders))
+    
+    def render_sparse(
+            self, 
+            params: Union[SequencerParams, Loop], 
+            block_size: int = 2 ** 14) -> BlockSparseCanvas:
+        """
+        Render the pattern to a block-sparse canvas, which only allocates 
+        blocks that some event reaches, e.g. for long arrangements that are
+        mostly silent.  Nested patterns are rendered sparsely too.
+        
+        Normalization is deferred until the canvas is read, and silence is 
+        only filled in as it's streamed, e.g. by passing `iter_blocks()` to
+        `encode_sample_blocks`.
+        """
+        cached = self.cached(params)
+        if cached is not None:
+            return BlockSparseCanvas.from_array(cached, block_size)
+        
+        self.prefetch(params)
+        
+        if isinstance(params, Loop):
+            pattern = self.render_sparse(params.pattern, block_size)
+            canvas = BlockSparseCanvas(block_size)
+            for start in self._loop_starts(params).tolist():
+                canvas.add(start, pattern)
+            return canvas
+        
+        flat = self._compiled(params)
+        buses = self._active_buses(params)
+        
+        renders: List[Union[np.ndarray, BlockSparseCanvas]] = []
+        for voice in flat.voices:
+            checkpoint()
+            nested = nested_sequencer(voice)
+            if nested is not None and nested.samplerate == self.samplerate:
+                renders.append(nested.render_sparse(voice.params, block_size))
+            else:
+                renders.append(voice.synth(voice.params))
+        
+        canvas = BlockSparseCanvas(block_size)
+        sends = {name: BlockSparseCanvas(block_size) for name in buses}
+        
+        convolved = [
+            voice for voice in self._impulse_train_voices(flat, renders) 
+            if isinstance(renders[voice], np.ndarray)
         ]
+        skip = set(convolved)
         
-        end_time = max(end_times)
-        end_sample = int(end_time * self.samplerate)
+        levels = {name: flat.sends[name].tolist() for name in buses}
+        
+        for i, (start, voice, gain) in enumerate(zip(
+                flat.starts.tolist(), flat.voice_index.tolist(), flat.gains.tolist())):
+            
+            if voice in skip:
+                continue
+            
+            checkpoint()
+            canvas.add(start, renders[voice], gain)
+            for name, level in levels.items():
+                if level[i]:
+                    sends[name].add(start, renders[voice], gain * level[i])
         
+        for voice in convolved:
+            members = np.flatnonzero(flat.voice_index == voice)
+            onsets = flat.starts[members]
+            gains = flat.gains[members]
+            names = [name for name in sends if np.any(flat.sends[name][members])]
+            
+            mixed = impulse_train_mix(
+                renders[voice], 
+                onsets, 
+                [gains, *[gains * flat.sends[name][members] for name in names]])
+            
+            canvas.add(int(onsets.min()), mixed[0])
+            for name, wet in zip(names, mixed[1:]):
+                sends[name].add(int(onsets.min()), wet)
+        
+        dry_end = len(canvas)
+        
+        # convolution is linear, so each run of sent signal can be convolved
+        # separately, without filling in the silence between them
+        for name, bus in buses.items():
+            for start, run in sends[name].runs():
+                wet = convolve_impulse_response(run, bus, self.fetcher)
+                canvas.add(start, wet, self._bus_gain(bus))
+        
+        if buses:
+            canvas.extend(dry_end + self._tail(buses))
+        
+        if params.normalize:
+            canvas.normalize()
+        
+        return canvas
+    
+    def _active_buses(self, params: SequencerParams) -> Dict[str, ReverbParameters]:
+        """
+        The buses to which at least one event sends a signal
+        """
+        active = dict()
+        
+        for name, levels in params.table.sends.items():
+            if name not in params.buses:
+                raise ValueError(f'Event sends to undeclared bus {name}')
+            if np.any(levels):
+                active[name] = params.buses[name]
+        
+        if active and self.fetcher is None:
+            raise ValueError('A fetcher is required to render patterns with reverb buses')
+        
+        return active
+    
+    def _bus_gain(self, bus: ReverbParameters) -> float:
+        # normalizing by the impulse response's energy keeps the bus's wet 
+        # level independent of the impulse response's length and loudness
+        ir = impulse_response(self.fetcher, bus)
+        return bus.mix / (np.linalg.norm(ir) + 1e-8)
+    
+    def _use_impulse_train(self, count: int, span: int, length: int) -> bool:
+        """
+        Whether `count` copies of a render, starting within `span` samples, 
+        should be mixed by convolution with an impulse train
+        """
+        if self.mixing == 'direct' or count < 2:
+            return False
+        
+        if self.mixing == 'impulse':
+            return True
+        
+        return impulse_train_mix_cost(span, length) < direct_mix_cost(count, length)
+    
+    def _impulse_train_voices(
+            self, 
+            flat: FlatPattern, 
+            renders: Sequence[np.ndarray]) -> List[int]:
+        """
+        The voices whose events should be mixed by convolving their render
+        with an impulse train, rather than by adding each separately
+        """
+        if self.mixing == 'direct':
+            return []
+        
+        n_voices = len(flat.voices)
+        counts = np.bincount(flat.voice_index, minlength=n_voices)
+        
+        first = np.full(n_voices, np.iinfo(np.int64).max)
+        last = np.zeros(n_voices, dtype=np.int64)
+        np.minimum.at(first, flat.voice_index, flat.starts)
+        np.maximum.at(last, flat.voice_index, flat.starts)
+        
+        return [
+            voice for voice, count in enumerate(counts.tolist()) 
+            if self._use_impulse_train(
+                count, int(last[voice] - first[voice]) + 1, len(renders[voice]))
+        ]
+    
+    def _events(self, params: SequencerParams) -> FlatPattern:
+        """
+        The pattern's own events, with nested patterns left intact
+        """
+        table = params.table
+        return FlatPattern(
+            starts=self._start_samples(params),
+            gains=table.gains,
+            voice_index=table.voice_index,
+            voices=table.voices,
+            sends=table.sends)
+    
+    def flatten(self, params: SequencerParams) -> FlatPattern:
+        """
+        Compile a tree of nested patterns into a single list of leaf events,
+        with absolute start positions and accumulated gains, which can be 
+        mixed in a single pass over a single buffer.
+        
+        Each nested pattern's normalization is preserved by scaling its 
+        events by its peak, which is found by streaming its mix, so that no
+        intermediate canvas is allocated.  Loops, nested patterns that 
+        declare or are sent to buses, and those rendered at a different 
+        samplerate, are left intact and rendered as leaves.
+        """
+        return self._flatten(params, dict())
+    
+    def _flatten(
+            self, 
+            params: SequencerParams, 
+            levels: Dict[int, FlatPattern]) -> FlatPattern:
+        
+        flat = self._events(params)
+        
+        expanded = []
+        for index, voice in enumerate(flat.voices):
+            nested = nested_sequencer(voice)
+            if nested is None or nested.samplerate != self.samplerate \
+                    or not isinstance(voice.params, SequencerParams) or voice.params.buses:
+                continue
+            
+            members = flat.voice_index == index
+            if any(np.any(levels[members]) for levels in flat.sends.values()):
+                continue
+            
+            # each unique nested pattern is compiled once, however many times
+            # it's played
+            key = id(voice.params)
+            if key not in levels:
+                levels[key] = nested._flatten_level(voice.params, levels)
+            expanded.append((members, levels[key]))
+        
+        if not expanded:
+            return flat
+        
+        keep = ~np.logical_or.reduce([members for members, _ in expanded])
+        result = flat.select(keep)
+        for members, level in expanded:
+            result = result.concat(level.place(flat.starts[members], flat.gains[members]))
+        
+        return result.compact()
+    
+    def _flatten_level(
+            self, 
+            params: SequencerParams, 
+            levels: Dict[int, FlatPattern]) -> FlatPattern:
+        
+        flat = self._flatten(params, levels)
+        if not params.normalize:
+            return flat
+        
+        return flat.scale(1 / (self._peak(params, flat) + 1e-8))
+    
+    def _compiled(self, params: SequencerParams) -> FlatPattern:
+        return self.flatten(params) if self.flatten_nested else self._events(params)
+    
+    def mix(self, params: SequencerParams, renders: Sequence[np.ndarray]) -> np.ndarray:
+        """
+        Mix the pattern's events into a single canvas, given the render of 
+        each of the pattern's unique voices
+        """
+        return self._mix(params, self._events(params), renders)
+    
+    def _mix(
+            self, 
+            params: SequencerParams, 
+            flat: FlatPattern, 
+            renders: Sequence[np.ndarray]) -> np.ndarray:
+        
+        buses = self._active_buses(params)
+        
+        lengths = np.array([len(r) for r in renders], dtype=np.int64)
+        end_sample = int(np.max(flat.starts + lengths[flat.voice_index]))
+        
+        record_duration(end_sample / self.samplerate)
         canvas = np.zeros((end_sample,), dtype=np.float32)
+        sends = {name: np.zeros((end_sample,)) for name in buses}
+        levels = {name: flat.sends[name].tolist() for name in buses}
         
-        # TODO: consider just using fft shift here
-        for event, render in zip(params.events, renders):
-            start_sample = int((event.time / params.speed) * self.samplerate)
-            if start_sample < 0:
-                raise ValueError('Negative samples not supported')
+        convolved = self._impulse_train_voices(flat, renders)
+        skip = set(convolved)
+        
+        for i, (start_sample, voice, gain) in enumerate(zip(
+                flat.starts.tolist(), flat.voice_index.tolist(), flat.gains.tolist())):
+            
+            if voice in skip:
+                continue
+            
+            checkpoint()
+            render = renders[voice] * gain
             end_sample = start_sample + len(render)
-            duration = end_sample - start_sample
-            canvas[start_sample: end_sample] += render[:duration]
+            canvas[start_sample: end_sample] += render
+            
+            for name, level in levels.items():
+                if level[i]:
+                    sends[name][start_sample: end_sample] += render * level[i]
+        
+        for voice in convolved:
+            members = np.flatnonzero(flat.voice_index == voice)
+            onsets = flat.starts[members]
+            gains = flat.gains[members]
+            names = [name for name in sends if np.any(flat.sends[name][members])]
+            
+            mixed = impulse_train_mix(
+                renders[voice], 
+                onsets, 
+                [gains, *[gains * flat.sends[name][members] for name in names]])
+            
+            first = onsets.min()
+            canvas[first: first + len(mixed[0])] += mixed[0]
+            for name, wet in zip(names, mixed[1:]):
+                sends[name][first: first + len(wet)] += wet
+        
+        # each bus is convolved once, with the sum of all signals sent to it
+        wets = [
+            convolve_impulse_response(sends[name], bus, self.fetcher) * self._bus_gain(bus)
+            for name, bus in buses.items()
+        ]
+        
+        if wets:
+            canvas = ensure_length(canvas, max(len(canvas), *[len(w) for w in wets]))
+            for wet in wets:
+                canvas[:len(wet)] += wet
         
         if params.normalize:
             canvas = canvas / (canvas.max() + 1e-8)
         
         print(f'Generated {len(canvas) / self.samplerate} seconds of audio')
         return canvas
-
     
+    def _iter_blocks(
+            self, 
+            params: SequencerParams, 
+            block_size: int, 
+            flat: Optional[FlatPattern] = None) -> Iterator[np.ndarray]:
+        """
+        Yield un-normalized blocks of the pattern's mix in time order, 
+        rendering each event only once the output reaches its start, and 
+        releasing it once the output has passed its end.  Buses are 
+        convolved block by block, using partitioned convolution.
+        
+        Nested patterns placed only once are themselves streamed, so that 
+        memory is bounded by polyphony however deeply patterns nest, while
+        those placed more than once are rendered whole, once, and shared.
+        """
+        if block_size <= 0:
+            raise ValueError(f'block_size must be positive but was {block_size}')
+        
+        if flat is None:
+            flat = self._compiled(params)
+        
+        if len(flat) == 0:
+            raise ValueError('Cannot render a pattern with no events')
+        
+        buses = self._active_buses(params)
+        convolvers = {
+            name: (reverb_convolver(self.fetcher, bus, block_size), self._bus_gain(bus)) 
+            for name, bus in buses.items()
+        }
+        tail = max([c.ir_length - 1 for c, _ in convolvers.values()], default=0)
+        
+        starts = flat.starts.tolist()
+        order = sorted(range(len(flat)), key=lambda i: starts[i])
+        gains = flat.gains.tolist()
+        voice_index = flat.voice_index.tolist()
+        levels = {name: flat.sends[name].tolist() for name in buses}
+        
+        # events whose span overlaps the current block, by their original 
+        # position, so that they're summed in the same order as in `mix`, 
+        # and the renders of their voices, which are released once no 
+        # remaining event needs them
+        active: Set[int] = set()
+        renders: Dict[int, Union[np.ndarray, StreamedRender]] = dict()
+        remaining = np.bincount(voice_index, minlength=len(flat.voices)).tolist()
+        uses = list(remaining)
+        # active events whose streamed render hasn't finished, so whose end
+        # isn't known yet
+        streaming: Set[int] = set()
+        pending = 0
+        end_sample = 0
+        total: Optional[int] = None
+        position = 0
+        
+        while total is None or position < total:
+            checkpoint()
+            block_end = position + block_size
+            
+            while pending < len(order) and starts[order[pending]] < block_end:
+                index = order[pending]
+                voice = voice_index[index]
+                if voice not in renders:
+                    renders[voice] = self._voice_render(
+                        flat.voices[voice], uses[voice] == 1, block_size)
+                active.add(index)
+                if isinstance(renders[voice], StreamedRender):
+                    streaming.add(index)
+                else:
+                    end_sample = max(end_sample, starts[index] + len(renders[voice]))
+                    record_duration(end_sample / self.samplerate)
+                pending += 1
+            
+            for index in sorted(streaming):
+                render = renders[voice_index[index]]
+                render.fill(block_end - starts[index])
+                if render.complete:
+                    streaming.discard(index)
+                    end_sample = max(end_sample, starts[index] + len(render))
+                    record_duration(end_sample / self.samplerate)
+            
+            if pending == len(order) and not streaming:
+                total = end_sample + tail
+                block_end = min(block_end, total)
+                if block_end <= position:
+                    break
+            
+            block = np.zeros((block_end - position,), dtype=np.float32)
+            sends = {name: np.zeros((block_end - position,)) for name in buses}
+            
+            for index in sorted(active):
+                start = starts[index]
+                voice = voice_index[index]
+                render = renders[voice]
+                lo = max(position, start)
+                hi = min(block_end, start + len(render))
+                if lo < hi:
+                    segment = render[lo - start: hi - start] * gains[index]
+                    block[lo - position: hi - position] += segment
+                    
+                    for name, level in levels.items():
+                        if level[index]:
+                            sends[name][lo - position: hi - position] += \
+                                segment * level[index]
+                
+                if index not in streaming and start + len(render) <= block_end:
+                    active.discard(index)
+                    remaining[voice] -= 1
+                    if remaining[voice] == 0:
+                        del renders[voice]
+            
+            for name, (convolver, gain) in convolvers.items():
+                wet = convolver.process(sends[name])
+                block += wet[:len(block)] * gain
+            
+            yield block
+            position = block_end
+    
+    def _voice_render(
+            self, 
+            voice: Voice, 
+            once: bool, 
+            block_size: int) -> Union[np.ndarray, StreamedRender]:
+        
+        synth, voice_params = voice
+        nested = nested_sequencer(voice)
+        
+        if once and nested is not None and nested.samplerate == self.samplerate \
+                and nested.cached(voice_params) is None:
+            return StreamedRender(nested.render_stream(voice_params, block_size))
+        
+        return synth(voice_params)
     
-    
\ No newline at end of file
+    def _iter_loop_blocks(self, loop: Loop, block_size: int) -> Iterator[np.ndarray]:
+        """
+        Yield blocks of a loop's overlapping repetitions in time order, so 
+        that memory is bounded by the length of a single repetition, rather
+        than by the loop's length
+        """
+        if block_size <= 0:
+            raise ValueError(f'block_size must be positive but was {block_size}')
+        
+        render = self.render(loop.pattern)
+        starts = self._loop_starts(loop).tolist()
+        total = starts[-1] + len(render)
+        
+        # the earliest repetition that may still overlap the current block
+        first = 0
+        
+        record_duration(total / self.samplerate)
+        
+        for position in range(0, total, block_size):
+            checkpoint()
+            block_end = min(position + block_size, total)
+            block = np.zeros((block_end - position,), dtype=np.float32)
+            
+            while starts[first] + len(render) <= position:
+                first += 1
+            
+            for start in starts[first:]:
+                if start >= block_end:
+                    break
+                lo = max(position, start)
+                hi = min(block_end, start + len(render))
+                block[lo - position: hi - position] += render[lo - start: hi - start]
+            
+            yield block
+    
+    def _prefer_dense(self, params: Union[SequencerParams, Loop]) -> bool:
+        """
+        Whether a normalized pattern, whose peak isn't known yet, should be
+        mixed once, in full, rather than streamed in two passes, which is 
+        the case when its render would fit within the render cache's budget
+        """
+        if isinstance(params, Loop) or not params.normalize \
+                or self._cached('peak', params) is not None:
+            return False
+        
+        self.prefetch(params)
+        length = self.max_render_length(params)
+        return length is not None and length * 4 <= self.render_cache.max_bytes
+    
+    def render_blocks(
+            self, 
+            params: Union[SequencerParams, Loop], 
+            block_size: int = 2048) -> Iterator[np.ndarray]:
+        """
+        Yield blocks of the pattern's mix, e.g. for encoding by `write`.
+        
+        Before its first block, a normalized pattern must be mixed in full,
+        to find its peak, unless the peak, or the render itself, is already
+        cached.  When the render fits within the render cache's budget, it 
+        is mixed once and cached, which takes half the time of streaming it
+        in two passes.  Otherwise it is streamed (see `render_stream`), 
+        bounding memory at the cost of mixing it twice.
+        """
+        cached = self.cached(params)
+        if cached is None and self._prefer_dense(params):
+            cached = self.render(params)
+        
+        if cached is not None:
+            return iter_sample_chunks(cached, chunksize=block_size)
+        
+        return self.render_stream(params, block_size)
+    
+    def render_stream(
+            self, 
+            params: Union[SequencerParams, Loop], 
+            block_size: int = 4096) -> Iterator[np.ndarray]:
+        """
+        Yield fixed-size blocks of the pattern's mix in time order, such 
+        that peak memory is bounded by the pattern's polyphony, rather than
+        its length.  The final block may be shorter than `block_size`.
+        
+        The concatenated blocks are identical to the output of `render`.  
+        Normalizing requires the peak of the entire mix, so normalized 
+        patterns whose peak isn't cached yet are mixed in two passes, the 
+        first of which only finds the peak.  Their first block is available
+        only after a full mix, and the whole stream costs roughly twice as 
+        much as `render`.  A render that's already cached is streamed from 
+        the cache.
+        """
+        cached = self.cached(params)
+        if cached is not None:
+            yield from iter_sample_chunks(cached, chunksize=block_size)
+            return
+        
+        self.prefetch(params)
+        
+        if isinstance(params, Loop):
+            yield from self._iter_loop_blocks(params, block_size)
+            return
+        
+        if not params.normalize:
+            yield from self._iter_blocks(params, block_size)
+            return
+        
+        peak = self._peak(params)
+        
+        for block in self._iter_blocks(params, block_size):
+            yield block / (peak + 1e-8)
@@ -0,0 +1,86 @@
+import asyncio
+from concurrent.futures import Executor
+from contextvars import copy_context
+from typing import Callable, Dict, Hashable, Optional, TypeVar
+
+from wiggle.cancellation import CancellationToken, cancellable
+
+T = TypeVar('T')
+
+
+class _Flight(object):
+
+    def __init__(self, future: asyncio.Future, token: CancellationToken):
+        super().__init__()
+        self.future = future
+        self.token = token
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Runs blocking work from asyncio code in an executor, collapsing
+    concurrent calls with the same key into a single in-flight computation,
+    whose result every caller receives.
+
+    Each computation runs under its own cancellation token, which is
+    cancelled once every caller waiting on it has been cancelled, so that
+    abandoned work stops at its next checkpoint.  Results are shared, so
+    callers must not modify them.
+    """
+
+    def __init__(self, executor: Optional[Executor] = None):
+        super().__init__()
+        self.executor = executor
+        self._flights: Dict[Hashable, _Flight] = dict()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def _start(self, key: Hashable, func: Callable[[], T]) -> _Flight:
+        loop = asyncio.get_running_loop()
+        token = CancellationToken()
+
+        def work() -> T:
+            with cancellable(token):
+                return func()
+
+        # the work runs in a copy of the caller's context, as it would if
+        # called directly
+        future = loop.run_in_executor(self.executor, copy_context().run, work)
+        flight = _Flight(future, token)
+
+        def done(f: asyncio.Future) -> None:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+            # the outcome of work abandoned by every caller is never awaited
+            if not f.cancelled():
+                f.exception()
+
+        future.add_done_callback(done)
+        return flight
+
+    async def run(self, key: Optional[Hashable], func: Callable[[], T]) -> T:
+        """
+        Run `func`, or wait for an identical call already in flight.  Calls
+        with a key of `None` are never shared.
+        """
+        flight = None if key is None else self._flights.get(key)
+        if flight is None:
+            flight = self._start(key, func)
+            if key is not None:
+                self._flights[key] = flight
+
+        flight.waiters += 1
+        try:
+            # one caller being cancelled mustn't cancel the others' result
+            return await asyncio.shield(flight.future)
+        except asyncio.CancelledError:
+            if flight.waiters == 1:
+                flight.token.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            raise
+        finally:
+            flight.waiters -= 1
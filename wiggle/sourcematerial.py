@@ -1,12 +1,8 @@
-from typing import Protocol
 from dataclasses import dataclass
 
-@dataclass
-class SourceMaterial:
-    url: str
-    
-    def __hash__(self):
-        return hash(self.url)
+from wiggle.immutable import Immutable
+
 
-    def __eq__(self, other: 'SourceMaterial'):
-        return self.url == other.url
\ No newline at end of file
+@dataclass(frozen=True, slots=True, eq=False)
+class SourceMaterial(Immutable):
+    url: str
@@ -0,0 +1,132 @@
+from fractions import Fraction
+import numpy as np
+from librosa.effects import time_stretch, pitch_shift
+from scipy.signal import resample_poly
+
+allowed_qualities = set([
+    'fast', 'standard', 'high'
+])
+
+
+def get_quality(name: str) -> str:
+    if name not in allowed_qualities:
+        raise ValueError(f'{name} is not an allowed quality')
+    return name
+
+
+def fix_length(samples: np.ndarray, length: int) -> np.ndarray:
+    if len(samples) >= length:
+        return samples[:length]
+    return np.pad(samples, [(0, length - len(samples))])
+
+
+def best_alignment(region: np.ndarray, target: np.ndarray, step: int) -> int:
+    """
+    Offset into `region` at which `target` is most similar, found with a
+    coarse search over decimated signals, refined at full resolution
+    """
+    coarse = np.correlate(region[::step], target[::step], mode='valid')
+    best = int(np.argmax(coarse)) * step
+
+    candidates = range(
+        max(0, best - step + 1),
+        min(len(region) - len(target), best + step - 1) + 1)
+    similarity = [np.dot(region[c: c + len(target)], target) for c in candidates]
+    return candidates[int(np.argmax(similarity))]
+
+
+def wsola_time_stretch(
+        samples: np.ndarray,
+        rate: float,
+        frame_size: int = 1024,
+        tolerance: int = 256,
+        search_step: int = 4) -> np.ndarray:
+    """
+    Waveform-similarity overlap-add time stretching.  Like librosa's
+    `time_stretch`, a rate greater than one shortens the audio.
+
+    Each output frame is copied directly from the input, from a position
+    within `tolerance` samples of its nominal position, chosen to best
+    continue the previous frame, so no STFT or phase reconstruction is
+    required
+    """
+    if rate <= 0:
+        raise ValueError(f'rate must be positive but was {rate}')
+
+    hop = frame_size // 2
+    window = np.hanning(frame_size)
+    output_length = int(round(len(samples) / rate))
+    n_frames = -(-output_length // hop) + 1
+
+    pad = tolerance + frame_size
+    padded = np.pad(
+        samples, [(pad, pad + int(n_frames * hop * rate) + frame_size)])
+
+    output = np.zeros(n_frames * hop + frame_size)
+    norm = np.zeros(n_frames * hop + frame_size)
+
+    delta = 0
+    for i in range(n_frames):
+        position = pad + int(i * hop * rate) + delta
+        frame = padded[position: position + frame_size]
+
+        output[i * hop: i * hop + frame_size] += frame * window
+        norm[i * hop: i * hop + frame_size] += window
+
+        # the frame that would naturally follow this one, and the region
+        # in which to search for the best match to it
+        natural = padded[position + hop: position + hop + frame_size]
+        nominal = pad + int((i + 1) * hop * rate)
+        region = padded[nominal - tolerance: nominal + tolerance + frame_size]
+        delta = best_alignment(region, natural, search_step) - tolerance
+
+    output[norm > 1e-3] /= norm[norm > 1e-3]
+    return output[:output_length]
+
+
+def resample_pitch_shift(
+        samples: np.ndarray,
+        n_steps: float,
+        max_denominator: int = 64) -> np.ndarray:
+    """
+    Shift pitch by polyphase resampling, and then restore the original
+    duration using WSOLA time stretching
+    """
+    ratio = Fraction(2 ** (-n_steps / 12)).limit_denominator(max_denominator)
+    resampled = resample_poly(samples, ratio.numerator, ratio.denominator)
+
+    if len(resampled) == 0:
+        return fix_length(resampled, len(samples))
+
+    stretched = wsola_time_stretch(resampled, rate=len(resampled) / len(samples))
+    return fix_length(stretched, len(samples))
+
+
+def stretch(samples: np.ndarray, rate: float, quality: str = 'standard') -> np.ndarray:
+    quality = get_quality(quality)
+
+    if quality == 'fast':
+        return wsola_time_stretch(samples, rate)
+
+    if quality == 'high':
+        return time_stretch(samples, rate=rate, n_fft=4096)
+
+    return time_stretch(samples, rate=rate)
+
+
+def shift_pitch(
+        samples: np.ndarray,
+        samplerate: int,
+        n_steps: float,
+        quality: str = 'standard') -> np.ndarray:
+
+    quality = get_quality(quality)
+
+    if quality == 'fast':
+        return resample_pitch_shift(samples, n_steps)
+
+    if quality == 'high':
+        return pitch_shift(
+            samples, sr=samplerate, n_steps=n_steps, n_fft=4096, res_type='soxr_vhq')
+
+    return pitch_shift(samples, sr=samplerate, n_steps=n_steps)
@@ -1,4 +1,4 @@
-from typing import Dict, List, Union
+from typing import List, Optional, Union
 
 from wiggle.samplerparams import SamplerParameters
 from .sequencer import Sequencer, SequencerParams
@@ -10,7 +10,7 @@ import numpy as np
 def materialize_synths(fetcher: AudioFetcher) -> List[BaseSynth]:
     return [
         Sampler(fetcher),
-        Sequencer(fetcher.samplerate)
+        Sequencer(fetcher.samplerate, fetcher=fetcher)
     ]
 
 Params = Union[SequencerParams, SamplerParameters]
@@ -72,11 +72,22 @@ def render(
     return samples
 
 
-def restore_params_from_dict(synth_id: Union[str, int], data: dict) -> Params:
+def restore_params_from_dict(
+        synth_id: Union[str, int], 
+        data: dict, 
+        fetcher: Optional[AudioFetcher] = None) -> Params:
+    
     try:
         params_class = params_by_synth_id[int(synth_id)]
     except (KeyError, ValueError) as e:
         params_class = params_by_synth_name[str(synth_id)]
     
+    if params_class is SequencerParams:
+        if fetcher is None:
+            raise ValueError('A fetcher is required to restore the synths of sequencer events')
+        
+        return SequencerParams.from_dict(
+            data, restore_params_from_dict, lambda id: get_synth(fetcher, id))
+    
     params = params_class.from_dict(data)
     return params
\ No newline at end of file
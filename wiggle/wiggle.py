@@ -1,15 +1,29 @@
 from wiggle.basesynth import BaseSynth
+from wiggle.cancellation import CancellationToken, cancellable
+from wiggle.fingerprint import UnstableIdentity, fingerprint
 from wiggle.fetch import AudioFetcher
+from wiggle.governor import ResourceGovernor, ResourceLimits, ResourceUsage
 from wiggle.sequencer import Sequencer
 from wiggle.sampler import Sampler
+from wiggle.singleflight import SingleFlight
 from wiggle.synthtype import SynthType
-from typing import Any, IO, Union
+from typing import Any, Callable, Hashable, IO, Iterator, Optional, Union
+from concurrent.futures import Executor
+from contextlib import contextmanager
 import numpy as np
-from dataclasses import dataclass
+import logging
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
 
 @dataclass
 class Permissions:
     fetch_external: bool
+    limits: ResourceLimits = field(default_factory=ResourceLimits)
+
+
+def log_usage(usage: ResourceUsage) -> None:
+    logger.info(f'Request used {usage}')
 
 
 class Wiggle(object):
@@ -18,12 +32,16 @@ class Wiggle(object):
             self, 
             samplerate: int, 
             fetcher: AudioFetcher, 
-            permissons: Permissions):
+            permissons: Permissions,
+            report_usage: Callable[[ResourceUsage], None] = log_usage,
+            executor: Optional[Executor] = None):
 
         super().__init__()
         self.samplerate = samplerate
         self.fetcher = fetcher
         self.permissions = permissons
+        self.report_usage = report_usage
+        self.flights = SingleFlight(executor)
     
     def store_media(self, audio_resource: Union[str, IO]) -> str:
         if isinstance(audio_resource, str):
@@ -51,25 +69,129 @@ class Wiggle(object):
     def list_synths(self):
         return [
             Sampler(self.fetcher),
-            Sequencer(self.samplerate)
+            Sequencer(self.samplerate, fetcher=self.fetcher)
         ]
     
     def get_synth(self, synth_type: SynthType) -> BaseSynth:
         if synth_type == SynthType.Sampler:
             return Sampler(self.fetcher)
         elif synth_type == SynthType.Sequencer:
-            return Sequencer(self.samplerate)
+            return Sequencer(self.samplerate, fetcher=self.fetcher)
         else:
             raise ValueError(f'Unknown synth type {synth_type}')
     
-    def render(self, synth_type: SynthType, params: Any) -> np.ndarray:
+    def admit(self, governor: ResourceGovernor, synth: BaseSynth, params: Any) -> None:
+        """
+        Check the request's estimated size against its limits, before 
+        rendering anything
+        """
+        if isinstance(synth, Sequencer):
+            plan = synth.plan(params)
+            governor.admit(plan.duration_seconds, plan.events, plan.depth, plan.urls)
+            return
+        
+        length = synth.max_render_length(params)
+        governor.admit(
+            duration_seconds=None if length is None else length / synth.samplerate,
+            events=1,
+            depth=0,
+            urls=set(sm.url for sm in params.source_material))
+    
+    @contextmanager
+    def governed(self, synth: BaseSynth, params: Any) -> Iterator[ResourceGovernor]:
+        """
+        Enforce the resource limits in this instance's permissions for a 
+        single request, reporting its usage once it completes or fails
+        """
+        governor = ResourceGovernor(self.permissions.limits)
+        try:
+            with governor:
+                self.admit(governor, synth, params)
+                yield governor
+        finally:
+            self.report_usage(governor.usage)
+    
+    def render(
+            self, 
+            synth_type: SynthType, 
+            params: Any, 
+            token: Optional[CancellationToken] = None) -> np.ndarray:
+        
         synth = self.get_synth(synth_type)
-        samples = synth.render(params)
+        with self.governed(synth, params) as governor, cancellable(token):
+            samples = synth.render(params)
+            governor.record_duration(len(samples) / synth.samplerate)
         return samples
     
-    def write(self, synth_type: SynthType, params: Any, io: IO) -> IO:
+    def write(
+            self, 
+            synth_type: SynthType, 
+            params: Any, 
+            io: IO, 
+            token: Optional[CancellationToken] = None) -> IO:
+        
         synth = self.get_synth(synth_type)
-        written = synth.write(params, io)
+        with self.governed(synth, params), cancellable(token):
+            written = synth.write(params, io)
         return written
     
+    def encode(
+            self, 
+            synth_type: SynthType, 
+            params: Any, 
+            format: str = 'WAV', 
+            subtype: str = 'PCM_16',
+            token: Optional[CancellationToken] = None) -> memoryview:
+        
+        synth = self.get_synth(synth_type)
+        with self.governed(synth, params), cancellable(token):
+            return synth.encode(params, format=format, subtype=subtype)
+    
+    def request_key(self, synth_type: SynthType, params: Any) -> Optional[Hashable]:
+        """
+        Identifies requests that produce identical audio, or `None` if the
+        parameters refer to a synth with no stable identity
+        """
+        try:
+            return (synth_type, self.samplerate, fingerprint(params))
+        except UnstableIdentity:
+            return None
+    
+    async def render_async(self, synth_type: SynthType, params: Any) -> np.ndarray:
+        """
+        Render without blocking the event loop.  Concurrent, identical 
+        requests share a single render, whose samples are read-only.
+        
+        Cancelling the awaiting task abandons the request, and the render
+        itself stops once every request sharing it has been abandoned.
+        """
+        def render() -> np.ndarray:
+            samples = self.render(synth_type, params)
+            samples.flags.writeable = False
+            return samples
+        
+        key = self.request_key(synth_type, params)
+        return await self.flights.run(None if key is None else ('render', key), render)
+    
+    async def write_async(
+            self, 
+            synth_type: SynthType, 
+            params: Any, 
+            io: IO,
+            format: str = 'WAV', 
+            subtype: str = 'PCM_16') -> IO:
+        """
+        Encode without blocking the event loop, and write the result to 
+        `io`.  Concurrent, identical requests share a single encoding.
+        """
+        key = self.request_key(synth_type, params)
+        encoded = await self.flights.run(
+            None if key is None else ('encode', key, format, subtype), 
+            lambda: self.encode(synth_type, params, format=format, subtype=subtype))
+        
+        io.write(encoded)
+        if io.seekable():
+            io.seek(0)
+        return io
+    
     
\ No newline at end of file